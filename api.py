@@ -1,61 +1,497 @@
 import logging
+import json
+import itertools
+import os
+import time
 
 import hug
+import falcon
 
 import lib.instances as instances
+import lib.jobs as jobs
+import lib.telemetry as telemetry
+import lib.metrics as metrics
+import lib.control as control
+from lib.feed import StampWatcher
 from lib.logger import initLogger
+from lib.constants import FEED_MAX_WAIT, METRICS_DIR, METRICS_WRITE_INTERVAL
 
 LOGGER_NAME = "api"
+# maximum number of serialized responses kept by cachedResponse
+RESPONSE_CACHE_SIZE = 256
+# streamed responses are sent in chunks of roughly this many bytes
+STREAM_CHUNK_SIZE = 65536
 
 initLogger(LOGGER_NAME, "API")
 
-@hug.get('/groups')
-def getGroups():
+REQUEST_SECONDS = metrics.registry.histogram("arboretum_api_request_seconds",
+    "Seconds taken to handle API requests, by route and status",
+    ["method", "route", "status"])
+
+# when this worker last left a snapshot of its metrics in METRICS_DIR
+_metrics_written = 0.0
+
+# shared by every /changes request handled by this worker
+_stamp_watcher = StampWatcher()
+
+# serialized responses keyed by endpoint and parameters, each stored with the
+# stamp value it was generated at and its extra headers
+_response_cache = {}
+
+@hug.format.content_type('application/json; charset=utf-8')
+def preserialized(data, request=None, response=None):
+    """
+    Output format for responses that are already encoded JSON, either as
+    bytes or as a ChunkStream
+    """
+    return data
+
+@hug.format.content_type('text/plain; version=0.0.4; charset=utf-8')
+def prometheus(data, request=None, response=None):
+    """
+    Output format for metrics, already rendered in Prometheus' text format
+    """
+    return data.encode("UTF-8")
+
+@hug.middleware_class()
+class RequestTimer:
+    """
+    Records how long each request takes. Requests are labelled with the
+    first segment of their path, so that eg every /jobs/{job_id} request
+    counts towards /jobs.
+    """
+    def process_request(self, request, response):
+        request.context['request_start'] = time.monotonic()
+
+    def process_response(self, request, response, resource, *args):
+        start = request.context.get('request_start')
+        if start is None:
+            return
+
+        REQUEST_SECONDS.observe(time.monotonic() - start,
+            method=request.method,
+            route="/" + request.path.strip("/").split("/")[0],
+            status=str(response.status).split()[0])
+        writeMetrics()
+
+def writeMetrics(force=False):
+    """
+    Leaves a snapshot of this worker's metrics in METRICS_DIR for whichever
+    worker answers /metrics, at most once every METRICS_WRITE_INTERVAL
+    seconds unless 'force' is set
+    """
+    global _metrics_written
+    now = time.monotonic()
+    if not force and now - _metrics_written < METRICS_WRITE_INTERVAL:
+        return
+
+    _metrics_written = now
+    try:
+        metrics.writeSnapshot(METRICS_DIR, os.getpid())
+    except OSError:
+        logging.getLogger(LOGGER_NAME).exception(
+            "Couldn't write metrics to {}.".format(METRICS_DIR))
+
+class ChunkStream:
+    """
+    File-like wrapper around an iterator of byte strings, letting hug stream
+    a response while it is still being generated. Once the iterator is
+    exhausted, the complete body is handed to 'on_complete'.
+    """
+    def __init__(self, chunks, on_complete=None):
+        self.chunks = iter(chunks)
+        self.on_complete = on_complete
+        self.buffer = b""
+        self.body = []
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.done = True
+                if self.on_complete is not None:
+                    self.on_complete(b"".join(self.body))
+                break
+
+            self.buffer += chunk
+            if self.on_complete is not None:
+                self.body.append(chunk)
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        # closing the generator releases its database connection early if
+        # the client went away
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+
+def streamGroupsJSON(entries):
+    """
+    Serializes groups as a JSON object one group at a time
+
+    Parameters
+    ----------
+    entries
+        Iterable of group dictionaries, as produced by instances.iterGroups
+
+    Yields
+    ------
+    chunk
+        UTF-8 encoded fragments of the JSON object
+    """
+    chunk = ["{"]
+    size = 0
+    separator = ""
+
+    for entry in entries:
+        item = "{}{}: {}".format(separator, json.dumps(entry['group_name']),
+            json.dumps(instances.formatGroup(entry)))
+        chunk.append(item)
+        size += len(item)
+        separator = ", "
+
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(chunk).encode("UTF-8")
+            chunk = []
+            size = 0
+
+    chunk.append("}")
+    yield "".join(chunk).encode("UTF-8")
+
+def storeResponse(key, stamp, headers, body):
+    """
+    Caches a serialized response, evicting entries built at other stamps and
+    then the oldest entries once RESPONSE_CACHE_SIZE is reached
+    """
+    for old_key in [old_key for old_key, cached in _response_cache.items()
+            if cached[0] != stamp]:
+        del _response_cache[old_key]
+
+    while len(_response_cache) >= RESPONSE_CACHE_SIZE:
+        del _response_cache[next(iter(_response_cache))]
+
+    _response_cache[key] = (stamp, headers, body)
+
+def cachedResponse(key, build, request, response):
+    """
+    Returns the serialized result of 'build', reusing the copy cached for
+    'key' while the database stamp hasn't changed. The stamp is sent as an
+    ETag, and a matching If-None-Match header gets an empty 304 response.
+
+    Parameters
+    ----------
+    key
+        Cache key identifying the endpoint and its parameters
+    build
+        Function returning a tuple of a dictionary of extra response headers
+        and an iterable of UTF-8 encoded JSON chunks
+    request
+        Falcon request object
+    response
+        Falcon response object
+
+    Returns
+    -------
+    body
+        UTF-8 encoded JSON, or a ChunkStream producing it
+    """
+    stamp = instances.getStamp()
+    etag = '"{}"'.format(stamp)
+    response.set_header('ETag', etag)
+
+    if_none_match = request.get_header('If-None-Match')
+    if if_none_match is not None and etag in [tag.strip() for tag in
+            if_none_match.split(",")]:
+        response.status = falcon.HTTP_304
+        return b""
+
+    cached = _response_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        for name, value in cached[1].items():
+            response.set_header(name, value)
+        return cached[2]
+
+    # the stamp is read before the body is built, so a change that happens
+    # in between only causes an unnecessary rebuild later
+    headers, chunks = build()
+    for name, value in headers.items():
+        response.set_header(name, value)
+
+    return ChunkStream(chunks,
+        on_complete=lambda body: storeResponse(key, stamp, headers, body))
+
+def groupsResponse(active_only, request, response, limit, cursor, prefix,
+        status, sort, reverse, since):
+    """
+    Shared implementation of the /groups and /activegroups endpoints. Pages
+    are fetched in one go so the next page's cursor can be sent in the
+    X-Next-Cursor header, unpaginated responses are streamed. If 'since' is
+    given, only the groups that changed after that version are returned.
+    """
+    filters = {'active_only': active_only, 'prefix': prefix,
+        'status': status, 'sort': sort, 'descending': reverse}
+
+    def build():
+        try:
+            if since is not None:
+                changes = instances.getGroupChanges(since,
+                    active_only=active_only)
+                return {}, [json.dumps(changes).encode("UTF-8")]
+            elif limit is not None:
+                entries, next_cursor = instances.getGroupPage(limit,
+                    cursor=cursor, **filters)
+                headers = {}
+                if next_cursor is not None:
+                    headers['X-Next-Cursor'] = next_cursor
+                return headers, streamGroupsJSON(entries)
+            else:
+                entries = instances.iterGroups(cursor=cursor, **filters)
+                # start the query now so that bad parameters are reported
+                # before the response starts streaming
+                first = list(itertools.islice(entries, 1))
+                return {}, streamGroupsJSON(itertools.chain(first, entries))
+        except ValueError as error:
+            raise falcon.HTTPBadRequest("Invalid parameter", str(error))
+
+    key = json.dumps([limit, cursor, since, sorted(filters.items())])
+    return cachedResponse(key, build, request, response)
+
+@hug.get('/groups', output=preserialized)
+def getGroups(request, response, limit: hug.types.number=None,
+        cursor: hug.types.text=None, prefix: hug.types.text=None,
+        status: hug.types.text=None, sort: hug.types.text="name",
+        reverse: hug.types.smart_boolean=False,
+        since: hug.types.number=None):
     """
     Getter function for groups
 
+    Parameters
+    ----------
+    limit
+        Maximum number of groups to return, the cursor of the next page is
+        sent in the X-Next-Cursor header
+    cursor
+        Value of X-Next-Cursor from the previous page
+    prefix
+        Only return groups whose name starts with this string
+    status
+        Only return groups with this status, eg 'up', 'building', 'error' or 'down'
+    sort
+        'name', 'ram' or 'build_time'
+    reverse
+        Sort in descending order
+    since
+        Version (stamp) the client already has. If given, the response is
+        an object with the current 'version', the changed groups under
+        'groups' and the names of deleted groups under 'removed'. 'full' is
+        true if the change log didn't go back far enough and 'groups' holds
+        every group instead.
+
+    Returns
+    -------
+    instances.iterGroups(...)
+        List of groups, as JSON
+    """
+    return groupsResponse(False, request, response, limit, cursor, prefix,
+        status, sort, reverse, since)
+
+@hug.get('/activegroups', output=preserialized)
+def getActiveGroups(request, response, limit: hug.types.number=None,
+        cursor: hug.types.text=None, prefix: hug.types.text=None,
+        status: hug.types.text=None, sort: hug.types.text="name",
+        reverse: hug.types.smart_boolean=False,
+        since: hug.types.number=None):
+    """
+    Getter function for active groups, accepts the same parameters as
+    /groups
+
     Returns
     -------
-    instances.getGroups(True)
-        List of groups
+    instances.iterGroups(active_only=True, ...)
+        List of active groups, as JSON
     """
-    return instances.getGroups(True)
+    return groupsResponse(True, request, response, limit, cursor, prefix,
+        status, sort, reverse, since)
 
-@hug.get('/activegroups')
-def getActiveGroups():
+def acceptJob(kind, args, response):
     """
-    Getter function for active groups
+    Submits a job and answers 202 Accepted with where to follow it
 
     Returns
     -------
-    instances.getGroups(True, active_only=True)
-        List of active groups
+    job
+        Dictionary with the 'job_id'
     """
-    return instances.getGroups(True, active_only=True)
+    job_id = jobs.requestJob(kind, args, LOGGER_NAME)
+
+    response.status = falcon.HTTP_202
+    response.set_header('Location', '/jobs/{}'.format(job_id))
+
+    return {'job_id': job_id}
 
 @hug.get('/create')
-def createInstance(group):
+def createInstance(group, response):
     """
-    Creates an instance of a given group with lifespan 8 hours
+    Queues the creation of an instance of a given group with lifespan 8
+    hours
 
     Parameters
     ----------
     group
         Name of the Unix group to start an instance for
+
+    Returns
+    -------
+    job
+        Dictionary with the 'job_id' to follow on /jobs/{job_id}
+    """
+    return acceptJob("create", {'groups': [group], 'lifetime': "8 hours"},
+        response)
+
+@hug.post('/create')
+def createInstances(groups: hug.types.multiple, response):
+    """
+    Queues the creation of instances of several groups at once, each with
+    lifespan 8 hours
+
+    Parameters
+    ----------
+    groups
+        Names of the Unix groups to start instances for, as a JSON list or
+        repeated form fields
+
+    Returns
+    -------
+    job
+        Dictionary with the 'job_id' to follow on /jobs/{job_id}. The job's
+        result maps each group to whether its instance was created, and its
+        server ID or the error.
     """
-    instances.startInstance(group, "8 hours", "api")
+    return acceptJob("create", {'groups': groups, 'lifetime': "8 hours"},
+        response)
 
 @hug.get('/destroy')
-def destroyInstance(group):
+def destroyInstance(group, response):
     """
-    Destroys an instance of a given group with lifespan 8 hours
+    Queues the destruction of the instance of a given group
 
     Parameters
     ----------
     group
-        Name of the Unix group to start an instance for
+        Name of the Unix group whose instance to destroy
+
+    Returns
+    -------
+    job
+        Dictionary with the 'job_id' to follow on /jobs/{job_id}
     """
-    instances.destroyInstance(group, "api")
+    return acceptJob("destroy", {'group': group}, response)
+
+@hug.post('/destroy')
+def destroyInstances(response, groups: hug.types.multiple=None,
+        glob: hug.types.text=None, expired_before: hug.types.text=None):
+    """
+    Queues the destruction of several instances at once, those matching
+    every given criterion. The instances are picked when the request is
+    accepted and destroyed concurrently.
+
+    Parameters
+    ----------
+    groups
+        Names of Unix groups, as a JSON list or repeated form fields
+    glob
+        Glob the group names have to match, eg 'hgi*'
+    expired_before
+        Only instances whose prune time is at or before this time, 'now' or
+        a UTC date and time like '2019-06-01 12:00:00'
+
+    Returns
+    -------
+    job
+        Dictionary with the 'job_id' to follow on /jobs/{job_id}. The job's
+        result maps each group to whether its instance was destroyed.
+    """
+    if groups is None and glob is None and expired_before is None:
+        raise falcon.HTTPBadRequest("Missing parameter",
+            "Give groups, glob or expired_before.")
+
+    try:
+        selected = instances.selectBranches(groups, glob, expired_before)
+    except ValueError as error:
+        raise falcon.HTTPBadRequest("Invalid parameter", str(error))
+
+    if not selected:
+        raise falcon.HTTPNotFound(description="No instances match.")
+
+    return acceptJob("destroy", {'groups': selected}, response)
+
+@hug.get('/jobs/{job_id}')
+def getJob(job_id: hug.types.text):
+    """
+    Reports the progress of a create or destroy job
+
+    Parameters
+    ----------
+    job_id
+        ID returned by /create or /destroy
+
+    Returns
+    -------
+    jobs.getJob(job_id)
+        The job's 'status' ('queued', 'running', 'done' or 'failed'), its
+        'result' and 'error', and when it was submitted, started and
+        finished
+    """
+    job = jobs.getJob(job_id)
+
+    if job is None:
+        raise falcon.HTTPNotFound()
+
+    return job
+
+@hug.get('/buildtimes')
+def getBuildTimes():
+    """
+    Reports where build time goes
+
+    Returns
+    -------
+    telemetry.summarisePhases()
+        Dictionary mapping each flavor to its number of finished 'builds'
+        and the mean seconds from the request to each later build phase
+    """
+    return telemetry.summarisePhases()
+
+@hug.get('/metrics', output=prometheus)
+def getMetrics():
+    """
+    Reports the metrics of the daemon, merged across its processes, and of
+    the API, merged across its workers
+
+    Returns
+    -------
+    text
+        Counters, gauges and histograms in Prometheus' text format
+    """
+    instances.collectMetrics()
+    writeMetrics(force=True)
+
+    # this worker's snapshot goes last, so its fresh gauges win
+    snapshots = metrics.readSnapshots(METRICS_DIR, exclude=str(os.getpid()))
+    snapshots.append(metrics.registry.snapshot())
+
+    try:
+        snapshots.insert(0, control.request("metrics", timeout=5))
+    except (control.DaemonUnavailable, control.CommandError, OSError):
+        pass
+
+    return metrics.render(metrics.mergeSnapshots(snapshots))
 
 @hug.get('/lastmodified')
 def getStamp():
@@ -68,3 +504,40 @@ def getStamp():
         The value of the stamp
     """
     return instances.getStamp()
+
+@hug.get('/changes')
+def getChanges(stamp: hug.types.text, timeout: hug.types.number=FEED_MAX_WAIT):
+    """
+    Long-poll replacement for polling /lastmodified. Waits until the stamp
+    differs from 'stamp' and returns the new stamp with the groups that
+    changed since 'stamp', or returns the unchanged stamp once the timeout
+    expires.
+
+    Parameters
+    ----------
+    stamp
+        Last stamp known to the client
+    timeout
+        Maximum number of seconds to wait, capped at FEED_MAX_WAIT
+
+    Returns
+    -------
+    changes
+        Dictionary with the current 'stamp' and whether it 'changed'. If it
+        did, the 'full', 'groups' and 'removed' fields of
+        instances.getGroupChanges are included.
+    """
+    current = str(instances.getStamp())
+
+    if current == str(stamp):
+        current = _stamp_watcher.wait(stamp,
+            max(0, min(timeout, FEED_MAX_WAIT)))
+
+        if current is None:
+            return {'stamp': stamp, 'changed': False}
+
+    changes = instances.getGroupChanges(stamp)
+
+    return {'stamp': changes['version'], 'changed': True,
+        'full': changes['full'], 'groups': changes['groups'],
+        'removed': changes['removed']}
@@ -7,15 +7,17 @@ import os
 import sys
 import subprocess
 import re
-import socket
 
 import jinja2
 import openstack
 
 import lib.instances as instances
+import lib.telemetry as telemetry
+import lib.control as control
+import lib.metrics as metrics
 from lib.daemon import Arboretum
 from lib.logger import initLogger
-from lib.constants import DATABASE_NAME
+from lib.constants import DATABASE_NAME, DAEMON_MODE
 
 LOGGER_NAME = "cli"
 
@@ -24,14 +26,19 @@ The following parser arguments create functionalities that the user can enter
 in order to interact with the daemon. The following commands are operations
 the user can use with the daemon where <> compulsory fields, [] optional fields:
 
-start
+start [--mode processes/asyncio]
 stop
 status
 active
-create <group> [--lifetime <lifetime>]
-destroy <group>
+create <group> [<group> ...] [--lifetime <lifetime>]
+destroy [<group> ...] [--glob <glob>] [--expired-before <time>]
 update
-groups
+groups [--limit <n>] [--cursor <cursor>] [--prefix <prefix>] [--status <status>]
+    [--sort name/ram/build_time] [--reverse]
+active [same options as groups]
+buildtimes
+metrics
+profile [--seconds <seconds>]
 """
 
 parser = argparse.ArgumentParser(description="Arboretum - A system to start, monitor, and destroy OpenStack Branchserve instances.")
@@ -40,6 +47,10 @@ subparsers = parser.add_subparsers(dest='subparser')
 
 parser_start = subparsers.add_parser('start',
     help="Start the Arboretum daemon")
+parser_start.add_argument('--mode', choices=['processes', 'asyncio'],
+    default=DAEMON_MODE,
+    help="Run the daemon's loops in their own processes or as tasks of a " \
+        "single asyncio event loop. Defaults to {}.".format(DAEMON_MODE))
 
 parser_stop = subparsers.add_parser('stop',
     help="Stop the Arboretum demon")
@@ -51,9 +62,10 @@ parser_active = subparsers.add_parser('active',
     help="Print status of active instances to stdout.")
 
 parser_instantiate = subparsers.add_parser('create',
-    help="Create a new Branchserve instance on OpenStack")
-parser_instantiate.add_argument('group', nargs=1,
-    help="Unix group name to make an instance for")
+    help="Create new Branchserve instances on OpenStack")
+parser_instantiate.add_argument('group', nargs='+',
+    help="Unix group names to make instances for, several instances are " \
+        "created concurrently")
 parser_instantiate.add_argument('--lifetime', nargs='+',
     default=['8', 'hours'],
     help="How long Arboretum will wait before automatically destroying " \
@@ -61,16 +73,50 @@ parser_instantiate.add_argument('--lifetime', nargs='+',
         "days OR forever\nNote: [xyz] should be three digits maximum.")
 
 parser_destroy = subparsers.add_parser('destroy',
-    help="Destroy an existing Branchserve instance on Openstack")
-parser_destroy.add_argument('group', nargs=1,
-    help="Name of the Unix group whose instance will be destroyed")
+    help="Destroy existing Branchserve instances on Openstack")
+parser_destroy.add_argument('group', nargs='*',
+    help="Names of the Unix groups whose instances will be destroyed, " \
+        "several instances are destroyed concurrently")
+parser_destroy.add_argument('--glob',
+    help="Only destroy instances of groups matching this glob, eg 'hgi*'")
+parser_destroy.add_argument('--expired-before', dest='expired_before',
+    help="Only destroy instances whose prune time is at or before this " \
+        "time: 'now' or a UTC date and time like '2019-06-01 12:00:00'")
+
+parser_metrics = subparsers.add_parser('metrics',
+    help="Print the daemon's metrics in Prometheus' text format.")
+
+parser_profile = subparsers.add_parser('profile',
+    help="Sample the stacks of the running daemon's processes and write " \
+        "them next to arboretum.log.")
+parser_profile.add_argument('--seconds', type=float, default=10,
+    help="How long to sample for. Defaults to 10 seconds.")
 
 parser_update = subparsers.add_parser('update',
     help="Update catalogue of S3 mpistat chunks.")
 
+parser_buildtimes = subparsers.add_parser('buildtimes',
+    help="Print how long builds take to reach each phase, per flavor.")
+
 parser_groups = subparsers.add_parser('groups',
     help="Print a list of available groups and their requirements.")
 
+for _parser in (parser_groups, parser_active):
+    _parser.add_argument('--limit', type=int,
+        help="Only print this many groups, followed by the cursor of the " \
+            "next page")
+    _parser.add_argument('--cursor',
+        help="Cursor printed after the previous page")
+    _parser.add_argument('--prefix',
+        help="Only print groups whose name starts with this string")
+    _parser.add_argument('--status',
+        help="Only print groups with this status, eg up, building, error or down")
+    _parser.add_argument('--sort', default='name',
+        choices=sorted(instances.GROUP_SORT_KEYS.keys()),
+        help="Column to sort the groups by. Defaults to name.")
+    _parser.add_argument('--reverse', action='store_true',
+        help="Sort in descending order")
+
 def verifyLifetime(lifetime):
     """
     Syntax checker for the 'lifetime' argument
@@ -90,6 +136,138 @@ def verifyLifetime(lifetime):
     else:
         return lifetime
 
+def printGroups(args, active_only):
+    """
+    Prints groups as a tab-separated table, streaming them from the database
+    unless a page size was given
+
+    Parameters
+    ----------
+    args
+        Parsed arguments of the 'groups' or 'active' command
+    active_only
+        Only print groups that have an instance
+    """
+    filters = {'active_only': active_only, 'prefix': args.prefix,
+        'status': args.status, 'sort': args.sort,
+        'descending': args.reverse, 'cursor': args.cursor}
+
+    try:
+        if args.limit is not None:
+            entries, next_cursor = instances.getGroupPage(args.limit,
+                **filters)
+        else:
+            entries, next_cursor = instances.iterGroups(**filters), None
+
+        for line in instances.formatGroupsTSV(entries):
+            print(line)
+    except ValueError as error:
+        print(error)
+        exit(1)
+
+    if next_cursor is not None:
+        print("\nNext page: --cursor {}".format(next_cursor))
+
+def printBuildTimes():
+    """
+    Prints the mean seconds builds of each flavor take to reach each phase,
+    as a tab-separated table
+    """
+    phases = telemetry.PHASES[1:]
+    print("Flavor\tBuilds\t" + "\t".join(phases))
+
+    for flavor, summary in sorted(telemetry.summarisePhases().items()):
+        print("{}\t{}\t{}".format(flavor, summary['builds'],
+            "\t".join("{:.0f}s".format(summary[phase]) if phase in summary
+                else "-" for phase in phases)))
+
+def requestDaemon(command, args=None):
+    """
+    Asks the daemon to run a command, so that it's the one talking to
+    OpenStack and writing the database
+
+    Parameters
+    ----------
+    command
+        One of the commands in lib/control.py
+    args
+        Dictionary of arguments for the command
+
+    Returns
+    -------
+    result
+        The command's result, or None if the daemon couldn't be reached and
+        the caller should do the work itself
+    """
+    try:
+        return control.request(command, args)
+    except control.DaemonUnavailable:
+        return None
+    except control.CommandError as error:
+        print("Error: {}".format(error))
+        exit(1)
+
+def printCreateResults(results, lifetime):
+    """
+    Prints the outcome of creating each group's instance, as returned by
+    instances.startInstances
+    """
+    for group, result in results.items():
+        if result['success']:
+            print("Created new Treeserve instance:\nID: {}\nGroup: {}\n" \
+                "Lifetime: {}".format(result['id'], group, lifetime))
+        else:
+            print(result['error'])
+
+def destroyGroups(groups):
+    """
+    Destroys the instances of 'groups' through the daemon, or directly if
+    it can't be reached
+    """
+    results = requestDaemon("destroy", {'groups': groups, 'wait': True})
+
+    if results is None:
+        instances.destroyInstances(groups, "cli")
+        return
+
+    for group, result in results.items():
+        if result['success']:
+            print("{} instance destroyed.".format(group))
+        else:
+            print(result['error'])
+
+def printMetrics():
+    """
+    Prints the daemon's metrics in Prometheus' text format, or only the ones
+    read from the database if the daemon isn't running
+    """
+    snapshot = requestDaemon("metrics")
+
+    if snapshot is None:
+        print("# The daemon isn't running, only database metrics are shown.")
+        instances.collectMetrics()
+        snapshot = metrics.registry.snapshot()
+
+    print(metrics.render(snapshot), end="")
+
+def profileDaemon(seconds):
+    """
+    Profiles the running daemon for 'seconds' seconds and prints where the
+    collapsed stacks were written
+    """
+    try:
+        result = control.request("profile", {'seconds': seconds},
+            timeout=seconds + 60)
+    except control.DaemonUnavailable:
+        print("Error: the daemon isn't running.")
+        exit(1)
+    except control.CommandError as error:
+        print("Error: {}".format(error))
+        exit(1)
+
+    print("Wrote {} samples from {} processes to {}".format(
+        result['samples'], result['processes'], result['path']))
+
 def getDaemonStatus():
     """
     Creates the daemon
@@ -105,13 +283,12 @@ def getDaemonStatus():
         signals=[10])
 
     if service.is_running():
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect(('127.0.0.1', 4510))
-            sock.send(b'status')
-            data = sock.recv(1024)
-        return data.decode("UTF-8")
-    else:
-        return "down"
+        try:
+            return control.request("status", timeout=5)
+        except (control.DaemonUnavailable, control.CommandError, OSError):
+            pass
+
+    return "down"
 
 if __name__ == '__main__':
     initLogger(LOGGER_NAME, "CLI")
@@ -121,7 +298,7 @@ if __name__ == '__main__':
     # daemon's working directory is root, so it needs the current working dir
     # signal 10 (SIGUSR1) is used for user-defined signals
     service = Arboretum(os.path.abspath(''), 'arboretum', pid_dir='/tmp',
-        signals=[10])
+        signals=[10], mode=getattr(args, 'mode', DAEMON_MODE))
 
     """
     The following lines of code control what the daemon does depending
@@ -168,7 +345,17 @@ if __name__ == '__main__':
 
         if go:
             lifetime = verifyLifetime(" ".join(args.lifetime))
-            instances.startInstance(args.group[0], lifetime, "cli")
+            results = requestDaemon("create", {'groups': args.group,
+                'lifetime': lifetime, 'wait': True, 'accepted': time.time()})
+
+            if results is not None:
+                printCreateResults(results, lifetime)
+            else:
+                results = instances.startInstances(args.group, lifetime,
+                    "cli")
+
+            if not all(result['success'] for result in results.values()):
+                exit(1)
         else:
             print("Exiting.")
 
@@ -182,13 +369,44 @@ if __name__ == '__main__':
             print("Inactive.")
 
     elif args.subparser == "destroy":
-        instances.destroyInstance(args.group[0], "cli")
+        if args.glob is None and args.expired_before is None:
+            if not args.group:
+                parser_destroy.error("give groups, --glob or --expired-before")
+            destroyGroups(args.group)
+        else:
+            try:
+                groups = instances.selectBranches(args.group or None,
+                    args.glob, args.expired_before)
+            except ValueError as error:
+                print("Error: {}".format(error))
+                exit(1)
+
+            if groups:
+                destroyGroups(groups)
+            else:
+                print("No instances match.")
+
+    elif args.subparser == "metrics":
+        printMetrics()
+
+    elif args.subparser == "profile":
+        profileDaemon(args.seconds)
 
     elif args.subparser == "update":
-        instances.generateGroupDatabase("cli")
+        result = requestDaemon("refresh")
+
+        if result is None:
+            instances.generateGroupDatabase("cli")
+        elif result['changed']:
+            print("Group catalogue updated.")
+        else:
+            print("Group catalogue already up to date.")
 
     elif args.subparser == "groups":
-        print(instances.getGroups(False))
+        printGroups(args, False)
 
     elif args.subparser == "active":
-        print(instances.getGroups(False, active_only=True))
+        printGroups(args, True)
+
+    elif args.subparser == "buildtimes":
+        printBuildTimes()
@@ -0,0 +1,258 @@
+import os
+import threading
+from concurrent.futures import Future
+
+import jinja2
+import openstack
+
+from . import metrics
+from .constants import SERVER_IMAGE, SERVER_KEY_NAME, SERVER_NETWORK, \
+    SERVER_SECURITY_GROUPS, USERDATA_TEMPLATE, OPENSTACK_CLOUD, \
+    OPENSTACK_RATE, OPENSTACK_RETRIES, OPENSTACK_RETRY_STATUSES, \
+    TOKEN_REFRESH_MARGIN
+
+LOGGER_NAME = "cli"
+# directory of arboretum.py and user.sh. The daemon's working directory is
+# '/', so templates can't be looked up relative to it.
+TEMPLATE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# services whose requests are retried on OPENSTACK_RETRY_STATUSES, the ones
+# behind the connection methods Arboretum uses
+RETRY_SERVICES = ("compute", "image", "network")
+# method name prefixes of calls that only read, duplicates of these that are
+# in flight at the same time are collapsed into one request
+LOOKUP_PREFIXES = ("get_", "list_", "search_")
+
+CALLS = metrics.registry.counter("arboretum_openstack_calls_total",
+    "OpenStack API calls", ["method", "outcome"])
+CALL_SECONDS = metrics.registry.histogram("arboretum_openstack_call_seconds",
+    "Seconds taken by OpenStack API calls", ["method"])
+COALESCED = metrics.registry.counter("arboretum_openstack_coalesced_total",
+    "Lookups that shared the result of an identical one in flight",
+    ["method"])
+
+class Gateway:
+    """
+    Long-lived, shared stand-in for an openstack.connection.Connection
+
+    The connection is made once per process, so clouds.yaml is read, Keystone
+    is authenticated against and HTTP sessions are opened once rather than
+    for every operation. openstacksdk limits it to OPENSTACK_RATE requests
+    per second per service, and retries single requests answered with one
+    of OPENSTACK_RETRY_STATUSES up to OPENSTACK_RETRIES times. Whole methods are never
+    retried here: one call such as create_server makes several requests,
+    and running it again after its POST went through would boot a second
+    server.
+
+    Every method of the connection is available on the gateway, wrapped so
+    that it:
+
+    - renews the Keystone token TOKEN_REFRESH_MARGIN seconds before it
+      expires
+    - counts calls and their latency by method
+    - shares the result of a lookup with identical lookups made while it's
+      in flight
+
+    close() does nothing, so callers can keep treating the gateway as a
+    connection of their own.
+    """
+    def __init__(self, cloud=OPENSTACK_CLOUD):
+        self.cloud = cloud
+        self.conn = None
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+
+    def connection(self):
+        """
+        Returns the underlying connection, making it if needed and renewing
+        its token when it's about to expire
+        """
+        with self.lock:
+            if self.conn is None:
+                conn = openstack.connect(cloud=self.cloud,
+                    rate_limit=OPENSTACK_RATE,
+                    status_code_retries=OPENSTACK_RETRIES)
+
+                # keystoneauth only retries 429 and 503 unless a service's
+                # proxy says otherwise, and there's no setting for it
+                for service in RETRY_SERVICES:
+                    getattr(conn, service).retriable_status_codes = \
+                        OPENSTACK_RETRY_STATUSES
+
+                self.conn = conn
+
+            auth = getattr(self.conn.session, "auth", None)
+            auth_ref = getattr(auth, "auth_ref", None)
+
+            if auth_ref is not None and \
+                    auth_ref.will_expire_soon(TOKEN_REFRESH_MARGIN):
+                # the next request authenticates again
+                auth.invalidate()
+
+            return self.conn
+
+    def close(self):
+        pass
+
+    def call(self, _method, *args, **kwargs):
+        """
+        Calls the connection's method named '_method', recording its outcome
+        and latency. The odd name keeps it clear of the method's own keyword
+        arguments, eg create_server's 'name'.
+        """
+        with CALL_SECONDS.time(method=_method):
+            try:
+                result = getattr(self.connection(), _method)(*args, **kwargs)
+            except openstack.exceptions.HttpException as error:
+                CALLS.inc(method=_method, outcome=str(error.status_code))
+                raise
+            except Exception:
+                CALLS.inc(method=_method, outcome="error")
+                raise
+
+        CALLS.inc(method=_method, outcome="ok")
+        return result
+
+    def lookup(self, _method, *args, **kwargs):
+        """
+        Like 'call', but identical lookups made while one is in flight wait
+        for its result instead of sending their own request
+        """
+        # arguments are usually strings and small dictionaries of filters,
+        # whose reprs identify them well enough
+        key = repr((_method, args, sorted(kwargs.items())))
+
+        with self.inflight_lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+
+        if not leader:
+            COALESCED.inc(method=_method)
+            return future.result()
+
+        try:
+            future.set_result(self.call(_method, *args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            with self.inflight_lock:
+                del self.inflight[key]
+
+        return future.result()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        if not callable(getattr(self.connection(), name)):
+            return getattr(self.connection(), name)
+
+        method = self.lookup if name.startswith(LOOKUP_PREFIXES) \
+            else self.call
+
+        def wrapper(*args, **kwargs):
+            return method(name, *args, **kwargs)
+
+        return wrapper
+
+# gateway of the current process, replaced after a fork
+_gateway = None
+_gateway_pid = None
+_gateway_lock = threading.Lock()
+
+def connect():
+    """
+    Returns the process' shared OpenStack gateway, connected to the
+    OPENSTACK_CLOUD cloud in clouds.yaml
+
+    Returns
+    -------
+    conn
+        A Gateway, which can be used like an openstack.connection.Connection
+    """
+    global _gateway, _gateway_pid
+
+    with _gateway_lock:
+        if _gateway is None or _gateway_pid != os.getpid():
+            _gateway = Gateway()
+            _gateway_pid = os.getpid()
+
+        return _gateway
+
+def renderUserdata(group_name=None, pooled=False, restored=False):
+    """
+    Renders the userdata script passed to new instances
+
+    Parameters
+    ----------
+    group_name
+        Unix group whose data the instance loads, None for pooled instances
+    pooled
+        Render the script for a pooled instance, which provisions itself and
+        then waits to be assigned a group
+    restored
+        Render the script for an instance booted from a snapshot of the
+        group, which only has to start serving its tree
+
+    Returns
+    -------
+    userdata
+        The rendered script
+    """
+    jinja_env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(TEMPLATE_DIR))
+    template = jinja_env.get_template(USERDATA_TEMPLATE)
+
+    return template.render(group_name = group_name, pooled = pooled,
+        restored = restored)
+
+def listServers(conn):
+    """
+    Lists every Arboretum server, branches and pooled instances alike, in a
+    single request
+
+    Parameters
+    ----------
+    conn
+        An OpenStack connection
+
+    Returns
+    -------
+    servers
+        Dictionary mapping server IDs to servers
+    """
+    return {server.id: server for server in
+        conn.list_servers(filters={'name': '^arboretum-'})}
+
+def createServer(conn, name, flavor, userdata, image=None):
+    """
+    Boots an Arboretum instance, from the arboretum image unless told
+    otherwise
+
+    Parameters
+    ----------
+    conn
+        An OpenStack connection
+    name
+        Name of the new server
+    flavor
+        Name of the flavor to use
+    userdata
+        Script run by the server on first boot
+    image
+        ID of the image to boot from, defaults to SERVER_IMAGE
+
+    Returns
+    -------
+    info
+        The server as returned by 'create_server'
+    """
+    return conn.create_server(name=name,
+        image=SERVER_IMAGE if image is None else image,
+        key_name=SERVER_KEY_NAME,
+        flavor=flavor,
+        network=SERVER_NETWORK,
+        security_groups=SERVER_SECURITY_GROUPS,
+        userdata=userdata)
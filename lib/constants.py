@@ -1 +1,159 @@
 DATABASE_NAME = "_arboretum_database.db"
+# Unix domain socket the daemon takes commands from the CLI and API on
+CONTROL_SOCKET = "/tmp/arboretum.sock"
+# largest control message accepted, in bytes
+CONTROL_MAX_FRAME = 16 * 1024**2
+# most control commands the daemon runs at once
+CONTROL_WORKERS = 4
+# threads running the quick, read-only control commands, so they're answered
+# while the other workers are busy with slow ones
+CONTROL_QUICK_WORKERS = 2
+# directory where each API worker leaves a snapshot of its metrics, so that
+# /metrics reports them added up across workers, and the least number of
+# seconds between two snapshots of a worker
+METRICS_DIR = "/tmp/arboretum-metrics"
+METRICS_WRITE_INTERVAL = 1
+# how the daemon runs its loops by default: 'processes' forks one process per
+# loop, 'asyncio' runs them all as tasks of one event loop
+DAEMON_MODE = "processes"
+# most blocking steps run at once by the asyncio daemon
+DAEMON_EXECUTOR_WORKERS = 4
+# seconds before the asyncio daemon retries a task whose step raised
+TASK_RESTART_DELAY = 5
+# seconds between two samples of the daemon's stacks while profiling
+PROFILE_INTERVAL = 0.01
+# longest profile the daemon takes on request, in seconds
+PROFILE_MAX_SECONDS = 300
+# the daemon dumps the stack of a step that runs this many times longer than
+# its steps usually take, or WATCHDOG_MIN_SECONDS if that's longer
+WATCHDOG_FACTOR = 10
+WATCHDOG_MIN_SECONDS = 60
+# weight of the latest duration in the moving average of a step's durations
+WATCHDOG_SMOOTHING = 0.2
+
+# number of mpistat index rows loaded per executemany call when the group
+# catalogue is regenerated
+INGEST_BATCH_SIZE = 5000
+
+# location of the mpistat index on S3
+S3_BUCKET = "branchserve"
+S3_INDEX_KEY = "mpistat/index.txt"
+# s3cmd style config file holding the S3 credentials and endpoint
+S3_CONFIG = "~/.s3cfg"
+# environment variable overriding the S3 endpoint, eg for a local stand-in
+S3_ENDPOINT_VARIABLE = "ARBORETUM_S3_ENDPOINT"
+S3_POOL_SIZE = 4
+
+# seconds between two stamp lookups while long-poll clients are waiting
+FEED_POLL_INTERVAL = 0.25
+# longest a /changes request is held open, kept below gunicorn's timeout
+FEED_MAX_WAIT = 25
+
+# number of most recent versions kept in the change log, and how often (in
+# versions) older entries are trimmed
+CHANGELOG_LENGTH = 10000
+CHANGELOG_TRIM_INTERVAL = 100
+
+# seconds a connection waits for another process' write lock before giving up
+DATABASE_BUSY_TIMEOUT = 30
+# number of prepared statements cached per SQLite connection
+STATEMENT_CACHE_SIZE = 256
+
+# seconds before the cached flavor list is refreshed
+FLAVOR_CACHE_TTL = 3600
+# flavor name fragments tried in order when picking a flavor, "m" keeps the
+# high core count o2 flavors out
+FLAVOR_PREFERENCE = ["m", "s2"]
+# fewest cores an instance is given
+FLAVOR_MIN_VCPUS = 2
+# flavor used for instances needing less than FLAVOR_DEFAULT_MAX_RAM bytes
+FLAVOR_DEFAULT = "m1.small"
+FLAVOR_DEFAULT_MAX_RAM = 14 * 1024**3
+
+# most servers created at once by a batch create
+CREATE_CONCURRENCY = 8
+# most servers destroyed at once by a batch destroy, eg of expired instances
+DESTROY_CONCURRENCY = 8
+# seconds after which a destroy that never finished, eg because its process
+# died, is taken over by the next one, unless it waits for a snapshot
+DESTROY_CLAIM_TIMEOUT = 900
+
+# how new instances are booted
+SERVER_IMAGE = "hgi-arboretum-image"
+SERVER_KEY_NAME = "mercury"
+SERVER_NETWORK = "cloudforms_network"
+SERVER_SECURITY_GROUPS = ["default", "cloudforms_web_in", "cloudforms_ssh_in",
+    "cloudforms_local_in"]
+# jinja template of the userdata script, next to arboretum.py
+USERDATA_TEMPLATE = "user.sh"
+
+# number of idle, pre-provisioned instances kept per flavor, eg
+# {"m1.small": 2}. Flavors that aren't listed are never pooled.
+POOL_SIZES = {}
+# seconds after the last create of a flavor before its pool is emptied
+POOL_IDLE_TIMEOUT = 4 * 3600
+# seconds a pooled instance may take to become ready before it's destroyed
+POOL_BUILD_TIMEOUT = 3600
+# port pooled instances serve once they're ready to be assigned a group
+POOL_PORT = 8081
+# server metadata key naming the group a pooled instance is assigned to
+POOL_GROUP_KEY = "arboretum_group"
+
+# most create and destroy jobs run at once by each API worker
+JOB_CONCURRENCY = 4
+# seconds a finished job is kept around for /jobs lookups
+JOB_RETENTION = 24 * 3600
+
+# bytes of RAM given to an instance on top of its group's requirement, as
+# headroom for system processes
+RAM_HEADROOM = 1024**3
+
+# most recent builds of a group averaged to predict its next one
+ESTIMATE_GROUP_HISTORY = 20
+# fewest builds of a flavor needed before fitting build time against RAM
+ESTIMATE_MIN_SAMPLES = 3
+
+# snapshot a group's instance before destroying it, and boot the group's
+# next instance from that snapshot while its index entry is unchanged
+SNAPSHOTS_ENABLED = False
+# only groups whose mpistat build time is at least this many minutes are
+# snapshotted, smaller ones rebuild quickly enough
+SNAPSHOT_MIN_BUILD_TIME = 30
+# seconds a snapshot is kept after it was taken or last used
+SNAPSHOT_LIFETIME = 14 * 24 * 3600
+# seconds before the daemon gives up on a snapshot OpenStack hasn't
+# finished, and destroys its instance anyway
+SNAPSHOT_TIMEOUT = 3600
+
+# where Treeserve answers once an instance is ready
+TREESERVE_PORT = 8080
+TREESERVE_PROBE_PATH = "/api/v2"
+# seconds a readiness probe waits to connect, and then for a response
+PROBE_CONNECT_TIMEOUT = 3
+PROBE_READ_TIMEOUT = 10
+# most readiness probes in flight at once
+PROBE_CONCURRENCY = 32
+
+# fewest and most seconds between two checks of the same building instance
+POLL_MIN_INTERVAL = 5
+POLL_MAX_INTERVAL = 120
+# seconds between two checks of the warm pool
+POOL_CHECK_INTERVAL = 15
+# most seconds the prune loop sleeps between checks for branches that were
+# created or destroyed without the daemon being told
+PRUNE_MAX_INTERVAL = 30
+# seconds before the daemon retries destroying an expired instance it failed
+# to destroy
+PRUNE_RETRY_DELAY = 60
+
+# entry of clouds.yaml Arboretum connects to
+OPENSTACK_CLOUD = "openstack"
+# OpenStack requests per second allowed per process and service, enforced
+# by openstacksdk for each HTTP request
+OPENSTACK_RATE = 10
+# retries of a single HTTP request OpenStack answered with one of
+# OPENSTACK_RETRY_STATUSES, with keystoneauth's backoff
+OPENSTACK_RETRIES = 4
+OPENSTACK_RETRY_STATUSES = [429, 502, 503, 504]
+# seconds before its expiry that the Keystone token is renewed
+TOKEN_REFRESH_MARGIN = 300
@@ -0,0 +1,416 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import uuid
+
+from .constants import CONTROL_SOCKET, CONTROL_MAX_FRAME, CONTROL_WORKERS, \
+    CONTROL_QUICK_WORKERS
+
+"""
+The daemon is controlled over a Unix domain socket. Each message is a
+frame: a 4 byte big-endian length followed by that many bytes of UTF-8
+JSON. A request is {"id": ..., "command": ..., "args": {...}} and its
+response {"id": ..., "ok": true, "result": ...} or {"id": ..., "ok":
+false, "error": "..."}, with the request's id. A connection can carry
+several requests, whose responses may come back in any order.
+
+The daemon runs the commands from a queue on CONTROL_WORKERS threads, so it
+is the only process writing instances to the database while it runs. The
+quick, read-only status, metrics and list commands, and creates and
+destroys that only queue a job, have a queue of their own on
+CONTROL_QUICK_WORKERS threads, so they're answered straight away even while
+creates and destroys that wait keep the other workers busy. The commands
+are:
+
+status
+    The health of the daemon's processes or tasks
+create
+    Creates instances for args['groups'] with args['lifetime']. With
+    args['wait'], answers with each group's outcome once done, otherwise
+    straight away with the 'job_id' of a job doing it
+destroy
+    Destroys the instances of args['groups'], answering like create
+metrics
+    Snapshot of the daemon's metrics, merged across its processes, see
+    lib/metrics.py
+profile
+    Samples the stacks of every daemon process for args['seconds']
+    seconds, answers with the 'path' of the collapsed stacks it wrote next
+    to arboretum.log, see lib/profiling.py
+list
+    The groups, or with args['active_only'] the active ones, like /groups
+refresh
+    Updates the group catalogue from mpistat's index, answers whether it
+    changed
+"""
+
+# prefix of every frame, the length of its JSON body
+FRAME_HEADER = struct.Struct(">I")
+# commands that only read and return quickly, run on their own workers
+QUICK_COMMANDS = {"status", "metrics", "list"}
+# commands that are just as quick when they only queue a job, ie without
+# args['wait']
+JOB_COMMANDS = {"create", "destroy"}
+
+
+class DaemonUnavailable(Exception):
+    """
+    The daemon couldn't be reached, eg because it isn't running
+    """
+
+
+class CommandError(Exception):
+    """
+    The daemon ran the command but it failed
+    """
+
+
+def encodeFrame(message):
+    """
+    Returns 'message', a JSON serializable object, as a frame
+    """
+    body = json.dumps(message).encode("UTF-8")
+    return FRAME_HEADER.pack(len(body)) + body
+
+def decodeLength(header):
+    """
+    Returns the body length from a frame's header
+
+    Raises
+    ------
+    ValueError
+        If the frame is bigger than CONTROL_MAX_FRAME
+    """
+    length = FRAME_HEADER.unpack(header)[0]
+    if length > CONTROL_MAX_FRAME:
+        raise ValueError("Frame of {} bytes is too big.".format(length))
+
+    return length
+
+def recvExactly(sock, size):
+    """
+    Reads exactly 'size' bytes, or returns None if the connection is closed
+    before the first of them
+    """
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if data:
+                raise ConnectionError("Connection closed mid-frame.")
+            return None
+        data += chunk
+
+    return data
+
+def recvFrame(sock):
+    """
+    Reads a frame from a blocking socket
+
+    Returns
+    -------
+    message
+        The decoded message, or None if the connection was closed
+    """
+    header = recvExactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+
+    body = recvExactly(sock, decodeLength(header))
+    if body is None:
+        raise ConnectionError("Connection closed mid-frame.")
+
+    return json.loads(body.decode("UTF-8"))
+
+async def readFrame(reader):
+    """
+    Reads a frame from an asyncio stream
+
+    Returns
+    -------
+    message
+        The decoded message, or None if the connection was closed
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as error:
+        if error.partial:
+            raise ConnectionError("Connection closed mid-frame.")
+        return None
+
+    body = await reader.readexactly(decodeLength(header))
+    return json.loads(body.decode("UTF-8"))
+
+def request(command, args=None, timeout=None, path=CONTROL_SOCKET):
+    """
+    Sends a command to the daemon and waits for its response
+
+    Parameters
+    ----------
+    command
+        One of the commands described in the module docstring
+    args
+        JSON serializable dictionary of arguments for the command
+    timeout
+        Seconds to wait for the response, forever if None
+    path
+        Path of the daemon's socket
+
+    Returns
+    -------
+    result
+        The command's result
+
+    Raises
+    ------
+    DaemonUnavailable
+        If the daemon couldn't be reached
+    CommandError
+        If the command failed
+    """
+    request_id = uuid.uuid4().hex
+
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    except AttributeError:
+        # no Unix domain sockets on this platform
+        raise DaemonUnavailable("Unix domain sockets aren't supported.")
+
+    with sock:
+        try:
+            # connecting is quick when the daemon is up, however long the
+            # command takes
+            sock.settimeout(1)
+            sock.connect(path)
+        except OSError as error:
+            raise DaemonUnavailable("Can't reach the daemon at {}: {}"
+                .format(path, error))
+
+        sock.settimeout(timeout)
+        sock.sendall(encodeFrame({'id': request_id, 'command': command,
+            'args': args or {}}))
+
+        response = recvFrame(sock)
+
+    if response is None:
+        raise DaemonUnavailable("The daemon closed the connection.")
+    if response.get('id') != request_id:
+        raise CommandError("Response to the wrong request.")
+    if not response.get('ok'):
+        raise CommandError(response.get('error'))
+
+    return response.get('result')
+
+
+class CommandQueue:
+    """
+    Runs control commands in the order they arrive, on a fixed number of
+    worker threads, with separate workers for quick commands, see isQuick
+
+    Methods
+    -------
+    submit(message, reply)
+        Queues a request
+    stop()
+        Stops the workers once the queued commands are done
+    """
+    def __init__(self, handlers, workers=CONTROL_WORKERS,
+            quick_workers=CONTROL_QUICK_WORKERS, logger="daemon"):
+        """
+        Parameters
+        ----------
+        handlers
+            Dictionary mapping command names to functions taking the
+            request's arguments and returning a JSON serializable result
+        workers
+            Number of slow commands run at once
+        quick_workers
+            Number of quick commands run at once
+        logger
+            Name of the logger failures are reported to
+        """
+        self.handlers = handlers
+        self.logger = logging.getLogger(logger)
+        self.queue = queue.Queue()
+        self.quick_queue = queue.Queue()
+        # (queue, thread) of every worker
+        self.threads = [(commands, threading.Thread(target=self.work,
+                args=(commands,), daemon=True))
+            for commands, count in ((self.queue, workers),
+                (self.quick_queue, quick_workers))
+            for _ in range(count)]
+
+        for _, thread in self.threads:
+            thread.start()
+
+    def submit(self, message, reply):
+        """
+        Queues a request
+
+        Parameters
+        ----------
+        message
+            The decoded request
+        reply
+            Function called with the response, from a worker thread
+        """
+        if isQuick(message):
+            self.quick_queue.put((message, reply))
+        else:
+            self.queue.put((message, reply))
+
+    def stop(self):
+        """
+        Stops the workers once the commands already queued are done
+        """
+        for commands, _ in self.threads:
+            commands.put(None)
+        for _, thread in self.threads:
+            thread.join()
+
+    def work(self, commands):
+        while True:
+            item = commands.get()
+            if item is None:
+                return
+
+            message, reply = item
+            response = {'id': message.get('id')
+                if isinstance(message, dict) else None}
+
+            try:
+                if not isinstance(message, dict) or \
+                        message.get('command') not in self.handlers:
+                    raise ValueError("Unknown command.")
+
+                response['result'] = self.handlers[message['command']](
+                    message.get('args') or {})
+                response['ok'] = True
+            except Exception as error:
+                if not isinstance(error, (ValueError, KeyError)):
+                    self.logger.exception("Command {} failed."
+                        .format(message.get('command')))
+                response['ok'] = False
+                response['error'] = "{}: {}".format(type(error).__name__,
+                    error)
+
+            try:
+                reply(response)
+            except Exception:
+                # the client went away, nothing to report to
+                pass
+
+
+def isQuick(message):
+    """
+    Returns whether a request is answered quickly, ie it's one of
+    QUICK_COMMANDS or of JOB_COMMANDS without args['wait']
+    """
+    if not isinstance(message, dict):
+        return False
+
+    command = message.get('command')
+    args = message.get('args')
+    if not isinstance(args, dict):
+        args = {}
+
+    return command in QUICK_COMMANDS or \
+        (command in JOB_COMMANDS and not args.get('wait'))
+
+
+class ControlServer:
+    """
+    Serves the control socket with a thread per connection, handing the
+    requests to a CommandQueue
+
+    Methods
+    -------
+    start()
+        Starts accepting connections
+    close()
+        Stops accepting connections and removes the socket
+    """
+    def __init__(self, commands, path=CONTROL_SOCKET):
+        """
+        Parameters
+        ----------
+        commands
+            CommandQueue running the requests
+        path
+            Path of the socket, replaced if it's left over from a daemon
+            that crashed
+        """
+        self.commands = commands
+        self.path = path
+        self.sock = bindSocket(path)
+        self.thread = threading.Thread(target=self.accept, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.sock.close()
+        removeSocket(self.path)
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                # the socket was closed
+                return
+
+            threading.Thread(target=self.serve, args=(conn,),
+                daemon=True).start()
+
+    def serve(self, conn):
+        lock = threading.Lock()
+
+        def reply(response):
+            with lock:
+                conn.sendall(encodeFrame(response))
+
+        try:
+            while True:
+                message = recvFrame(conn)
+                if message is None:
+                    break
+                self.commands.submit(message, reply)
+        except (OSError, ValueError):
+            # eg a client speaking another protocol
+            pass
+
+        # clients wait for their responses before closing, so responses
+        # still queued have nobody to go to
+        conn.close()
+
+def bindSocket(path=CONTROL_SOCKET):
+    """
+    Binds and listens on the control socket, replacing a stale one
+
+    Returns
+    -------
+    sock
+        The listening socket
+    """
+    removeSocket(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+
+    return sock
+
+def removeSocket(path=CONTROL_SOCKET):
+    """
+    Removes the control socket's file, if there is one
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -1,20 +1,38 @@
+import asyncio
 import logging
+import queue
+import threading
 import time
+import uuid
 import os
-import sqlite3
 import re
-import socket
 from pathlib import Path
-from multiprocessing import Process, Event
+from multiprocessing import Process, Event, Queue
+from concurrent.futures import ThreadPoolExecutor
 
 import jinja2
 import service
 import openstack
 
 from . import instances
-from .constants import DATABASE_NAME
+from . import flavors
+from . import cloud
+from . import pool
+from . import snapshots
+from . import probes
+from . import control
+from . import jobs
+from . import metrics
+from . import profiling
+from .scheduler import PollScheduler, ExpiryHeap
+from .constants import DATABASE_NAME, CONTROL_SOCKET, DAEMON_MODE, \
+    DAEMON_EXECUTOR_WORKERS, TASK_RESTART_DELAY, PROFILE_MAX_SECONDS, \
+    POOL_CHECK_INTERVAL, PRUNE_MAX_INTERVAL, PRUNE_RETRY_DELAY
 from .logger import initLogger
 
+RESTARTS = metrics.registry.counter("arboretum_restarts_total",
+    "Daemon processes or tasks revived after dying", ["process"])
+
 
 class Arboretum(service.Service):
     """
@@ -26,28 +44,65 @@ class Arboretum(service.Service):
     -------
     run
         Main run loop of the daemon process used to setup processes
+    runAsync
+        Main run loop of the daemon in asyncio mode
+    runTask(name, step, wakeup, executor, task_health)
+        Runs one of the steps as an asyncio task
+    handleConnection(reader, writer, commands)
+        Reads requests from the control socket in asyncio mode
+    getCommandHandlers(health, child_metrics)
+        Functions carrying out each control command
+    collectMetrics(child_metrics)
+        Snapshot of the metrics of all of the daemon's processes
+    profileCommand(args)
+        Profiles all of the daemon's processes for the profile command
+    prepareProcess(process)
+        Sets up a freshly forked process of the daemon
+    refreshFlavors()
+        Keeps the flavor list of the process serving creates fresh
+    sendMetrics(process)
+        Sends this process' metrics to the main process
+    createCommand(args)
+        Creates instances for the control socket's create command
+    destroyCommand(args)
+        Destroys instances for the control socket's destroy command
+    wakePruner
+        Makes the prune loop pick up new prune times straight away
     getHealthString(process_health)
         Getter function that turns the processes' health into a String
     pruneLoop(exit_event)
-        Exit Event checker & Wrapper function for pruneExpiredInstances
+        Exit Event checker & Wrapper function for pruneStep
     updateLoop(exit_event)
-        Exit Event checker & Wrapper function for updateBuildingInstances
+        Exit Event checker & Wrapper function for updateStep
     updateGroupsLoop(exit_event)
-        Updates group database every hour checking for exit event during sleep phase
-    pruneExpiredInstances
-        Checks active instance's lifetime and destroys where appropriate
+        Exit Event checker & Wrapper function for updateGroupsStep
+    pruneStep(state)
+        Destroys the instances whose prune time has passed
+    updateStep(state)
+        Checks the building instances that are due and the warm pool
+    updateGroupsStep
+        Updates the group database and prunes stale snapshots
+    syncExpiries(expiry, version)
+        Brings the prune loop's heap of prune times up to date
+    pruneExpiredInstances(expiry)
+        Destroys the instances whose prune time has passed
 
 
     """
-    def __init__(self, working_dir, *args, **kwargs):
+    def __init__(self, working_dir, *args, mode=DAEMON_MODE, **kwargs):
         """
         Parameters
         ----------
         working_dir : str
             z
+        mode : str
+            'processes' runs each loop in its own process, 'asyncio' runs
+            them all as tasks of one event loop
         """
         super(Arboretum, self).__init__(*args, **kwargs)
 
+        self.mode = mode
+
         self.LOGGER_NAME = "daemon"
         self.logger = initLogger(self.LOGGER_NAME, "DAEMON")
 
@@ -64,90 +119,117 @@ class Arboretum(service.Service):
         """
         Main run loop of the daemon
 
-        Sets up socket connection, establishes the processes and
-        loops checking for a change of state
+        Establishes the processes, serves the control socket and loops
+        checking for a change of state, or hands over to runAsync in asyncio
+        mode
 
         Raises
         ------
         NameError
             If the socket or event doesn't exist
         """
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                # creates IPv4 TCP socket for the daemon and CLI to talk over
-                sock.bind(('127.0.0.1', 4510))
-                sock.listen()
-                sock.settimeout(1)
-
-                exit_event = Event()
-                self.logger.info("Starting daemon management processes.")
-
-                process_map = {'prune_process': self.pruneLoop,
-                    'instance_update_process': self.updateLoop,
-                    'group_update_process': self.updateGroupsLoop}
-
-                processes = {}
-                for process_name in process_map.keys():
-                    processes[process_name] = Process(
-                        target=process_map[process_name],
-                        args=(exit_event,), daemon=True)
+        if self.mode == "asyncio":
+            # python-service calls run from a thread of its own, which has
+            # no event loop yet
+            asyncio.run(self.runAsync())
+            return
 
-                process_health = {}
+        try:
+            exit_event = Event()
+            # set when branches are created, wakes the prune loop
+            self.expiry_event = Event()
+            # the processes send snapshots of their metrics after each step
+            self.metrics_queue = Queue()
+            child_metrics = {}
+            # profile requests for each process and their results
+            self.profile_requests = {name: Queue() for name in
+                ['prune_process', 'instance_update_process',
+                'group_update_process']}
+            self.profile_results = Queue()
+            self.profile_lock = threading.Lock()
+            self.logger.info("Starting daemon management processes.")
+
+            process_map = {'prune_process': self.pruneLoop,
+                'instance_update_process': self.updateLoop,
+                'group_update_process': self.updateGroupsLoop}
+
+            processes = {}
+            for process_name in process_map.keys():
+                processes[process_name] = Process(
+                    target=process_map[process_name],
+                    args=(exit_event,), daemon=True)
+
+            process_health = {}
+
+            for process in processes.keys():
+                processes[process].start()
+                process_health[process] = "up"
+
+            # the command threads start after the processes are forked, so
+            # the processes don't inherit them
+            commands = control.CommandQueue(
+                self.getCommandHandlers(process_health, child_metrics))
+            server = control.ControlServer(commands)
+            server.start()
+            next_flavor_check = 0
+
+            while not self.got_sigterm():
+                time.sleep(1)
+
+                # creates run in this process, on the command threads and
+                # jobs, and choose flavors from its own copy of the list
+                if time.time() >= next_flavor_check:
+                    self.refreshFlavors()
+                    next_flavor_check = time.time() + POOL_CHECK_INTERVAL
+
+                while True:
+                    try:
+                        process, snapshot = self.metrics_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    child_metrics[process] = snapshot
 
+                # Test for crashed processes, will crash silently otherwise
+                dead_procs = []
                 for process in processes.keys():
-                    processes[process].start()
+                    if not processes[process].is_alive():
+                        self.logger.critical("CRITICAL: Process {}" \
+                            "has died".format(process))
+                        process_health[process] = "down"
+                        dead_procs.append(process)
+
+                for process in dead_procs:
+                    processes.pop(process)
+                    # start a new process of the same type
+                    replacement = Process(target=process_map[process],
+                        args=(exit_event,), daemon=True)
+                    replacement.start()
+                    processes[process] = replacement
                     process_health[process] = "up"
+                    RESTARTS.inc(process=process)
+                    self.logger.critical("Process {} has been revived."
+                        .format(process))
 
-                while not self.got_sigterm():
-                    try:
-                        # blocking socket with a second-long time out
-                        conn, addr = sock.accept()
-                        data = conn.recv(1024)
-                        if data:
-                            cmd = data.decode("UTF-8")
-                            if cmd == "status":
-                                response = self.getHealthString(process_health)
-                                conn.sendall(response)
-                        conn.close()
-                    except socket.timeout:
-                        pass
-
-                    # Test for crashed processes, will crash silently otherwise
-                    dead_procs = []
-                    for process in processes.keys():
-                        if not processes[process].is_alive():
-                            self.logger.critical("CRITICAL: Process {}" \
-                                "has died".format(process))
-                            process_health[process] = "down"
-                            dead_procs.append(process)
-
-                    for process in dead_procs:
-                        processes.pop(process)
-                        # start a new process of the same type
-                        replacement = Process(target=process_map[process],
-                            args=(exit_event,), daemon=True)
-                        replacement.start()
-                        processes[process] = replacement
-                        process_health[process] = "up"
-                        self.logger.critical("Process {} has been revived."
-                            .format(process))
-
-                sock.close()
+            # commands that were already queued still run
+            server.close()
+            commands.stop()
 
             self.logger.info("Terminating daemon management processes.")
             exit_event.set()
+            self.expiry_event.set()
 
             for process in processes.values():
                 process.join()
             self.logger.info("Exiting.")
         except Exception as e:
             try:
-                sock.close()
+                server.close()
             except NameError:
                 pass
 
             try:
                 exit_event.set()
+                self.expiry_event.set()
                 for process in processes.values():
                     process.join()
             except NameError:
@@ -155,6 +237,319 @@ class Arboretum(service.Service):
 
             raise e
 
+    async def runAsync(self):
+        """
+        Main run loop of the daemon in asyncio mode
+
+        Runs the prune, instance update and group update steps as tasks of
+        one event loop, alongside an asyncio server for the control socket.
+        The steps block, so they're run on an executor of at most
+        DAEMON_EXECUTOR_WORKERS threads, and share this process' database
+        connections, OpenStack connection and caches. Stops once the current
+        steps and queued commands finish after a SIGTERM.
+        """
+        self.loop = loop = asyncio.get_running_loop()
+        self.profile_lock = threading.Lock()
+        executor = ThreadPoolExecutor(max_workers=DAEMON_EXECUTOR_WORKERS)
+
+        self.stop_event = asyncio.Event()
+        # set when branches are created, wakes the prune task
+        self.expiry_wakeup = asyncio.Event()
+        # python-service owns SIGTERM, and signal handlers can only be added
+        # to a loop in the main thread, so a thread waits for it instead
+        def watchSigterm():
+            self.wait_for_sigterm()
+            loop.call_soon_threadsafe(self.stop_event.set)
+
+        threading.Thread(target=watchSigterm, daemon=True).start()
+
+        self.logger.info("Starting daemon management tasks.")
+
+        task_health = {}
+        prune_state = {}
+        update_state = {}
+        task_map = {
+            'prune_task': (lambda: self.pruneStep(prune_state),
+                self.expiry_wakeup),
+            'instance_update_task': (lambda: self.updateStep(update_state),
+                None),
+            'group_update_task': (self.updateGroupsStep, None)}
+
+        commands = control.CommandQueue(self.getCommandHandlers(task_health,
+            {}))
+        control.removeSocket()
+        server = await asyncio.start_unix_server(
+            lambda reader, writer: self.handleConnection(reader, writer,
+                commands), CONTROL_SOCKET)
+
+        tasks = [loop.create_task(self.runTask(name, step, wakeup, executor,
+            task_health)) for name, (step, wakeup) in task_map.items()]
+
+        await self.stop_event.wait()
+        self.logger.info("Terminating daemon management tasks.")
+
+        server.close()
+        await server.wait_closed()
+        control.removeSocket()
+        # commands that were already queued still run
+        await loop.run_in_executor(None, commands.stop)
+
+        await asyncio.gather(*tasks)
+        executor.shutdown(wait=True)
+
+        self.logger.info("Exiting.")
+
+    async def runTask(self, name, step, wakeup, executor, task_health):
+        """
+        Runs 'step' on the executor until the daemon stops, sleeping for as
+        long as each run asks. A step that raises is retried after
+        TASK_RESTART_DELAY seconds, like a crashed process is revived.
+
+        Parameters
+        ----------
+        name
+            Name of the task, as reported by the status command
+        step
+            Function returning the seconds until it's next due
+        wakeup
+            asyncio Event that cuts the sleep short, or None
+        executor
+            Executor the step runs on
+        task_health
+            Dictionary of the tasks' status
+        """
+        loop = asyncio.get_event_loop()
+        task_health[name] = "up"
+        watchdog = profiling.Watchdog(name)
+
+        while not self.stop_event.is_set():
+            try:
+                delay = await loop.run_in_executor(executor, watchdog.call,
+                    step)
+            except Exception:
+                self.logger.critical("CRITICAL: Task {} has died"
+                    .format(name), exc_info=True)
+                task_health[name] = "down"
+                delay = TASK_RESTART_DELAY
+
+            waits = [loop.create_task(self.stop_event.wait())]
+            if wakeup is not None:
+                waits.append(loop.create_task(wakeup.wait()))
+
+            done, pending = await asyncio.wait(waits, timeout=delay,
+                return_when=asyncio.FIRST_COMPLETED)
+            for waiter in pending:
+                waiter.cancel()
+
+            if wakeup is not None:
+                wakeup.clear()
+
+            if task_health[name] == "down" and not self.stop_event.is_set():
+                task_health[name] = "up"
+                RESTARTS.inc(process=name)
+                self.logger.critical("Task {} has been revived.".format(name))
+
+    async def handleConnection(self, reader, writer, commands):
+        """
+        Reads requests from a connection to the control socket in asyncio
+        mode and queues them, see lib/control.py for the protocol
+
+        Parameters
+        ----------
+        reader, writer
+            Streams of the connection
+        commands
+            CommandQueue running the requests
+        """
+        loop = asyncio.get_event_loop()
+
+        def send(response):
+            if not writer.is_closing():
+                writer.write(control.encodeFrame(response))
+
+        def reply(response):
+            loop.call_soon_threadsafe(send, response)
+
+        try:
+            while True:
+                message = await control.readFrame(reader)
+                if message is None:
+                    break
+                commands.submit(message, reply)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            # eg a client speaking another protocol
+            pass
+
+        # clients wait for their responses before closing, so responses
+        # still queued have nobody to go to
+        writer.close()
+
+    def getCommandHandlers(self, health, child_metrics):
+        """
+        Returns the functions carrying out each control command
+
+        Parameters
+        ----------
+        health
+            Dictionary of the processes' or tasks' status, reported by the
+            status command
+        child_metrics
+            Dictionary of the latest metrics snapshot of each process,
+            merged with this process' by the metrics command
+
+        Returns
+        -------
+        handlers
+            Dictionary mapping command names to functions taking the
+            command's arguments, see lib/control.py
+        """
+        return {'status': lambda args: self.getHealthString(health)
+                .decode("UTF-8"),
+            'create': self.createCommand,
+            'destroy': self.destroyCommand,
+            'list': lambda args: instances.getGroups(True,
+                active_only=bool(args.get('active_only')),
+                db_name=self.db_path),
+            'metrics': lambda args: self.collectMetrics(child_metrics),
+            'profile': self.profileCommand,
+            'refresh': lambda args: {'changed': bool(
+                instances.generateGroupDatabase(self.LOGGER_NAME,
+                    db_name=self.db_path))}}
+
+    def collectMetrics(self, child_metrics):
+        """
+        Returns a snapshot of the daemon's metrics, merged across its
+        processes, with the gauges that mirror the database up to date
+
+        Parameters
+        ----------
+        child_metrics
+            Dictionary of the latest metrics snapshot of each process
+        """
+        instances.collectMetrics(self.db_path)
+
+        return metrics.mergeSnapshots([metrics.registry.snapshot()] +
+            list(child_metrics.values()))
+
+    def profileCommand(self, args):
+        """
+        Samples the stacks of every process of the daemon for
+        args['seconds'] seconds and writes them, merged, as collapsed stacks
+        next to arboretum.log
+
+        Returns
+        -------
+        result
+            Dictionary with the 'path' of the profile, its number of
+            'samples' and of 'processes' profiled
+
+        Raises
+        ------
+        ValueError
+            If the duration isn't valid or a profile is already running
+        """
+        seconds = float(args.get('seconds', 10))
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            raise ValueError("Profiles last between 0 and {} seconds."
+                .format(PROFILE_MAX_SECONDS))
+
+        if not self.profile_lock.acquire(blocking=False):
+            raise ValueError("A profile is already running.")
+
+        try:
+            request_id = uuid.uuid4().hex
+            waiting = 0
+
+            if self.mode != "asyncio":
+                for requests in self.profile_requests.values():
+                    requests.put((request_id, seconds))
+                    waiting += 1
+
+            profiles = [profiling.sampleStacks(seconds,
+                root="daemon" if self.mode == "asyncio" else "main_process")]
+
+            # processes that are busy starting up may answer a little late
+            deadline = time.monotonic() + 10
+            while waiting:
+                try:
+                    answer_id, stacks = self.profile_results.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    self.logger.warning("{} processes didn't send their " \
+                        "profile.".format(waiting))
+                    break
+
+                # answers to earlier requests that timed out are dropped
+                if answer_id == request_id:
+                    profiles.append(stacks)
+                    waiting -= 1
+        finally:
+            self.profile_lock.release()
+
+        stacks = profiling.mergeProfiles(profiles)
+        path = profiling.writeProfile(stacks, self.working_dir)
+        self.logger.info("Profile of {} samples written to {}."
+            .format(sum(stacks.values()), path))
+
+        return {'path': path, 'samples': sum(stacks.values()),
+            'processes': len(profiles)}
+
+    def createCommand(self, args):
+        """
+        Creates instances for args['groups'] with args['lifetime'], straight
+        away if args['wait'] is set, otherwise as a job
+
+        Returns
+        -------
+        result
+            Dictionary mapping each group to its outcome, or with the
+            'job_id' of the job
+        """
+        groups = list(args['groups'])
+        lifetime = args.get('lifetime', "8 hours")
+
+        if not args.get('wait'):
+            return {'job_id': jobs.submitJob("create",
+                {'groups': groups, 'lifetime': lifetime}, self.LOGGER_NAME,
+                db_name=self.db_path, callback=self.wakePruner)}
+
+        try:
+            return instances.startInstances(groups, lifetime,
+                self.LOGGER_NAME, db_name=self.db_path,
+                accepted=args.get('accepted'))
+        finally:
+            self.wakePruner()
+
+    def destroyCommand(self, args):
+        """
+        Destroys the instances of args['groups'], straight away if
+        args['wait'] is set, otherwise as a job
+
+        Returns
+        -------
+        result
+            Dictionary mapping each group to its outcome, or with the
+            'job_id' of the job
+        """
+        groups = list(args['groups'])
+
+        if not args.get('wait'):
+            return {'job_id': jobs.submitJob("destroy", {'groups': groups},
+                self.LOGGER_NAME, db_name=self.db_path)}
+
+        return instances.destroyInstances(groups, self.LOGGER_NAME,
+            db_name=self.db_path)
+
+    def wakePruner(self):
+        """
+        Makes the prune loop or task pick up new prune times straight away,
+        from any thread
+        """
+        if self.mode == "asyncio":
+            self.loop.call_soon_threadsafe(self.expiry_wakeup.set)
+        else:
+            self.expiry_event.set()
+
     def getHealthString(self, process_health):
         """
         Getter function that turns the processes' health into a String
@@ -177,59 +572,282 @@ class Arboretum(service.Service):
 
     def pruneLoop(self, exit_event):
         """
-        Exit Event checker & Wrapper function for pruneExpiredInstances
+        Exit Event checker & Wrapper function for pruneStep
 
         Parameters
         ----------
         exit_event
             Multiprocessing event that controls the running of the daemon's processes
         """
+        self.prepareProcess("prune_process")
+        watchdog = profiling.Watchdog("prune_process")
+        state = {}
+
         while not exit_event.is_set():
-            self.pruneExpiredInstances()
-            time.sleep(2)
+            delay = watchdog.call(lambda: self.pruneStep(state))
+            self.sendMetrics("prune_process")
+
+            # a notification that arrives after this still wakes the next
+            # wait, and the next sync picks up its changes
+            if self.expiry_event.wait(delay):
+                self.expiry_event.clear()
 
     def updateLoop(self, exit_event):
         """
-        Exit Event checker & Wrapper function for updateBuildingInstances
+        Exit Event checker & Wrapper function for updateStep
+
+        Parameters
+        ----------
+        exit_event
+            Multiprocessing event that controls the running of the daemon's processes
         """
+        self.prepareProcess("instance_update_process")
+        watchdog = profiling.Watchdog("instance_update_process")
+        state = {}
+
         while not exit_event.is_set():
-            instances.updateBuildingInstances(self.db_path)
-            time.sleep(5)
+            delay = watchdog.call(lambda: self.updateStep(state))
+            self.sendMetrics("instance_update_process")
+            exit_event.wait(delay)
 
     def updateGroupsLoop(self, exit_event):
         """
-        Updates group database every hour checking for exit event during sleep phase
+        Exit Event checker & Wrapper function for updateGroupsStep
 
         Parameters
         ----------
         exit_event
             Multiprocessing event that controls the running of the daemon's processes
         """
+        self.prepareProcess("group_update_process")
+        watchdog = profiling.Watchdog("group_update_process")
+
         while not exit_event.is_set():
-            instances.generateGroupDatabase("daemon", db_name=self.db_path)
-            # sleep for an hour, waking up every two seconds so that the exit
-            # event can be checked
-            count = 0
-            while count < 3600:
-                if exit_event.is_set():
-                    break
-                time.sleep(2)
-                count += 2
+            delay = watchdog.call(self.updateGroupsStep)
+            self.sendMetrics("group_update_process")
+            exit_event.wait(delay)
 
-    def pruneExpiredInstances(self):
+    def refreshFlavors(self):
         """
-        Checks active instance's lifetime and destroys where appropriate
+        Keeps this process' flavor list fresh, so creates don't have to
+        wait for OpenStack to list the flavors
         """
-        db = sqlite3.connect(self.db_path)
-        cursor = db.cursor()
+        try:
+            flavors.catalogue.ensureFresh(cloud.connect)
+        except Exception as error:
+            self.logger.warning("Couldn't fetch the flavor list.\n{}: {}"
+                .format(type(error), error))
 
-        cursor.execute('''SELECT instance_id, group_name, prune_time FROM
-            branches WHERE prune_time <= datetime("now")''')
+    def prepareProcess(self, process):
+        """
+        Sets up a freshly forked process of the daemon: forgets the metrics
+        it inherited, which the main process reports itself, and starts
+        answering profile requests
 
-        for result in cursor:
-            self.logger.info("{} instance has expired.\n\tPrune time: {}"
-                .format(result[1], result[2]))
+        Parameters
+        ----------
+        process
+            Name of the process, as reported by the status command
+        """
+        metrics.registry.clear()
+        profiling.serveProfiles(self.profile_requests[process],
+            self.profile_results, process)
+
+    def sendMetrics(self, process):
+        """
+        Sends a snapshot of this process' metrics to the daemon's main
+        process
+
+        Parameters
+        ----------
+        process
+            Name of the process, as reported by the status command
+        """
+        # snapshots still queued aren't worth waiting for when exiting
+        self.metrics_queue.cancel_join_thread()
+        self.metrics_queue.put((process, metrics.registry.snapshot()))
+
+    @metrics.timed
+    def pruneStep(self, state):
+        """
+        Destroys the instances whose prune time has passed, the ones whose
+        snapshot has finished and the ones whose destroy never finished
+
+        The prune times of all branches are kept in a heap, loaded from the
+        database on the first step and updated from the change log whenever
+        the database's stamp moves. The caller should sleep until the
+        earliest prune time, or until it's told that branches were created,
+        but at most PRUNE_MAX_INTERVAL seconds, so an idle daemon only reads
+        the stamp every so often.
+
+        Parameters
+        ----------
+        state
+            Dictionary kept between steps, empty on the first one
+
+        Returns
+        -------
+        delay
+            Seconds until the next step is due
+        """
+        expiry = state.setdefault('expiry', ExpiryHeap())
+        state['version'] = self.syncExpiries(expiry, state.get('version'))
+        self.pruneExpiredInstances(expiry)
+        # instances kept for their snapshot
+        instances.finishDestroys(self.LOGGER_NAME, self.db_path)
+
+        # destroys that their process died or was stopped in the middle of
+        stale = instances.getStaleDestroys(self.db_path)
+        if stale:
+            self.logger.warning("Taking over the unfinished destroys of {}."
+                .format(", ".join(stale)))
+            instances.destroyInstances(stale, self.LOGGER_NAME,
+                db_name=self.db_path)
+
+        delay = PRUNE_MAX_INTERVAL
+        next_prune = expiry.next()
+        if next_prune is not None:
+            delay = max(0, min(delay, next_prune - time.time()))
+
+        return delay
+
+    @metrics.timed
+    def updateStep(self, state):
+        """
+        Checks the building instances that are due and the warm pool
 
-            instances.destroyInstance(result[1], "daemon", db_name=self.db_path)
+        Each building instance is checked when the scheduler says it's due,
+        the warm pool every POOL_CHECK_INTERVAL seconds, and the next step is
+        due whenever either is.
 
-        db.close()
+        Parameters
+        ----------
+        state
+            Dictionary kept between steps, empty on the first one
+
+        Returns
+        -------
+        delay
+            Seconds until the next step is due
+        """
+        scheduler = state.setdefault('scheduler', PollScheduler())
+        next_pool_check = state.get('next_pool_check', 0)
+
+        now = time.time()
+        scheduler.sync(instances.getBuildingBranches(self.db_path))
+        due = scheduler.due(now)
+        pool_due = now >= next_pool_check
+
+        if due or pool_due:
+            # one listing of every Arboretum server serves the whole cycle
+            conn = cloud.connect()
+            try:
+                servers = cloud.listServers(conn)
+            finally:
+                conn.close()
+
+        if due:
+            outcomes = instances.updateBuildingInstances(self.db_path,
+                servers, due)
+
+            for group in due:
+                outcome = outcomes.get(group)
+
+                # finished branches are dropped by the next sync
+                if outcome is None or outcome in (probes.READY, "error"):
+                    continue
+
+                # both are normal while the instance builds
+                if outcome in ("no_ip", "refused"):
+                    scheduler.schedule(group, now)
+                else:
+                    scheduler.fail(group, now)
+
+        if pool_due:
+            # keeps this process' flavor list warm for build time
+            # predictions, and in asyncio mode for creates too
+            flavors.catalogue.ensureFresh(cloud.connect)
+            pool.updatePoolInstances(cloud.connect, self.db_path, servers)
+            pool.prunePool(cloud.connect, self.db_path)
+            pool.refillPool(cloud.connect, self.db_path)
+            next_pool_check = state['next_pool_check'] = \
+                now + POOL_CHECK_INTERVAL
+
+        return min(scheduler.delay(), max(0, next_pool_check - time.time()))
+
+    @metrics.timed
+    def updateGroupsStep(self):
+        """
+        Updates the group database and prunes stale snapshots
+
+        Returns
+        -------
+        delay
+            Seconds until the next step is due, an hour
+        """
+        instances.generateGroupDatabase("daemon", db_name=self.db_path)
+        # snapshots go stale when their group's data changes
+        snapshots.pruneSnapshots(cloud.connect, self.db_path)
+
+        return 3600
+
+    def syncExpiries(self, expiry, version):
+        """
+        Brings the heap of prune times up to date with the database
+
+        Parameters
+        ----------
+        expiry
+            ExpiryHeap of prune times by group
+        version
+            Stamp of the database when the heap was last synced, or None to
+            load every branch
+
+        Returns
+        -------
+        version
+            The database's current stamp
+        """
+        changes = instances.getExpiryChanges(version, self.db_path)
+
+        if changes['full']:
+            expiry.clear()
+
+        for group, prune_time in changes['prune_times'].items():
+            expiry.set(group, prune_time)
+
+        return changes['version']
+
+    @metrics.timed
+    def pruneExpiredInstances(self, expiry):
+        """
+        Destroys the instances whose prune time has passed, concurrently.
+        Instances that couldn't be destroyed are retried after
+        PRUNE_RETRY_DELAY seconds.
+
+        Parameters
+        ----------
+        expiry
+            ExpiryHeap of prune times by group, due groups are removed
+        """
+        due = expiry.pop()
+        if not due:
+            return
+
+        for group, prune_time in due:
+            self.logger.info("{} instance has expired.\n\tPrune time: {}"
+                .format(group, time.strftime("%Y-%m-%d %H:%M:%S",
+                    time.gmtime(prune_time))))
+
+        try:
+            results = instances.destroyInstances([group for group, _ in due],
+                "daemon", db_name=self.db_path)
+        except Exception:
+            self.logger.exception("Couldn't destroy expired instances.")
+            results = {}
+
+        # groups that are gone or being destroyed elsewhere drop out of the
+        # heap at the next sync, deferring them is harmless
+        for group, _ in due:
+            if not results.get(group, {}).get('success'):
+                expiry.defer(group, time.time() + PRUNE_RETRY_DELAY)
@@ -0,0 +1,145 @@
+import os
+import sqlite3
+import sys
+import threading
+import contextlib
+
+from . import metrics
+from .constants import DATABASE_NAME, DATABASE_BUSY_TIMEOUT, \
+    STATEMENT_CACHE_SIZE
+
+def getThreadLocal():
+    """
+    Returns the class of thread-local storage. gevent's monkey-patching makes
+    threading.local local to each greenlet, which under a gevent worker would
+    open a connection for every API request, so the original is used then.
+    Greenlets of a thread take turns, and SQLite calls don't yield, so they
+    can share its connection.
+    """
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is not None and monkey.is_module_patched("threading"):
+        return monkey.get_original("threading", "local")
+
+    return threading.local
+
+# connections are reused within a thread, sqlite3 connection objects can't be
+# shared between threads and must not survive a fork
+_local = getThreadLocal()()
+
+LOCK_WAIT_SECONDS = metrics.registry.histogram(
+    "arboretum_sqlite_lock_wait_seconds",
+    "Seconds spent waiting to begin a transaction", ["mode"])
+
+def getConnection(db_name=DATABASE_NAME):
+    """
+    Returns this thread's connection to 'db_name', opening it on first use.
+
+    Connections are in autocommit mode, use transaction() for anything that
+    writes. The database is switched to WAL mode so that readers don't block
+    the writer and vice versa, and writers wait for the lock instead of
+    failing with 'database is locked'.
+
+    Parameters
+    ----------
+    db_name
+        Path of the SQLite database file
+
+    Returns
+    -------
+    db
+        An sqlite3 connection
+    """
+    path = os.path.abspath(db_name)
+
+    if getattr(_local, "pid", None) != os.getpid():
+        # inherited from a parent process, don't touch them
+        _local.connections = {}
+        _local.pid = os.getpid()
+
+    db = _local.connections.get(path)
+
+    if db is None:
+        # 'timeout' sets SQLite's busy_timeout
+        db = sqlite3.connect(path, timeout=DATABASE_BUSY_TIMEOUT,
+            isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+        db.execute('''PRAGMA journal_mode = WAL''')
+        # WAL makes NORMAL durable against application crashes, which saves
+        # an fsync per transaction
+        db.execute('''PRAGMA synchronous = NORMAL''')
+        _local.connections[path] = db
+
+    return db
+
+def closeConnection(db_name=DATABASE_NAME):
+    """
+    Closes this thread's connection to 'db_name', if there is one. Needed
+    before the database file is removed.
+
+    Parameters
+    ----------
+    db_name
+        Path of the SQLite database file
+    """
+    if getattr(_local, "pid", None) != os.getpid():
+        return
+
+    db = _local.connections.pop(os.path.abspath(db_name), None)
+    if db is not None:
+        db.close()
+
+def removeDatabase(db_name=DATABASE_NAME):
+    """
+    Deletes the database file along with its WAL and shared memory files
+
+    Parameters
+    ----------
+    db_name
+        Path of the SQLite database file
+    """
+    closeConnection(db_name)
+
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(db_name + suffix)
+        except FileNotFoundError:
+            pass
+
+@contextlib.contextmanager
+def transaction(db_name=DATABASE_NAME, immediate=True):
+    """
+    Context manager running its body in a single transaction, which is
+    committed on success and rolled back if an exception is raised. Nested
+    uses join the outer transaction.
+
+    Parameters
+    ----------
+    db_name
+        Path of the SQLite database file
+    immediate
+        Take the write lock straight away. This avoids deadlocks between two
+        readers that both try to upgrade to writers, so leave it on unless
+        the transaction only reads.
+
+    Yields
+    ------
+    cursor
+        Cursor of this thread's connection
+    """
+    db = getConnection(db_name)
+    cursor = db.cursor()
+
+    if db.in_transaction:
+        yield cursor
+        return
+
+    # BEGIN IMMEDIATE waits here while another connection holds the lock
+    mode = "immediate" if immediate else "deferred"
+    with LOCK_WAIT_SECONDS.time(mode=mode):
+        cursor.execute('''BEGIN IMMEDIATE''' if immediate else '''BEGIN''')
+    try:
+        yield cursor
+    except BaseException:
+        db.rollback()
+        raise
+    else:
+        db.commit()
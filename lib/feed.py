@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+
+from . import instances
+from .constants import FEED_POLL_INTERVAL
+
+
+class StampWatcher:
+    """
+    Watches the database stamp on behalf of any number of waiting clients
+
+    A single background thread polls the stamp, and only while somebody is
+    waiting, so the database sees one cheap query per interval per process
+    no matter how many long-poll requests are open. Under a cooperative
+    gunicorn worker (eg gevent) each waiting request is a greenlet rather
+    than a worker.
+
+    Methods
+    -------
+    wait(since, timeout)
+        Blocks until the stamp differs from 'since' or 'timeout' expires
+    """
+    def __init__(self, interval=FEED_POLL_INTERVAL, logger="api"):
+        """
+        Parameters
+        ----------
+        interval
+            Seconds between two stamp lookups
+        logger
+            Name of the logger failed lookups are reported to
+        """
+        self.interval = interval
+        self.logger = logging.getLogger(logger)
+        self.condition = threading.Condition()
+        self.stamp = None
+        self.waiters = 0
+        self.thread = None
+
+    def _poll(self):
+        """
+        Body of the polling thread, exits once nobody is waiting
+        """
+        while True:
+            with self.condition:
+                if self.waiters == 0:
+                    self.thread = None
+                    return
+
+            try:
+                stamp = str(instances.getStamp())
+            except Exception:
+                # eg the database is locked, waiters keep waiting and the
+                # next lookup may succeed
+                self.logger.exception("Couldn't read the stamp.")
+            else:
+                with self.condition:
+                    if stamp != self.stamp:
+                        self.stamp = stamp
+                        self.condition.notify_all()
+
+            time.sleep(self.interval)
+
+    def wait(self, since, timeout):
+        """
+        Blocks until the stamp differs from 'since'
+
+        Parameters
+        ----------
+        since
+            Stamp value the client already knows about
+        timeout
+            Maximum number of seconds to wait
+
+        Returns
+        -------
+        stamp
+            The new stamp, or None if it didn't change before the timeout
+        """
+        deadline = time.monotonic() + timeout
+        since = str(since)
+
+        with self.condition:
+            self.waiters += 1
+            if self.thread is None:
+                # the last known stamp may be stale if nobody was waiting
+                self.stamp = None
+                self.thread = threading.Thread(target=self._poll, daemon=True)
+                self.thread.start()
+
+            try:
+                while True:
+                    if self.stamp is not None and self.stamp != since:
+                        return self.stamp
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+
+                    self.condition.wait(remaining)
+            finally:
+                self.waiters -= 1
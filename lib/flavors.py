@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+
+from .constants import FLAVOR_CACHE_TTL, FLAVOR_PREFERENCE, \
+    FLAVOR_MIN_VCPUS, FLAVOR_DEFAULT, FLAVOR_DEFAULT_MAX_RAM
+
+LOGGER_NAME = "cli"
+
+
+class NoFlavorError(Exception):
+    """
+    Raised when no flavor has enough RAM for an instance
+    """
+    pass
+
+
+class FlavorCatalogue:
+    """
+    In-memory copy of OpenStack's flavor list, used to pick flavors locally
+
+    The list is fetched once and then refreshed in the background when it's
+    older than 'ttl', so choosing a flavor only waits on the network the very
+    first time.
+
+    Methods
+    -------
+    refresh(connect)
+        Fetches the flavor list from OpenStack
+    ensureFresh(connect, block)
+        Refreshes the list if it's missing or stale
+    choose(ram, connect, caller)
+        Picks the best flavor for an instance needing 'ram' bytes
+    peek(ram)
+        Like choose, but never fetches the list
+    """
+    def __init__(self, ttl=FLAVOR_CACHE_TTL):
+        """
+        Parameters
+        ----------
+        ttl
+            Seconds after which the flavor list is refreshed
+        """
+        self.ttl = ttl
+        self.flavors = None
+        self.fetched = 0
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def refresh(self, connect):
+        """
+        Fetches the flavor list from OpenStack
+
+        Parameters
+        ----------
+        connect
+            Function returning an OpenStack connection
+        """
+        conn = connect()
+        try:
+            flavors = [(flavor.name, flavor.ram, flavor.vcpus)
+                for flavor in conn.list_flavors()]
+        finally:
+            conn.close()
+
+        with self.lock:
+            self.flavors = flavors
+            self.fetched = time.monotonic()
+            self.refreshing = False
+
+    def isStale(self):
+        return self.flavors is None or \
+            time.monotonic() - self.fetched > self.ttl
+
+    def ensureFresh(self, connect, block=False):
+        """
+        Refreshes the flavor list if it's missing or older than the TTL. A
+        missing list is always fetched before returning, a stale one is
+        refreshed in a background thread unless 'block' is set.
+
+        Parameters
+        ----------
+        connect
+            Function returning an OpenStack connection
+        block
+            Wait for a stale list to be refreshed
+        """
+        if self.flavors is None or (block and self.isStale()):
+            self.refresh(connect)
+            return
+
+        if not self.isStale():
+            return
+
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.refresh(connect)
+            except Exception as error:
+                logging.getLogger(LOGGER_NAME).warning("Flavor refresh " \
+                    "failed, keeping the old list.\n{}: {}"
+                    .format(type(error), error))
+                with self.lock:
+                    self.refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def bestFit(self, family, ram):
+        """
+        Returns the (name, RAM in MiB, cores) of the smallest flavor of
+        'family' with at least 'ram' bytes of RAM and FLAVOR_MIN_VCPUS cores,
+        or None if there isn't one
+        """
+        ram_mb = ram / 1024**2
+        candidates = [flavor for flavor in self.flavors
+            if family in flavor[0] and flavor[1] >= ram_mb
+            and flavor[2] >= FLAVOR_MIN_VCPUS]
+
+        if not candidates:
+            return None
+
+        # best fit: least RAM, then fewest cores
+        return min(candidates, key=lambda flavor: (flavor[1], flavor[2]))
+
+    def peek(self, ram):
+        """
+        Same choice as 'choose', but only from the list already in memory
+        and without logging. Cheap enough to call once per group.
+
+        Returns
+        -------
+        flavor
+            Name of the flavor 'choose' would pick, or None if the list
+            hasn't been fetched yet or no flavor is big enough
+        """
+        if ram < FLAVOR_DEFAULT_MAX_RAM:
+            return FLAVOR_DEFAULT
+
+        if self.flavors is None:
+            return None
+
+        for family in FLAVOR_PREFERENCE:
+            best = self.bestFit(family, ram)
+            if best is not None:
+                return best[0]
+
+        return None
+
+    def choose(self, ram, connect, caller="cli"):
+        """
+        Picks the smallest flavor with at least 'ram' bytes of RAM and
+        FLAVOR_MIN_VCPUS cores, trying each family in FLAVOR_PREFERENCE in
+        turn. Instances that fit in FLAVOR_DEFAULT_MAX_RAM get FLAVOR_DEFAULT.
+
+        Parameters
+        ----------
+        ram
+            Bytes of RAM the instance needs
+        connect
+            Function returning an OpenStack connection, used if the flavor
+            list needs fetching
+        caller
+            Name of the logger to record the decision with, 'cli' logs to
+            the CLI's logger
+
+        Returns
+        -------
+        flavor
+            Name of the chosen flavor
+
+        Raises
+        ------
+        NoFlavorError
+            Raised if no flavor of any preferred family is big enough
+        """
+        logger = logging.getLogger(caller)
+
+        if ram < FLAVOR_DEFAULT_MAX_RAM:
+            logger.info("Chose flavor {} for {:,} bytes of RAM (default)."
+                .format(FLAVOR_DEFAULT, ram))
+            return FLAVOR_DEFAULT
+
+        self.ensureFresh(connect)
+
+        for family in FLAVOR_PREFERENCE:
+            best = self.bestFit(family, ram)
+
+            if best is not None:
+                name, flavor_ram, vcpus = best
+                logger.info("Chose flavor {} ({} MiB, {} cores, family {}) " \
+                    "for {:,} bytes of RAM.".format(name, flavor_ram, vcpus,
+                        family, ram))
+                return name
+
+            logger.info("No {} flavor has {:,} bytes of RAM, trying the next " \
+                "family.".format(family, ram))
+
+        raise NoFlavorError("No flavor has {:,} bytes of RAM".format(ram))
+
+# shared by everything in this process
+catalogue = FlavorCatalogue()
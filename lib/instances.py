@@ -1,59 +1,53 @@
 import logging
+import time
 import sqlite3
 import os
 import json
-import urllib.request
-import subprocess
 import re
-import random
 import math
+import hashlib
+import base64
 from pathlib import Path
-
-import jinja2
-import openstack
-
-from .constants import DATABASE_NAME
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore.exceptions
+
+from . import s3
+from . import database
+from . import migrations
+from . import flavors
+from . import cloud
+from . import pool
+from . import telemetry
+from . import snapshots
+from . import probes
+from . import metrics
+from .constants import DATABASE_NAME, INGEST_BATCH_SIZE, S3_BUCKET, \
+    S3_INDEX_KEY, CHANGELOG_LENGTH, CHANGELOG_TRIM_INTERVAL, \
+    CREATE_CONCURRENCY, DESTROY_CONCURRENCY, DESTROY_CLAIM_TIMEOUT, \
+    RAM_HEADROOM, TREESERVE_PORT, TREESERVE_PROBE_PATH
 
 LOGGER_NAME = "cli"
-RANDOM_RANGE = {'a':0, 'b':999999999999}
+# SQL expressions groups can be sorted by
+GROUP_SORT_KEYS = {'name': 'groups.group_name',
+    'ram': 'groups.ram',
+    'build_time': 'groups.time'}
+# statuses a branch can have, reported even when no branch has them
+BRANCH_STATUSES = ["building", "up", "error", "destroying"]
+
+INSTANCES = metrics.registry.gauge("arboretum_instances",
+    "Instances by status", ["status"])
+POOL_INSTANCES = metrics.registry.gauge("arboretum_pool_instances",
+    "Warm pool instances by flavor and status", ["flavor", "status"])
+GROUPS = metrics.registry.gauge("arboretum_groups",
+    "Groups in the catalogue")
 
 def initialiseDB():
     """
     Initialise the database by creating the SQL tables if not present already
+    and upgrading them to the latest schema revision
     """
-    db = sqlite3.connect(DATABASE_NAME)
-    cursor = db.cursor()
-
-    try:
-        cursor.execute('''CREATE TABLE branches(group_name TEXT PRIMARY KEY,
-            instance_ip TEXT,
-            prune_time TEXT,
-            instance_id TEXT,
-            creation_time TEXT,
-            status TEXT)
-        ''')
-    except sqlite3.OperationalError:
-        # this triggers when table "branches" already exists in the DB
-        pass
-
-    try:
-        cursor.execute('''CREATE TABLE groups(group_name TEXT PRIMARY KEY,
-            ram TEXT,
-            time TEXT)
-        ''')
-    except sqlite3.OperationalError:
-        pass
-
-    try:
-        cursor.execute('''CREATE TABLE info(name TEXT PRIMARY KEY,
-            value TEXT)''')
-        cursor.execute('''INSERT OR REPLACE INTO info
-            VALUES ("stamp", ?)''', (random.randint(**RANDOM_RANGE),))
-    except sqlite3.OperationalError:
-        pass
-
-    db.commit()
-    db.close()
+    migrations.migrate(DATABASE_NAME)
 
     logger = logging.getLogger(LOGGER_NAME)
     logger.info("Using {} as SQLite database file.".format(DATABASE_NAME))
@@ -67,33 +61,145 @@ def getStamp():
     result
         The value of the stamp, the first column in the row extracted
     """
-    db = sqlite3.connect(DATABASE_NAME)
-    cursor = db.cursor()
+    cursor = database.getConnection().execute(
+        '''SELECT value FROM info WHERE name = "stamp"''')
 
-    cursor.execute('''SELECT value FROM info WHERE name = "stamp"''')
-    result = cursor.fetchone()[0]
+    return cursor.fetchone()[0]
 
-    db.close()
+def modifyStamp(cursor, changes=()):
+    """
+    Advances the stamp, which doubles as the database's version number, by
+    one and records which groups changed in that version. This should be
+    called in the same transaction as the changes it records.
 
-    return result
+    Parameters
+    ----------
+    cursor
+        Cursor of the database, inside a transaction
+    changes
+        Iterable of (kind, group_name) tuples, where kind is 'branch' for
+        changes to an instance and 'group' for changes to the catalogue
 
-def modifyStamp(db):
+    Returns
+    -------
+    version
+        The new value of the stamp
+    """
+    cursor.execute('''UPDATE info SET value = CAST(value AS INTEGER) + 1
+        WHERE name = "stamp"''')
+    cursor.execute('''SELECT CAST(value AS INTEGER) FROM info
+        WHERE name = "stamp"''')
+    version = cursor.fetchone()[0]
+
+    cursor.executemany('''INSERT INTO changelog(version, kind, group_name)
+        VALUES(?, ?, ?)''', ((version, kind, name) for kind, name in changes))
+
+    # only the most recent versions are kept, clients that are further behind
+    # get a full snapshot instead
+    if version % CHANGELOG_TRIM_INTERVAL == 0:
+        cursor.execute('''DELETE FROM changelog WHERE version <= ?''',
+            (version - CHANGELOG_LENGTH,))
+        cursor.execute('''UPDATE info SET value = MAX(CAST(value AS INTEGER), ?)
+            WHERE name = "changelog_start"''', (version - CHANGELOG_LENGTH,))
+
+    return version
+
+def getGroupChanges(since, active_only=False):
     """
-    Change stamp to a new random integer
+    Returns the groups that changed after version 'since' of the database,
+    or every group if the change log doesn't go back that far.
 
     Parameters
     ----------
-    db
-        The SQL database
+    since
+        Stamp value the client last saw
+    active_only
+        Only consider groups that have an instance, groups whose instance
+        was destroyed are reported as removed
+
+    Returns
+    -------
+    changes
+        Dictionary with the current 'version', whether this is a 'full'
+        snapshot, the new state of changed groups under 'groups' and the
+        names of groups that no longer exist under 'removed'
     """
-    cursor = db.cursor()
+    cursor = database.getConnection().cursor()
+
+    cursor.execute('''SELECT name, CAST(value AS INTEGER) FROM info
+        WHERE name IN ("stamp", "changelog_start")''')
+    info = dict(cursor.fetchall())
+    version = info["stamp"]
+
+    try:
+        since = int(since)
+    except (TypeError, ValueError):
+        since = None
+
+    if since is None or since < info.get("changelog_start", version) \
+            or since > version:
+        return {'version': version, 'full': True, 'removed': [],
+            'groups': getGroups(True, active_only=active_only)}
+
+    cursor.execute('''SELECT DISTINCT group_name FROM changelog
+        WHERE version > ?''', (since,))
+    names = set(row[0] for row in cursor)
+
+    groups = getGroups(True, active_only=active_only, changed_since=since)
+
+    return {'version': version, 'full': False, 'groups': groups,
+        'removed': sorted(names - set(groups.keys()))}
+
+def getExpiryChanges(since, db_name=DATABASE_NAME):
+    """
+    Returns the prune times of the branches that changed after version
+    'since' of the database, or of every branch if the change log doesn't go
+    back that far. Costs a single query when nothing has changed.
+
+    Parameters
+    ----------
+    since
+        Stamp value the caller last saw, or None
+    db_name
+        Stores the name of the SQL database
+
+    Returns
+    -------
+    changes
+        Dictionary with the current 'version', whether this is a 'full'
+        snapshot and 'prune_times', mapping the groups of changed branches
+        to their prune time as an epoch time, or None if the branch is gone,
+        being destroyed or has no prune time
+    """
+    db = database.getConnection(db_name)
+
+    info = dict(db.execute('''SELECT name, CAST(value AS INTEGER) FROM info
+        WHERE name IN ("stamp", "changelog_start")''').fetchall())
+    version = info["stamp"]
+
+    if since == version:
+        return {'version': version, 'full': False, 'prune_times': {}}
+
+    # instances being destroyed are already taken care of
+    query = '''SELECT group_name, prune_time FROM branches
+        WHERE status != "destroying"'''
+
+    if since is None or since < info.get("changelog_start", version) \
+            or since > version:
+        return {'version': version, 'full': True,
+            'prune_times': dict(db.execute(query).fetchall())}
+
+    names = [row[0] for row in db.execute('''SELECT DISTINCT group_name
+        FROM changelog WHERE version > ? AND kind = "branch"''', (since,))]
 
-    cursor.execute('''INSERT OR REPLACE INTO info
-        VALUES ("stamp", ?)''', (random.randint(**RANDOM_RANGE),))
+    prune_times = dict.fromkeys(names)
+    prune_times.update(db.execute(query + ''' AND group_name IN
+        (SELECT group_name FROM changelog WHERE version > ?
+        AND kind = "branch")''', (since,)).fetchall())
 
-    db.commit()
+    return {'version': version, 'full': False, 'prune_times': prune_times}
 
-def getGroups(jsonify, active_only=False):
+def getGroups(jsonify, active_only=False, **filters):
     """
     Returns list of groups saved in the database.
 
@@ -101,6 +207,11 @@ def getGroups(jsonify, active_only=False):
     ----------
     jsonify
         Boolean which controls the return type
+    active_only
+        Only return groups that have an instance
+    filters
+        Any of the keyword arguments accepted by iterGroups, if 'limit' is
+        given only that page of groups is returned
 
     Returns
     -------
@@ -109,45 +220,324 @@ def getGroups(jsonify, active_only=False):
     tsv
         Tab-seperated table string
     """
+    if filters.get("limit") is not None:
+        entries, _ = getGroupPage(active_only=active_only, **filters)
+    else:
+        entries = iterGroups(active_only=active_only, **filters)
 
-    db = sqlite3.connect(DATABASE_NAME)
-    cursor = db.cursor()
+    if jsonify:
+        # Hug automatically converts this to JSON for the API
+        return {entry['group_name']: formatGroup(entry) for entry in entries}
+    else:
+        return "\n".join(formatGroupsTSV(entries))
+
+def formatGroup(entry):
+    """
+    Strips the internal fields from a group dictionary yielded by iterGroups
+
+    Parameters
+    ----------
+    entry
+        Group dictionary
+
+    Returns
+    -------
+    entry
+        Copy of the dictionary as exposed by the API
+    """
+    return {key: value for key, value in entry.items()
+        if not key.startswith('_')}
+
+def formatGroupsTSV(entries):
+    """
+    Formats groups as tab-separated lines, one line at a time so that large
+    catalogues can be printed as they are read.
+
+    Parameters
+    ----------
+    entries
+        Iterable of group dictionaries, as produced by iterGroups
+
+    Yields
+    ------
+    line
+        The header followed by one line per group
+    """
+    yield "Group\tRAM needed\tTime to build\tPredicted time to ready"
+    for group in entries:
+        yield "{}\t{:,} bytes\t{}\t{}".format(group['group_name'],
+            int(group['ram']), group['build_time'], group['predicted_time'])
+
+def formatMinutes(minutes):
+    """
+    Turns a number of minutes into a human readable string
+
+    Parameters
+    ----------
+    minutes
+        Integer number of minutes
+
+    Returns
+    -------
+    string
+        For example '1 minute' or '12 minutes'
+    """
+    if minutes == 1:
+        return "1 minute"
+    else:
+        return "{} minutes".format(minutes)
+
+def encodeCursor(values):
+    """
+    Encodes the sort key of the last row of a page as an opaque cursor
+
+    Parameters
+    ----------
+    values
+        List of JSON-serializable sort key values
+
+    Returns
+    -------
+    cursor
+        URL-safe string
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode("UTF-8")) \
+        .decode("ASCII")
+
+def decodeCursor(cursor):
+    """
+    Reverses encodeCursor
+
+    Parameters
+    ----------
+    cursor
+        String returned by encodeCursor
+
+    Returns
+    -------
+    values
+        List of sort key values
+
+    Raises
+    ------
+    ValueError
+        Raised if the cursor is malformed
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ASCII")))
+    except (ValueError, TypeError, UnicodeError) as error:
+        raise ValueError("Invalid cursor {}".format(cursor)) from error
+
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Invalid cursor {}".format(cursor))
+
+    return values
+
+def iterGroups(active_only=False, prefix=None, status=None, sort="name",
+        descending=False, limit=None, cursor=None, changed_since=None,
+        db_name=DATABASE_NAME):
+    """
+    Yields groups saved in the database one at a time, straight from the
+    SQLite cursor. Filtering, sorting and pagination all happen in SQL.
+
+    Parameters
+    ----------
+    active_only
+        Only yield groups that have an instance
+    prefix
+        Only yield groups whose name starts with this string
+    status
+        Only yield groups with this status, eg 'up', 'building', 'error' or 'down'
+    sort
+        One of the keys of GROUP_SORT_KEYS
+    descending
+        Reverse the sort order
+    limit
+        Maximum number of groups to yield
+    cursor
+        Cursor returned with the previous page, the groups following it
+        are yielded
+    changed_since
+        Only yield groups that have changed after this version
+    db_name
+        Stores the name of the SQL database
+
+    Yields
+    ------
+    entry
+        Dictionary describing a group and its instance, if any. The
+        '_sort_key' field is used for pagination and isn't part of the API.
+
+    Raises
+    ------
+    ValueError
+        Raised if 'sort' or 'cursor' are invalid
+    """
+    if sort not in GROUP_SORT_KEYS:
+        raise ValueError("Can't sort groups by {}, expected one of {}"
+            .format(sort, ", ".join(GROUP_SORT_KEYS.keys())))
+
+    sort_key = GROUP_SORT_KEYS[sort]
+    direction = "DESC" if descending else "ASC"
+
+    conditions = []
+    params = []
+
+    if active_only:
+        conditions.append('''branches.status IS NOT NULL''')
+
+    if status is not None:
+        conditions.append('''COALESCE(branches.status, "down") = ?''')
+        params.append(status)
+
+    if prefix:
+        # a range over the primary key, unlike LIKE, can use its index
+        conditions.append('''groups.group_name >= ?
+            AND groups.group_name < ?''')
+        params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+    if changed_since is not None:
+        conditions.append('''groups.group_name IN
+            (SELECT group_name FROM changelog WHERE version > ?)''')
+        params.append(int(changed_since))
+
+    if cursor is not None:
+        last_key, last_name = decodeCursor(cursor)
+        comparison = "<" if descending else ">"
+        conditions.append('''({0} {1} ?
+            OR ({0} = ? AND groups.group_name {1} ?))'''
+            .format(sort_key, comparison))
+        params += [last_key, last_key, last_name]
 
     # TODO: decide where/when to query the instance for its IP
-    cursor.execute('''SELECT groups.group_name, groups.ram, groups.time,
-        branches.prune_time, branches.creation_time, branches.status,
-        branches.instance_ip
+    # timestamps are formatted the way they were stored before the schema
+    # used epoch times
+    query = '''SELECT groups.group_name, groups.ram, groups.time,
+        CASE WHEN branches.group_name IS NULL THEN NULL
+            ELSE COALESCE(datetime(branches.prune_time, "unixepoch"), "never")
+            END,
+        datetime(branches.creation_time, "unixepoch"), branches.status,
+        branches.instance_ip, branches.server_status, {} AS sort_key
         FROM groups LEFT OUTER JOIN branches
-        ON groups.group_name = branches.group_name
-        ORDER BY groups.group_name''')
+        ON groups.group_name = branches.group_name'''.format(sort_key)
 
-    groups = {}
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
 
-    for group in cursor:
-        entry = {'group_name': group[0], 'ram': group[1],
-            'build_time': group[2], 'prune_time': group[3],
-            'creation_time': group[4], 'status': group[5],
-            'instance_ip': group[6]}
-        if entry['status'] == None:
-            entry['status'] = 'down'
+    query += " ORDER BY sort_key {0}, groups.group_name {0}".format(direction)
 
-        if active_only and entry['status'] != 'down':
-            groups[group[0]] = entry
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(int(limit))
 
-        if not active_only:
-            groups[group[0]] = entry
+    telemetry.estimator.refresh(db_name)
 
-    db.close()
+    cursor = database.getConnection(db_name).execute(query, params)
 
-    if jsonify:
-        # Hug automatically converts this to JSON for the API
-        return groups
+    try:
+        for group in cursor:
+            predicted = telemetry.estimator.predict(group[0], group[1])
+            entry = {'group_name': group[0], 'ram': group[1],
+                'build_time': formatMinutes(group[2]),
+                # falls back to mpistat's figure until there's history
+                'predicted_time': formatMinutes(group[2]
+                    if predicted is None else math.ceil(predicted / 60)),
+                'prune_time': group[3],
+                'creation_time': group[4], 'status': group[5],
+                'instance_ip': group[6], 'server_status': group[7],
+                '_sort_key': group[8]}
+            if entry['status'] == None:
+                entry['status'] = 'down'
+
+            yield entry
+    finally:
+        # releases the read snapshot if the caller stops early
+        cursor.close()
+
+def getGroupPage(limit, cursor=None, **filters):
+    """
+    Returns a single page of groups along with the cursor of the next page.
+
+    Parameters
+    ----------
+    limit
+        Maximum number of groups on the page
+    cursor
+        Cursor of the page to return, None for the first page
+    filters
+        Any other keyword arguments accepted by iterGroups
+
+    Returns
+    -------
+    (entries, next_cursor)
+        List of group dictionaries, and the cursor of the following page
+        or None if this is the last one
+
+    Raises
+    ------
+    ValueError
+        Raised if 'limit' is smaller than 1, or if iterGroups rejects the
+        filters
+    """
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError("Page size must be at least 1, got {}".format(limit))
+
+    entries = list(iterGroups(limit=limit + 1, cursor=cursor, **filters))
+
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        last = entries[-1]
+        next_cursor = encodeCursor([last['_sort_key'], last['group_name']])
+
+    return entries, next_cursor
+
+def collectMetrics(db_name=DATABASE_NAME):
+    """
+    Updates the gauges that mirror the database: instances by status, warm
+    pool instances by flavor and status, and the size of the catalogue
+
+    Parameters
+    ----------
+    db_name
+        Stores the name of the SQL database
+    """
+    db = database.getConnection(db_name)
+
+    counts = dict(db.execute('''SELECT status, COUNT(*) FROM branches
+        GROUP BY status''').fetchall())
+    INSTANCES.clear()
+    for status in BRANCH_STATUSES:
+        INSTANCES.set(counts.pop(status, 0), status=status)
+    for status, count in counts.items():
+        INSTANCES.set(count, status=status)
+
+    POOL_INSTANCES.clear()
+    for flavor, status, count in db.execute('''SELECT flavor, status,
+            COUNT(*) FROM pool GROUP BY flavor, status'''):
+        POOL_INSTANCES.set(count, flavor=flavor, status=status)
+
+    GROUPS.set(db.execute('''SELECT COUNT(*) FROM groups''').fetchone()[0])
+
+def report(caller, message, level=logging.INFO):
+    """
+    Prints 'message' if caller is 'cli', otherwise logs it with the logger
+    named 'caller'
+
+    Parameters
+    ----------
+    caller
+        'cli' or the name of a logger object
+    message
+        Text to print or log
+    level
+        Logging level used when the message is logged
+    """
+    if caller == "cli":
+        print(message)
     else:
-        tsv = "Group\tRAM needed\tTime to build"
-        for group in groups.values():
-            tsv += "\n{}\t{:,} bytes\t{}".format(
-                group['group_name'], int(group['ram']), group['build_time'])
-        return tsv
+        logging.getLogger(caller).log(level, message)
 
 def startInstance(group, lifetime, caller):
     """
@@ -165,176 +555,406 @@ def startInstance(group, lifetime, caller):
         Either 'cli' or the name of a logger object. If 'cli',
         output will be printed to stdout, if anything else caller will
         be used as an argument to 'logging.getLogger()'
+
+    Returns
+    -------
+    False
+        If the instance couldn't be created
     """
-    # this whole 'if caller != "cli"' thing feels ugly and redundant, but I'm
-    # not sure how else to do it
-    if caller != "cli":
-        logger = logging.getLogger(caller)
+    if not startInstances([group], lifetime, caller)[group]['success']:
+        return False
 
-    db = sqlite3.connect(DATABASE_NAME)
-    cursor = db.cursor()
+@metrics.timed
+def startInstances(groups, lifetime, caller, db_name=DATABASE_NAME,
+        accepted=None):
+    """
+    Start Treeserve instances for several groups at once. The servers are
+    created concurrently, up to CREATE_CONCURRENCY at a time, over a single
+    OpenStack connection and all of their branches are recorded in one
+    transaction.
 
-    cursor.execute('''SELECT * FROM branches WHERE group_name = ?''', (group,))
+    Parameters
+    ----------
+    groups
+        Names of the Unix groups to start instances for
+    lifetime
+        String indicating how long the instances will stay up
+        before being automatically destroyed. For example: '8 hours',
+        '25 minutes', 'forever'
+    caller
+        Either 'cli' or the name of a logger object. If 'cli',
+        output will be printed to stdout, if anything else caller will
+        be used as an argument to 'logging.getLogger()'
+    db_name
+        Stores the name of the SQL database
+    accepted
+        Epoch time the instances were asked for, recorded as the start of
+        their builds. Defaults to now.
 
-    if len(cursor.fetchall()) > 0:
-        if caller == "cli":
-            print("Can't create {} instance, one already exists!"
-                .format(group))
-        else:
-            logger.warning("Can't create {} instance, one already exists!"
-                .format(group))
-        return False
+    Returns
+    -------
+    results
+        Dictionary mapping each group to a dictionary with a boolean
+        'success' and either the new server's 'id' or an 'error' message
+    """
+    if accepted is None:
+        accepted = time.time()
 
-    cursor.execute('''SELECT group_name, ram
-        FROM groups WHERE group_name = ?''', (group,))
+    results = {}
+    requests = {}
+    rams = {}
 
-    result = cursor.fetchall()[0]
+    cursor = database.getConnection(db_name).cursor()
 
-    if len(result) == 0:
-        if caller == "cli":
-            print("Can't create {} instance, group not recognised!"
-                .format(group))
-        else:
-            logger.warning("Can't create {} instance, group not recognised!"
-                .format(group))
-        return False
+    # duplicates are dropped, keeping the order the groups were given in
+    for group in dict.fromkeys(groups):
+        cursor.execute('''SELECT 1 FROM branches WHERE group_name = ?''',
+            (group,))
 
+        if cursor.fetchone() is not None:
+            results[group] = {'success': False,
+                'error': "Can't create {} instance, one already exists!"
+                    .format(group)}
+            continue
 
-    conn = openstack.connect(cloud='openstack')
+        cursor.execute('''SELECT group_name, ram
+            FROM groups WHERE group_name = ?''', (group,))
 
-    name = 'arboretum-{}-branch'.format(group)
+        result = cursor.fetchone()
 
-    gib = 1024**3
-    mib = 1024**2
+        if result is None:
+            results[group] = {'success': False,
+                'error': "Can't create {} instance, group not recognised!"
+                    .format(group)}
+            continue
 
-    # extra GiB is added on top as headroom for system processes
-    ram = int(result[1]) + gib
+        rams[group] = result[1]
+        ram = result[1] + RAM_HEADROOM
 
-    # Defaults to using m1.small for groups requiring less than 14GiB of RAM
-    # that way every instance has at least two cores
-    if ram < 14*gib:
-        flavor = 'm1.small'
-    else:
-        ram_mb = ram / mib
-        # include="m" stops high core count o2 flavours from being used
         try:
-            flavor = conn.get_flavor_by_ram(ram_mb, include="m").name
-        except openstack.exceptions.SDKException:
-            # SDKException will be thrown when no matching flavour is found,
-            # then we try to get an s2 flavour instead
-            flavor = conn.get_flavor_by_ram(ram_mb, include="s2").name
-
-    jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(''))
-    template = jinja_env.get_template('user.sh')
-
-    userdata = template.render(group_name = group)
-
-    info = conn.create_server(name=name,
-        image='hgi-arboretum-image',
-        key_name='mercury',
-        flavor=flavor,
-        network='cloudforms_network',
-        security_groups=['default', 'cloudforms_web_in',
-            'cloudforms_ssh_in', 'cloudforms_local_in'],
-        userdata=userdata)
-    conn.close()
-
-    # OpenStack takes its time allocating the IP, so info.private_v4 will most
-    # likely be None here. It will be looked up again when necessary and
-    # saved in the database.
-    if lifetime == "forever":
-        cursor.execute('''INSERT INTO branches(group_name, instance_ip,
-            prune_time, instance_id, creation_time, status)
-            VALUES(?, ?, ?, ?, datetime("now"), ?)''',
-            (group, info.private_v4, "never", info.id, "building"))
-    else:
-        cursor.execute('''INSERT INTO branches(group_name, instance_ip,
-            prune_time, instance_id, creation_time, status)
-            VALUES(?, ?, datetime("now", ?), ?, datetime("now"), ?)''',
-            (group, info.private_v4, lifetime, info.id, "building"))
+            requests[group] = flavors.catalogue.choose(ram, cloud.connect,
+                LOGGER_NAME if caller == "cli" else caller)
+        except flavors.NoFlavorError:
+            results[group] = {'success': False,
+                'error': "Can't create {} instance, no flavor has enough " \
+                    "RAM!".format(group)}
+
+    servers = {}
+    # instances taken from the warm pool, which already have an IP
+    claimed = {}
+    # snapshot images that groups can be booted from instead of rebuilt
+    images = {}
+    for group in requests:
+        image = snapshots.findSnapshot(group, db_name)
+        if image is not None:
+            images[group] = image
+    # build phases reached so far by each group's instance
+    events = {group: {'accepted': accepted} for group in requests}
+
+    if requests:
+        conn = cloud.connect()
+
+        # a snapshot beats the pool, pooled instances still have to build
+        # the group's tree
+        for group in [group for group in requests if group not in images]:
+            instance = pool.claimInstance(requests[group], db_name)
+
+            if instance is None:
+                continue
 
-    modifyStamp(db)
+            try:
+                pool.assignInstance(conn, instance[0], group)
+            except Exception as error:
+                # the instance is in an unknown state, so it's dropped and
+                # the group gets a fresh one instead
+                report(caller, "Couldn't assign pooled instance {} to {}, " \
+                    "creating a new one.\n{}: {}".format(instance[0], group,
+                        type(error), error), logging.WARNING)
+                try:
+                    conn.delete_server(instance[0])
+                except Exception as error:
+                    # the rest of the batch still goes ahead, or the pooled
+                    # instances already claimed for it would leak
+                    report(caller, "Couldn't delete pooled instance {}.\n" \
+                        "{}: {}".format(instance[0], type(error), error),
+                        logging.WARNING)
+                continue
 
-    db.commit()
-    db.close()
+            claimed[group] = instance
+            events[group]['claimed'] = time.time()
+
+        def create(group):
+            info = cloud.createServer(conn,
+                'arboretum-{}-branch'.format(group), requests[group],
+                cloud.renderUserdata(group_name = group,
+                    restored = group in images),
+                image=images.get(group))
+            return info, time.time()
+
+        cold = [group for group in requests if group not in claimed]
+
+        if cold:
+            with ThreadPoolExecutor(max_workers=min(CREATE_CONCURRENCY,
+                    len(cold))) as executor:
+                futures = {group: executor.submit(create, group)
+                    for group in cold}
+
+                for group, future in futures.items():
+                    try:
+                        phase = "restored" if group in images else "created"
+                        info, events[group][phase] = future.result()
+                        servers[group] = (info.id, info.private_v4)
+                    except Exception as error:
+                        # a failure only affects the group it happened for
+                        results[group] = {'success': False,
+                            'error': "Can't create {} instance, OpenStack " \
+                                "returned an error: {}".format(group, error)}
+
+        conn.close()
+
+    servers.update(claimed)
+
+    if requests:
+        with database.transaction(db_name) as cursor:
+            pool.recordDemand(cursor, requests.values())
+
+    if servers:
+        # OpenStack takes its time allocating the IP, so private_v4 will most
+        # likely be None here. It will be looked up again when necessary and
+        # saved in the database.
+        # groups whose branch was recorded by a concurrent create since
+        # they were checked above
+        lost = {}
+
+        with database.transaction(db_name) as cursor:
+            for group, (instance_id, instance_ip) in servers.items():
+                # a NULL prune time means the instance is never pruned
+                cursor.execute('''INSERT OR IGNORE INTO branches(group_name,
+                    instance_ip, prune_time, instance_id, creation_time,
+                    status) VALUES(?, ?,
+                    CASE WHEN ? = "forever" THEN NULL
+                        ELSE CAST(strftime("%s", "now", ?) AS INTEGER) END,
+                    ?, CAST(strftime("%s", "now") AS INTEGER), ?)''',
+                    (group, instance_ip, lifetime, lifetime, instance_id,
+                    "building"))
+
+                if cursor.rowcount == 0:
+                    lost[group] = instance_id
+                    continue
+
+                telemetry.recordBuild(cursor, instance_id, group,
+                    requests[group], rams[group], group in claimed,
+                    events[group])
+
+            modifyStamp(cursor, [("branch", group) for group in servers
+                if group not in lost])
+
+        for group, (instance_id, instance_ip) in servers.items():
+            if group in lost:
+                results[group] = {'success': False,
+                    'error': "Can't create {} instance, one already exists!"
+                        .format(group)}
+            else:
+                results[group] = {'success': True, 'id': instance_id}
+
+        if lost:
+            # nothing refers to these servers, so they'd never be destroyed
+            conn = cloud.connect()
+            for group, instance_id in lost.items():
+                try:
+                    conn.delete_server(instance_id)
+                except Exception as error:
+                    report(caller, "Couldn't delete {}'s duplicate " \
+                        "instance {}.\n{}: {}".format(group, instance_id,
+                            type(error), error), logging.WARNING)
+            conn.close()
+
+    for group in dict.fromkeys(groups):
+        if results[group]['success']:
+            if caller == "cli":
+                report(caller, "Created new Treeserve instance:\nID: {}\n" \
+                    "Group: {}\nLifetime: {}".format(results[group]['id'],
+                        group, lifetime))
+            else:
+                report(caller, "Created new Treeserve instance:\n\tID: {}\n\t" \
+                    "Group: {}\n\tLifetime: {}".format(results[group]['id'],
+                        group, lifetime))
+        else:
+            report(caller, results[group]['error'], logging.WARNING)
 
-    if caller == "cli":
-        print("Created new Treeserve instance:\nID: {}\nGroup: {}\n" \
-            "Lifetime: {}".format(info.id, group, lifetime))
-    else:
-        logger.info("Created new Treeserve instance:\n\tID: {}\n\t" \
-            "Group: {}\n\tLifetime: {}".format(info.id, group, lifetime))
+    return {group: results[group] for group in dict.fromkeys(groups)}
 
-def updateBuildingInstances(db_name=DATABASE_NAME):
+def getBuildingBranches(db_name=DATABASE_NAME):
     """
-    Updates the building instances
+    Works out when each building instance is expected to be ready, from its
+    creation time and the predicted build time of its group
 
     Parameters
     ----------
     db_name
         Stores the name of the SQL database
 
-    Raises
-    ------
-    URLError
-        Raised if there is an error with the URL used
+    Returns
+    -------
+    expected
+        Dictionary mapping the groups of building branches to epoch times
     """
-    # will probably only ever be called by the daemon
-    logger = logging.getLogger("daemon")
-    db = sqlite3.connect(db_name)
-    cursor = db.cursor()
-
-    cursor.execute('''SELECT group_name, instance_ip FROM branches
-        WHERE status = "building"''')
-
-    conn = openstack.connect(cloud='openstack')
-
-    for branch in cursor:
-        # try to find IP address if not recorded already
-        if branch[1] == "":
-            logger.info("Try to find IP for {}...".format(branch[0]))
-            info = conn.get_server("arboretum-{}-branch"
-                .format(branch[0]))
-
-            if info is None:
-                logger.info("Instance not ready.")
-                continue
-
-            if info.private_v4 == "":
-                logger.info("No IP assigned yet.")
-                continue
-
-            cursor.execute('''UPDATE branches
-                SET instance_ip = ?
-                WHERE group_name = ?''', (info.private_v4, branch[0]))
-            db.commit()
-            logger.info("IP found successfully.")
-
-        # use IP address to ping instance and find whether Treeserve is done
-        if branch[1] != "":
-            logger.info("Checking if {} is ready...".format(branch[0]))
-            try:
-                urllib.request.urlopen(
-                    "http://{}:8080/api/v2".format(branch[1]))
+    telemetry.estimator.refresh(db_name)
+
+    expected = {}
+    for group, creation_time, ram, minutes in database.getConnection(db_name) \
+            .execute('''SELECT branches.group_name, branches.creation_time,
+            groups.ram, groups.time
+            FROM branches LEFT OUTER JOIN groups
+            ON groups.group_name = branches.group_name
+            WHERE branches.status = "building"'''):
+        predicted = None
+        if ram is not None:
+            predicted = telemetry.estimator.predict(group, ram)
+        if predicted is None:
+            predicted = (minutes or 0) * 60
+
+        expected[group] = (creation_time or 0) + predicted
+
+    return expected
+
+@metrics.timed
+def updateBuildingInstances(db_name=DATABASE_NAME, servers=None, groups=None):
+    """
+    Updates the branches from a single listing of Arboretum's servers:
+    records each server's status, flags branches whose server failed, and
+    saves newly assigned IPs. Then probes the building instances that have
+    an IP concurrently and marks the ones where Treeserve answers as up.
+    Failed probes are logged, never raised.
 
-                # if there's no error, Treeserve is ready
-                cursor.execute('''UPDATE branches
-                    SET status = "up"
-                    WHERE group_name = ?''', (branch[0],))
+    Parameters
+    ----------
+    db_name
+        Stores the name of the SQL database
+    servers
+        Servers as returned by cloud.listServers, listed here if not given
+    groups
+        Only look up IPs and probe the building branches of these groups,
+        defaults to all of them
 
-                modifyStamp(db)
-                db.commit()
-                logger.info("Ready.")
+    Returns
+    -------
+    outcomes
+        Dictionary mapping each building branch that was checked to the
+        outcome of its probe (see lib/probes.py), 'no_ip' if it has no IP
+        yet or 'error' if its server failed
+    """
+    # will probably only ever be called by the daemon
+    logger = logging.getLogger("daemon")
 
-            except urllib.error.URLError as e:
-                if str(e) == "<urlopen error [Errno 111] Connection refused>":
-                    logger.info("Treeserve not finished.")
-                else:
-                    raise e
+    branches = database.getConnection(db_name).execute(
+        '''SELECT group_name, instance_ip, instance_id, status, server_status
+        FROM branches''').fetchall()
 
-    conn.close()
-    db.close()
+    if not branches:
+        return {}
 
+    if servers is None:
+        conn = cloud.connect()
+        try:
+            servers = cloud.listServers(conn)
+        finally:
+            conn.close()
+
+    outcomes = {}
+    statuses = []
+    failed = []
+    activated = []
+    found = {}
+    # IPs of the building instances that can be probed
+    ips = {}
+    instance_ids = {}
+
+    for group, instance_ip, instance_id, status, server_status in branches:
+        instance_ids[group] = instance_id
+        server = servers.get(instance_id)
+
+        if server is not None and server.status != server_status:
+            statuses.append((server.status, group))
+            if server.status == "ACTIVE":
+                activated.append(instance_id)
+
+        if status != "building" or \
+                (groups is not None and group not in groups):
+            continue
+
+        if server is not None and server.status == "ERROR":
+            failed.append(group)
+            continue
+
+        # a server that was just created may not be listed yet
+        if not instance_ip and server is not None and server.private_v4:
+            instance_ip = found[group] = server.private_v4
+
+        if instance_ip:
+            ips[group] = instance_ip
+        else:
+            outcomes[group] = "no_ip"
+
+    if statuses or failed or found:
+        with database.transaction(db_name) as cursor:
+            cursor.executemany('''UPDATE branches SET server_status = ?
+                WHERE group_name = ?''', statuses)
+            cursor.executemany('''UPDATE branches SET status = "error"
+                WHERE group_name = ?''', [(group,) for group in failed])
+            cursor.executemany('''UPDATE branches SET instance_ip = ?
+                WHERE group_name = ?''', [(ip, group)
+                    for group, ip in found.items()])
+
+            for instance_id in activated:
+                telemetry.recordEvent(cursor, instance_id, "active")
+            for group in found:
+                telemetry.recordEvent(cursor, instance_ids[group],
+                    "ip_assigned")
+
+            modifyStamp(cursor, [("branch", group) for group in
+                dict.fromkeys([group for _, group in statuses] + failed +
+                    list(found))])
+
+    for group in failed:
+        logger.warning("{} instance failed in OpenStack, it won't be " \
+            "polled any more.".format(group))
+    for group, ip in found.items():
+        logger.info("Found IP {} for {}.".format(ip, group))
+
+    outcomes.update((group, "error") for group in failed)
+
+    # use IP address to ping instance and find whether Treeserve is done
+    probed = probes.probeAll(ips, TREESERVE_PORT, TREESERVE_PROBE_PATH)
+    outcomes.update(probed)
+
+    ready = [group for group, outcome in probed.items()
+        if outcome == probes.READY]
+
+    for group, outcome in probed.items():
+        if outcome == "refused":
+            logger.info("{}: Treeserve not finished.".format(group))
+        elif outcome != probes.READY:
+            logger.warning("{}: Treeserve probe failed ({}).".format(group,
+                outcome))
+
+    if ready:
+        with database.transaction(db_name) as cursor:
+            cursor.executemany('''UPDATE branches
+                SET status = "up"
+                WHERE group_name = ?''', [(group,) for group in ready])
+
+            for group in ready:
+                telemetry.recordEvent(cursor, instance_ids[group], "ready")
+
+            modifyStamp(cursor, [("branch", group) for group in ready])
+
+        for group in ready:
+            logger.info("{} ready.".format(group))
+
+    return outcomes
+
+@metrics.timed
 def generateGroupDatabase(caller, db_name=DATABASE_NAME):
     """
     Fetches mpistat chunks from S3 and creates a catalogue of
@@ -349,10 +969,16 @@ def generateGroupDatabase(caller, db_name=DATABASE_NAME):
     db_name
         Stores the name of the SQL database
 
+    Returns
+    -------
+    changed
+        True if the catalogue was modified, False if the index was unchanged
+        or identical to the stored catalogue
+
     Raises
     ------
-    CalledProcessError
-        Raised if a a process returns any exit value other than 0
+    botocore.exceptions.ClientError
+        Raised if the index can't be fetched from S3 and caller is 'cli'
     """
     if caller != "cli":
         logger = logging.getLogger(caller)
@@ -360,57 +986,288 @@ def generateGroupDatabase(caller, db_name=DATABASE_NAME):
     else:
         print("Updating group database...")
 
+    cursor = database.getConnection(db_name).cursor()
+
+    cursor.execute('''SELECT name, value FROM info
+        WHERE name IN ("index_etag", "index_hash")''')
+    previous = dict(cursor.fetchall())
+
+    try:
+        lines, index_etag = s3.streamObject(S3_BUCKET, S3_INDEX_KEY,
+            etag=previous.get("index_etag"))
+    except s3.NotModified:
+        if caller != "cli":
+            logger.info("Index unchanged since last update, skipping.")
+        else:
+            print("Index unchanged since last update, skipping.")
+        return False
+    except (botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError) as error:
+        if caller != "cli":
+            logger.critical("Index fetch failed!\n{}: {}"
+                .format(type(error), error))
+        else:
+            print("Index fetch failed!")
+            raise error
+        return
+
+    if caller != "cli":
+        logger.info("Streaming index...")
+
+    digest = hashlib.sha256()
+
+    # rows are streamed into a staging table first, it's private to this
+    # connection and the live catalogue isn't locked while the index is being
+    # downloaded
+    cursor.execute('''DROP TABLE IF EXISTS temp.groups_new''')
+    cursor.execute('''CREATE TEMP TABLE groups_new(
+        group_name TEXT PRIMARY KEY,
+        ram INTEGER NOT NULL,
+        time INTEGER NOT NULL,
+        data_hash TEXT NOT NULL)
+    ''')
+
     try:
-        output = subprocess.run(['s3cmd', 'get', '-f',
-            's3://branchserve/mpistat/index.txt', '/tmp/index.txt'],
-            check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as error:
+        index = hashLines(lines, digest)
+        # skip the header
+        next(index, None)
+        for batch in batchIndex(index):
+            cursor.executemany('''INSERT OR REPLACE INTO
+                groups_new(group_name, ram, time, data_hash)
+                VALUES(?,?,?,?)''', batch)
+    except (botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError) as error:
+        cursor.execute('''DROP TABLE temp.groups_new''')
         if caller != "cli":
-            logger.critical("s3cmd call failed!\n{}: {}"
+            logger.critical("Index download interrupted!\n{}: {}"
                 .format(type(error), error))
         else:
-            print("s3cmd call failed!")
+            print("Index download interrupted!")
             raise error
         return
+    except Exception:
+        cursor.execute('''DROP TABLE temp.groups_new''')
+        raise
 
     if caller != "cli":
         logger.info("Index fetch complete.")
-        logger.debug("s3cmd get output: {}"
-            .format(output.stdout.decode("UTF-8")))
     else:
         print("Index fetch complete.")
 
-    db = sqlite3.connect(db_name)
-    cursor = db.cursor()
+    index_hash = digest.hexdigest()
 
-    # existing groups aren't relevant, for simplicity's sake we can just
-    # nuke the groups table and populate it from scratch
-    cursor.execute('''DELETE FROM groups''')
-    if caller != "cli":
-        logger.info("Opening file...")
-    with open("/tmp/index.txt", "rt") as index:
-        # skip the header
-        index.readline()
-        for line in index:
-            _name, _time, _ram = line.split()
-
-            _time = math.ceil(float(_time)/60)
-            if _time == 1:
-                _human_time = "1 minute"
+    try:
+        with database.transaction(db_name) as cursor:
+            if previous.get("index_hash") == index_hash:
+                # the object was rewritten without its contents changing
+                inserted, removed, changed = [], [], []
             else:
-                _human_time = "{} minutes".format(_time)
+                inserted, removed, changed = applyGroupDiff(cursor)
 
-            cursor.execute('''INSERT INTO groups(group_name, ram, time)
-                VALUES(?,?,?)''', (_name, _ram, _human_time))
+            cursor.executemany('''INSERT OR REPLACE INTO info
+                VALUES (?, ?)''', (("index_hash", index_hash),
+                    ("index_etag", index_etag)))
 
-            db.commit()
+            if inserted or removed or changed:
+                modifyStamp(cursor, [("group", name) for name in
+                    inserted + removed + changed])
+    finally:
+        cursor.execute('''DROP TABLE temp.groups_new''')
 
     if caller != "cli":
-        logger.info("Group database generated successfully.")
+        logger.info("Group database generated successfully. {} added, {} " \
+            "removed, {} changed.".format(len(inserted), len(removed),
+                len(changed)))
     else:
-        print("Group database generated successfully.")
+        print("Group database generated successfully. {} added, {} " \
+            "removed, {} changed.".format(len(inserted), len(removed),
+                len(changed)))
 
-    db.close()
+    return bool(inserted or removed or changed)
+
+def hashLines(lines, digest):
+    """
+    Passes lines through unchanged while feeding them into a hash, so the
+    index can be fingerprinted in the same pass that parses it.
+
+    Parameters
+    ----------
+    lines
+        Iterable of index lines without line endings
+    digest
+        A hashlib object to update
+
+    Yields
+    ------
+    line
+        Each line of 'lines'
+    """
+    for line in lines:
+        digest.update(line.encode("UTF-8"))
+        digest.update(b"\n")
+        yield line
+
+def applyGroupDiff(cursor):
+    """
+    Applies the differences between the staged catalogue in 'groups_new' and
+    the live 'groups' table, touching only rows that were added, removed or
+    changed. Must be called inside a transaction.
+
+    Parameters
+    ----------
+    cursor
+        Cursor of the database holding both tables
+
+    Returns
+    -------
+    (inserted, removed, changed)
+        Lists of the names of the groups in each category
+    """
+    cursor.execute('''SELECT group_name FROM groups WHERE group_name NOT IN
+        (SELECT group_name FROM groups_new)''')
+    removed = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute('''SELECT groups_new.group_name FROM groups_new
+        JOIN groups ON groups_new.group_name = groups.group_name
+        WHERE groups_new.ram IS NOT groups.ram
+            OR groups_new.time IS NOT groups.time
+            OR groups_new.data_hash IS NOT groups.data_hash''')
+    changed = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute('''SELECT group_name FROM groups_new WHERE group_name
+        NOT IN (SELECT group_name FROM groups)''')
+    inserted = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute('''DELETE FROM groups WHERE group_name NOT IN
+        (SELECT group_name FROM groups_new)''')
+
+    cursor.execute('''UPDATE groups SET
+        ram = (SELECT ram FROM groups_new
+            WHERE groups_new.group_name = groups.group_name),
+        time = (SELECT time FROM groups_new
+            WHERE groups_new.group_name = groups.group_name),
+        data_hash = (SELECT data_hash FROM groups_new
+            WHERE groups_new.group_name = groups.group_name)
+        WHERE EXISTS (SELECT 1 FROM groups_new
+            WHERE groups_new.group_name = groups.group_name
+            AND (groups_new.ram IS NOT groups.ram
+                OR groups_new.time IS NOT groups.time
+                OR groups_new.data_hash IS NOT groups.data_hash))''')
+
+    cursor.execute('''INSERT INTO groups(group_name, ram, time, data_hash)
+        SELECT group_name, ram, time, data_hash FROM groups_new
+        WHERE group_name NOT IN (SELECT group_name FROM groups)''')
+
+    return inserted, removed, changed
+
+def parseIndexLine(line):
+    """
+    Parses a single line of the mpistat index into a groups table row.
+
+    Parameters
+    ----------
+    line
+        Whitespace separated line of the form '<group> <seconds> <bytes>'
+
+    Returns
+    -------
+    row
+        Tuple of (group_name, ram in bytes, build time in whole minutes,
+        hash of the line) ready to be inserted. The hash changes whenever
+        mpistat's figures for the group do, snapshots are matched on it.
+    """
+    _name, _time, _ram = line.split()
+    _hash = hashlib.sha256(" ".join((_name, _time, _ram)).encode("UTF-8"))
+
+    return (_name, int(_ram), math.ceil(float(_time)/60), _hash.hexdigest())
+
+def batchIndex(lines, batch_size=INGEST_BATCH_SIZE):
+    """
+    Groups parsed index lines into lists of at most 'batch_size' rows, so
+    they can be loaded with a single executemany call each.
+
+    Parameters
+    ----------
+    lines
+        Iterable of mpistat index lines, without the header
+    batch_size
+        Maximum number of rows in a batch
+
+    Yields
+    ------
+    batch
+        List of (group_name, ram, time, data_hash) tuples, see
+        parseIndexLine
+    """
+    batch = []
+    for line in lines:
+        if line.strip() == "":
+            continue
+
+        batch.append(parseIndexLine(line))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def selectBranches(groups=None, pattern=None, expired_before=None,
+        db_name=DATABASE_NAME):
+    """
+    Finds the branches matching every given criterion
+
+    Parameters
+    ----------
+    groups
+        Names of Unix groups
+    pattern
+        Glob the group names have to match, eg 'hgi*'
+    expired_before
+        Only branches whose prune time is at or before this time, either
+        'now' or a UTC date and time like '2019-06-01 12:00:00'
+    db_name
+        Stores the name of the SQL database
+
+    Returns
+    -------
+    groups
+        Sorted list of the groups of matching branches
+
+    Raises
+    ------
+    ValueError
+        If expired_before isn't a valid time
+    """
+    conditions = []
+    values = []
+
+    if pattern is not None:
+        conditions.append('''group_name GLOB ?''')
+        values.append(pattern)
+    if expired_before is not None:
+        before = database.getConnection(db_name).execute('''SELECT
+            CAST(strftime("%s", ?) AS INTEGER)''',
+            (expired_before,)).fetchone()[0]
+        if before is None:
+            raise ValueError("{} is not a valid time, use 'now' or " \
+                "'YYYY-MM-DD HH:MM:SS'.".format(expired_before))
+
+        conditions.append('''prune_time <= ?''')
+        values.append(before)
+
+    query = '''SELECT group_name FROM branches'''
+    if conditions:
+        query += ''' WHERE ''' + ''' AND '''.join(conditions)
+
+    matches = [row[0] for row in database.getConnection(db_name)
+        .execute(query + ''' ORDER BY group_name''', values)]
+
+    if groups is not None:
+        groups = set(groups)
+        matches = [group for group in matches if group in groups]
+
+    return matches
 
 def destroyInstance(group, caller, db_name=DATABASE_NAME):
     """
@@ -424,53 +1281,225 @@ def destroyInstance(group, caller, db_name=DATABASE_NAME):
     caller
         If 'cli', the program prints to stdout. If anything else,
         it's passed to logging.getLogger to fetch a logger object
+
+    Returns
+    -------
+    False
+        If the group has no instance, it's already being destroyed or
+        OpenStack returned an error
     """
-    if caller != "cli":
-        logger = logging.getLogger(caller)
+    if not destroyInstances([group], caller, db_name)[group]['success']:
+        return False
 
-    db = sqlite3.connect(db_name)
-    cursor = db.cursor()
+@metrics.timed
+def destroyInstances(groups, caller, db_name=DATABASE_NAME):
+    """
+    Destroys the instances of several groups at once. The servers are
+    deleted concurrently, up to DESTROY_CONCURRENCY at a time, over a single
+    OpenStack connection, and the branches are updated in one transaction
+    before and one after.
+
+    The branches are marked as 'destroying' first, so that an instance isn't
+    destroyed twice at the same time, eg by the daemon and the CLI. A branch
+    whose server couldn't be deleted goes back to its previous status. A
+    branch claimed more than DESTROY_CLAIM_TIMEOUT seconds ago by a destroy
+    that never finished is claimed again. An
+    instance that's being snapshotted is kept, still 'destroying', until
+    finishDestroys deletes it once the snapshot is done.
 
-    cursor.execute('''SELECT group_name, instance_id FROM branches WHERE
-        group_name = ?''', (group,))
+    Parameters
+    ----------
+    groups
+        Names of the Unix groups whose instances to destroy
+    caller
+        Either 'cli' or the name of a logger object. If 'cli',
+        output will be printed to stdout, if anything else caller will
+        be used as an argument to 'logging.getLogger()'
+    db_name
+        Stores the name of the SQL database
 
-    result = cursor.fetchall()
+    Returns
+    -------
+    results
+        Dictionary mapping each group to a dictionary with a boolean
+        'success' and an 'error' message if it failed
+    """
+    groups = list(dict.fromkeys(groups))
+    wanted = set(groups)
+    results = {}
+
+    with database.transaction(db_name) as cursor:
+        # claims left by destroys that never finished, except the ones
+        # waiting for a snapshot
+        cursor.execute('''SELECT group_name, instance_id, status,
+            status = "destroying"
+            AND COALESCE(destroy_time, 0) <
+                CAST(strftime("%s", "now") AS INTEGER) - ?
+            AND group_name NOT IN (SELECT group_name FROM pending_snapshots)
+            FROM branches''', (DESTROY_CLAIM_TIMEOUT,))
+        rows = [row for row in cursor.fetchall() if row[0] in wanted]
+        branches = {group: (instance_id, status)
+            for group, instance_id, status, _ in rows}
+        stale = {group for group, _, _, stale in rows if stale}
+
+        claimed = [group for group in groups if group in branches and
+            (branches[group][1] != "destroying" or group in stale)]
+
+        if claimed:
+            cursor.executemany('''UPDATE branches SET status = "destroying",
+                destroy_time = CAST(strftime("%s", "now") AS INTEGER)
+                WHERE group_name = ?''', [(group,) for group in claimed])
+            modifyStamp(cursor, [("branch", group) for group in claimed])
+
+    for group in groups:
+        if group not in branches:
+            results[group] = {'success': False,
+                'error': "{} instance not found in the database. The " \
+                    "instance was either already destroyed or never " \
+                    "created in the first place.".format(group)}
+        elif group not in claimed:
+            results[group] = {'success': False,
+                'error': "{} instance is already being destroyed."
+                    .format(group)}
+
+    deleted = []
+    failed = []
+
+    if claimed:
+        conn = cloud.connect()
+        logger_name = LOGGER_NAME if caller == "cli" else caller
+
+        def destroy(group):
+            server_id, status = branches[group]
+
+            # only a finished tree is worth keeping
+            if status == "up" and snapshots.startSnapshot(conn, group,
+                    server_id, logger_name, db_name):
+                return "snapshotting"
+
+            return "destroyed" if conn.delete_server(server_id) \
+                else "missing"
+
+        with ThreadPoolExecutor(max_workers=min(DESTROY_CONCURRENCY,
+                len(claimed))) as executor:
+            futures = {group: executor.submit(destroy, group)
+                for group in claimed}
+
+            for group, future in futures.items():
+                try:
+                    outcome = future.result()
+                except Exception as error:
+                    failed.append(group)
+                    results[group] = {'success': False,
+                        'error': "Can't destroy {} instance, OpenStack " \
+                            "returned an error: {}".format(group, error)}
+                    continue
+
+                results[group] = {'success': True}
+
+                if outcome == "snapshotting":
+                    report(caller, "{} instance will be destroyed once its " \
+                        "snapshot is saved.".format(group), logging.WARNING)
+                    continue
+
+                deleted.append(group)
+
+                if outcome == "destroyed":
+                    report(caller, "{} instance destroyed.".format(group),
+                        logging.WARNING)
+                else:
+                    report(caller, "Can't destroy {} instance, it doesn't " \
+                        "exist.".format(group), logging.WARNING)
+
+        conn.close()
+
+        with database.transaction(db_name) as cursor:
+            cursor.executemany('''DELETE FROM branches WHERE group_name = ?''',
+                [(group,) for group in deleted])
+            # a failed takeover is taken over again after another timeout
+            cursor.executemany('''UPDATE branches SET status = ?,
+                destroy_time = CASE WHEN ? = "destroying" THEN destroy_time
+                    ELSE NULL END
+                WHERE group_name = ? AND status = "destroying"''',
+                [(branches[group][1], branches[group][1], group)
+                    for group in failed])
+            modifyStamp(cursor, [("branch", group) for group in claimed])
+
+    for group in groups:
+        if not results[group]['success']:
+            report(caller, results[group]['error'], logging.WARNING)
+
+    return {group: results[group] for group in groups}
+
+def getStaleDestroys(db_name=DATABASE_NAME):
+    """
+    Finds the branches left 'destroying' for more than DESTROY_CLAIM_TIMEOUT
+    seconds by destroys that never finished, eg because their process died
+    or the daemon was stopped, other than the ones waiting for a snapshot
 
-    if len(result) == 0:
-        if caller == "cli":
-            print("{} instance not found in the database. The instance " \
-                "was either already destroyed or never created in the " \
-                "first place.".format(group))
-        else:
-            logger.warning("{} instance not found in the database."
-                .format(group))
+    Parameters
+    ----------
+    db_name
+        Stores the name of the SQL database
 
-        return False
+    Returns
+    -------
+    groups
+        Sorted list of the groups of those branches
+    """
+    return [row[0] for row in database.getConnection(db_name).execute('''
+        SELECT group_name FROM branches WHERE status = "destroying"
+        AND COALESCE(destroy_time, 0) <
+            CAST(strftime("%s", "now") AS INTEGER) - ?
+        AND group_name NOT IN (SELECT group_name FROM pending_snapshots)
+        ORDER BY group_name''', (DESTROY_CLAIM_TIMEOUT,))]
+
+@metrics.timed
+def finishDestroys(caller, db_name=DATABASE_NAME):
+    """
+    Deletes the instances that were kept for a snapshot, once OpenStack has
+    finished or given up on it
 
-    server_id = result[0][1]
+    Parameters
+    ----------
+    caller
+        Either 'cli' or the name of a logger object. If 'cli',
+        output will be printed to stdout, if anything else caller will
+        be used as an argument to 'logging.getLogger()'
+    db_name
+        Stores the name of the SQL database
+    """
+    if database.getConnection(db_name).execute('''SELECT 1
+            FROM pending_snapshots LIMIT 1''').fetchone() is None:
+        return
 
-    conn = openstack.connect(cloud='openstack')
-    success = conn.delete_server(server_id)
-    conn.close()
+    conn = cloud.connect()
+    deleted = []
 
-    if not success:
-        if caller == "cli":
-            print("Can't destroy {} instance, it doesn't exist."
-                .format(group))
-        else:
-            logger.warning("Can't destroy {} instance, it doesn't exist."
-                .format(group))
-    else:
-        if caller == "cli":
-            print("{} instance destroyed.".format(group))
-        else:
-            logger.warning("{} instance destroyed successfully.".format(group))
+    try:
+        finished = snapshots.checkSnapshots(conn,
+            LOGGER_NAME if caller == "cli" else caller, db_name)
 
-    cursor.execute('''DELETE FROM branches WHERE group_name = ?''', (group,))
-    modifyStamp(db)
+        for group, server_id in finished:
+            try:
+                conn.delete_server(server_id)
+            except Exception as error:
+                report(caller, "Can't destroy {} instance, OpenStack " \
+                    "returned an error: {}".format(group, error),
+                    logging.WARNING)
+                continue
 
-    db.commit()
-    db.close()
+            deleted.append((group, server_id))
+            report(caller, "{} instance destroyed.".format(group),
+                logging.WARNING)
+    finally:
+        conn.close()
+
+    if deleted:
+        with database.transaction(db_name) as cursor:
+            cursor.executemany('''DELETE FROM branches WHERE group_name = ?
+                AND instance_id = ? AND status = "destroying"''', deleted)
+            modifyStamp(cursor, [("branch", group) for group, _ in deleted])
 
 def checkDB(name):
     """
@@ -486,7 +1515,9 @@ def checkDB(name):
     name
         The name of an SQLite Db for the daemon to use.
     """
-
+    # the file might not belong to Arboretum, so it's inspected through a
+    # throwaway connection rather than one that switches it to WAL mode
+    database.closeConnection(name)
     db = sqlite3.connect(name)
     cursor = db.cursor()
 
@@ -498,14 +1529,17 @@ def checkDB(name):
             "the file and try again.".format(name))
         exit(1)
 
-    result = cursor.fetchall()
+    tables = set(row[0] for row in cursor.fetchall())
+    revision = cursor.execute('''PRAGMA user_version''').fetchone()[0]
 
     # if the DB is fresh, it will be empty
-    if [] == result:
+    if not tables:
         return name
-    # if the DB was only used by Arboretum, it will have a "branches" table
-    # and nothing else
-    elif [('branches',), ('groups',), ('info',)] == result:
+    # databases written by Arboretum record their schema revision, older ones
+    # can be recognised by only having Arboretum's tables. Either kind is
+    # upgraded by the migrations when the daemon starts.
+    elif revision > 0 or ('branches' in tables and
+            tables <= migrations.LEGACY_TABLES):
         print("""
 Database file {} already exists. What do you want to do?
 
@@ -519,7 +1553,7 @@ Database file {} already exists. What do you want to do?
 
         if choice == "o":
             db.close()
-            os.remove(name)
+            database.removeDatabase(name)
 
             return name
         elif choice == "r":
@@ -541,7 +1575,7 @@ database. Do you want to overwrite the file?
 
         if choice == "yes":
             db.close()
-            os.remove(name)
+            database.removeDatabase(name)
 
             return name
         else:
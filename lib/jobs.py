@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from . import instances
+from . import database
+from . import control
+from .constants import DATABASE_NAME, JOB_CONCURRENCY, JOB_RETENTION
+
+"""
+Jobs let the API hand slow OpenStack work to a background executor and
+answer straight away. Each job is a row in the 'jobs' table, so any API
+worker can report on it, but it runs in the worker that accepted it, at
+most JOB_CONCURRENCY at a time. A job goes from 'queued' to 'running' and
+then 'done' or 'failed'.
+"""
+
+# executor of the current process, recreated after a fork
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def getExecutor():
+    """
+    Returns the job executor of the current process
+    """
+    global _executor, _executor_pid
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=JOB_CONCURRENCY)
+            _executor_pid = os.getpid()
+
+        return _executor
+
+def runCreate(args, caller, submitted, db_name=DATABASE_NAME):
+    """
+    Creates instances for args['groups']. Fails if none could be created,
+    the outcome for each group is kept in the result either way.
+    """
+    results = instances.startInstances(args['groups'], args['lifetime'],
+        caller, db_name=db_name, accepted=submitted)
+
+    errors = [result['error'] for result in results.values()
+        if not result['success']]
+    if errors and len(errors) == len(results):
+        return results, "; ".join(errors)
+
+    return results, None
+
+def runDestroy(args, caller, submitted, db_name=DATABASE_NAME):
+    """
+    Destroys the instances of args['groups'], or of args['group'] alone.
+    Fails if none could be destroyed, the outcome for each group is kept in
+    the result either way.
+    """
+    groups = args['groups'] if 'groups' in args else [args['group']]
+    results = instances.destroyInstances(groups, caller, db_name)
+
+    errors = [result['error'] for result in results.values()
+        if not result['success']]
+    if errors and len(errors) == len(results):
+        return results, "; ".join(errors)
+
+    return results, None
+
+# functions carrying out each kind of job, given its arguments, logger name,
+# submission time and database, returning a JSON serializable result and an
+# error message or None
+JOB_KINDS = {'create': runCreate, 'destroy': runDestroy}
+
+def requestJob(kind, args, caller, db_name=DATABASE_NAME):
+    """
+    Hands a job to the daemon, so that it's the one talking to OpenStack and
+    writing the instances, or queues it on this process' executor if the
+    daemon can't be reached or doesn't accept it in time. In the rare case
+    that the daemon still runs it later, the second run finds the branches
+    already created or being destroyed and changes nothing.
+
+    Parameters
+    ----------
+    kind
+        Key of JOB_KINDS, ie 'create' or 'destroy'
+    args
+        JSON serializable dictionary of arguments for the job
+    caller
+        Name of the logger the job reports to when it runs here
+    db_name
+        Stores the name of the SQL database
+
+    Returns
+    -------
+    job_id
+        ID to look the job up with getJob
+    """
+    try:
+        return control.request(kind, dict(args, wait=False),
+            timeout=5)['job_id']
+    except control.DaemonUnavailable:
+        pass
+    except (OSError, control.CommandError) as error:
+        # eg a timeout, or the daemon couldn't record the job
+        logging.getLogger(caller).warning("The daemon didn't accept the {} " \
+            "job, running it here.\n{}: {}".format(kind, type(error),
+                error))
+
+    return submitJob(kind, args, caller, db_name)
+
+def submitJob(kind, args, caller, db_name=DATABASE_NAME, callback=None):
+    """
+    Records a job and queues it on this process' executor
+
+    Parameters
+    ----------
+    kind
+        Key of JOB_KINDS, ie 'create' or 'destroy'
+    args
+        JSON serializable dictionary of arguments for the job
+    caller
+        Name of the logger the job reports to
+    db_name
+        Stores the name of the SQL database
+    callback
+        Function called without arguments once the job has finished
+
+    Returns
+    -------
+    job_id
+        ID to look the job up with getJob
+    """
+    job_id = uuid.uuid4().hex
+    submitted = time.time()
+
+    with database.transaction(db_name) as cursor:
+        # finished jobs are only kept for a while
+        cursor.execute('''DELETE FROM jobs WHERE finish_time <
+            CAST(strftime("%s", "now") AS INTEGER) - ?''', (JOB_RETENTION,))
+        cursor.execute('''INSERT INTO jobs(job_id, kind, args, status,
+            submit_time) VALUES(?, ?, ?, "queued",
+            CAST(strftime("%s", "now") AS INTEGER))''',
+            (job_id, kind, json.dumps(args)))
+
+    future = getExecutor().submit(runJob, job_id, kind, args, caller,
+        submitted, db_name)
+    if callback is not None:
+        future.add_done_callback(lambda future: callback())
+
+    return job_id
+
+def runJob(job_id, kind, args, caller, submitted, db_name=DATABASE_NAME):
+    """
+    Carries out a job and records its outcome, never raises
+    """
+    try:
+        with database.transaction(db_name) as cursor:
+            cursor.execute('''UPDATE jobs SET status = "running",
+                start_time = CAST(strftime("%s", "now") AS INTEGER)
+                WHERE job_id = ?''', (job_id,))
+
+        try:
+            result, error = JOB_KINDS[kind](args, caller, submitted,
+                db_name)
+        except Exception as exception:
+            logging.getLogger(caller).exception("Job {} ({}) failed."
+                .format(job_id, kind))
+            result, error = None, "{}: {}".format(type(exception).__name__,
+                exception)
+
+        with database.transaction(db_name) as cursor:
+            cursor.execute('''UPDATE jobs SET status = ?, result = ?,
+                error = ?,
+                finish_time = CAST(strftime("%s", "now") AS INTEGER)
+                WHERE job_id = ?''', ("failed" if error else "done",
+                json.dumps(result), error, job_id))
+    except Exception:
+        # nothing above this to report to, the job stays unfinished
+        logging.getLogger(caller).exception("Couldn't record job {}."
+            .format(job_id))
+
+def getJob(job_id, db_name=DATABASE_NAME):
+    """
+    Looks up a job
+
+    Parameters
+    ----------
+    job_id
+        ID returned by submitJob
+    db_name
+        Stores the name of the SQL database
+
+    Returns
+    -------
+    job
+        Dictionary with the job's 'job_id', 'kind', 'args', 'status',
+        'result', 'error' and submit, start and finish times, or None if
+        there is no such job
+    """
+    row = database.getConnection(db_name).execute('''SELECT job_id, kind,
+        args, status, result, error,
+        datetime(submit_time, "unixepoch"),
+        datetime(start_time, "unixepoch"),
+        datetime(finish_time, "unixepoch")
+        FROM jobs WHERE job_id = ?''', (job_id,)).fetchone()
+
+    if row is None:
+        return None
+
+    return {'job_id': row[0],
+        'kind': row[1],
+        'args': json.loads(row[2]),
+        'status': row[3],
+        'result': json.loads(row[4]) if row[4] is not None else None,
+        'error': row[5],
+        'submit_time': row[6],
+        'start_time': row[7],
+        'finish_time': row[8]}
@@ -0,0 +1,410 @@
+import contextlib
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+"""
+An in-process registry of counters, gauges and latency histograms, rendered
+in Prometheus' text exposition format.
+
+Metrics are created once, at import time, and updated from any thread:
+
+    CALLS = metrics.registry.counter("arboretum_example_total",
+        "Example calls", ["outcome"])
+    CALLS.inc(outcome="ok")
+
+Each process has its own registry. A registry's snapshot is a JSON
+serializable dictionary, so the daemon can collect snapshots from its
+processes and the API can fetch the daemon's over the control socket. API
+workers, which don't talk to each other, share theirs as files in a directory
+with writeSnapshot and readSnapshots.
+Snapshots from several processes are merged by adding up counters and
+histograms, gauges take the value from the last snapshot that has them.
+"""
+
+# upper bounds, in seconds, of the buckets of latency histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30, 60, 300, 900, 3600)
+
+
+class Metric:
+    """
+    Values of one metric, by label values
+
+    Parameters
+    ----------
+    name
+        Name of the metric, eg 'arboretum_openstack_calls_total'
+    help
+        One line description
+    labelnames
+        Names of the labels every update has to give
+    """
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        # tuple of label values -> value
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{} takes the labels {}, not {}.".format(
+                self.name, list(self.labelnames), sorted(labels)))
+
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        """
+        Forgets every label combination, eg before setting them all again
+        """
+        with self.lock:
+            self.values = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {'kind': self.kind, 'help': self.help,
+                'labelnames': list(self.labelnames),
+                'values': [[list(key), self.copyValue(value)]
+                    for key, value in self.values.items()]}
+
+    def copyValue(self, value):
+        return value
+
+
+class Counter(Metric):
+    """
+    Value that only goes up
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down
+    """
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, eg latencies in seconds
+
+    Parameters
+    ----------
+    buckets
+        Increasing upper bounds of the buckets, +Inf is added
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            # [count per bucket, not cumulative, with +Inf last, sum, count]
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = \
+                    [[0] * (len(self.buckets) + 1), 0, 0]
+
+            index = len(self.buckets)
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    index = position
+                    break
+
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Context manager observing how many seconds its body took
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+    def copyValue(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+
+class Registry:
+    """
+    The metrics of a process, by name
+
+    Methods
+    -------
+    counter(name, help, labelnames)
+        Returns the counter called 'name', creating it if needed
+    gauge(name, help, labelnames)
+        Returns the gauge called 'name', creating it if needed
+    histogram(name, help, labelnames, buckets)
+        Returns the histogram called 'name', creating it if needed
+    snapshot()
+        JSON serializable copy of every metric
+    clear()
+        Forgets the values of every metric
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.setdefault(metric.name, metric)
+
+        if type(existing) is not type(metric):
+            raise ValueError("{} is already a {}.".format(metric.name,
+                existing.kind))
+
+        return existing
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def clear(self):
+        """
+        Forgets the values of every metric, eg in a forked process whose
+        parent reports its own
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        for metric in metrics:
+            metric.clear()
+
+# shared by everything in this process
+registry = Registry()
+
+FUNCTION_SECONDS = registry.histogram("arboretum_function_seconds",
+    "Seconds taken by instrumented functions", ["function"])
+FUNCTION_ERRORS = registry.counter("arboretum_function_errors_total",
+    "Calls of instrumented functions that raised", ["function"])
+
+def timed(function):
+    """
+    Decorator recording how long each call of 'function' takes under its
+    name in arboretum_function_seconds, and counting the calls that raise
+    """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            FUNCTION_ERRORS.inc(function=name)
+            raise
+        finally:
+            FUNCTION_SECONDS.observe(time.monotonic() - start,
+                function=name)
+
+    return wrapper
+
+def mergeSnapshots(snapshots):
+    """
+    Merges registry snapshots from several processes
+
+    Parameters
+    ----------
+    snapshots
+        Iterable of snapshots, as returned by Registry.snapshot
+
+    Returns
+    -------
+    snapshot
+        A single snapshot, with counters and histograms added up
+    """
+    merged = {}
+
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.get(name)
+            if target is None:
+                merged[name] = target = dict(metric, values={})
+            elif target['kind'] != metric['kind'] or \
+                    target.get('buckets') != metric.get('buckets'):
+                # incompatible definitions, eg from different versions
+                continue
+
+            values = target['values']
+            for key, value in metric['values']:
+                key = tuple(key)
+                if key not in values or metric['kind'] == "gauge":
+                    values[key] = value if metric['kind'] != "histogram" \
+                        else [list(value[0]), value[1], value[2]]
+                elif metric['kind'] == "counter":
+                    values[key] += value
+                else:
+                    old = values[key]
+                    values[key] = [[a + b for a, b in zip(old[0], value[0])],
+                        old[1] + value[1], old[2] + value[2]]
+
+    for metric in merged.values():
+        metric['values'] = [[list(key), value]
+            for key, value in metric['values'].items()]
+
+    return merged
+
+def writeSnapshot(directory, name):
+    """
+    Writes a snapshot of this process' registry to 'name'.json in
+    'directory', replacing the previous one in one step so readers never see
+    a partial file
+
+    Parameters
+    ----------
+    directory
+        Directory shared by the processes, created if missing
+    name
+        Identifies this process among them, eg its pid
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "{}.json".format(name))
+    temporary = "{}.{}.tmp".format(path, threading.get_ident())
+
+    with open(temporary, "w") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(temporary, path)
+
+def readSnapshots(directory, exclude=None):
+    """
+    Reads the snapshots written to 'directory' by writeSnapshot
+
+    Parameters
+    ----------
+    directory
+        Directory shared by the processes
+    exclude
+        Name of a snapshot to skip, eg this process' own
+
+    Returns
+    -------
+    list
+        The snapshots, in no particular order, skipping unreadable files
+    """
+    try:
+        filenames = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+    snapshots = []
+    for filename in filenames:
+        name, extension = os.path.splitext(filename)
+        if extension != ".json" or name == exclude:
+            continue
+
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+
+    return snapshots
+
+def formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(name, str(value)
+        .replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs) + "}"
+
+def formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+def render(snapshot=None):
+    """
+    Renders a snapshot in Prometheus' text exposition format
+
+    Parameters
+    ----------
+    snapshot
+        As returned by Registry.snapshot or mergeSnapshots, defaults to a
+        snapshot of this process' registry
+
+    Returns
+    -------
+    text
+        The metrics, one family after the other, sorted by name
+    """
+    if snapshot is None:
+        snapshot = registry.snapshot()
+
+    lines = []
+    for name, metric in sorted(snapshot.items()):
+        lines.append("# HELP {} {}".format(name, metric['help']))
+        lines.append("# TYPE {} {}".format(name, metric['kind']))
+        names = metric['labelnames']
+
+        for key, value in sorted(metric['values']):
+            if metric['kind'] != "histogram":
+                lines.append("{}{} {}".format(name,
+                    formatLabels(names, key), formatValue(value)))
+                continue
+
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket in zip(metric['buckets'] + [math.inf],
+                    counts):
+                cumulative += bucket
+                lines.append("{}_bucket{} {}".format(name,
+                    formatLabels(names, key, [("le", formatValue(bound))]),
+                    cumulative))
+            lines.append("{}_sum{} {}".format(name, formatLabels(names, key),
+                formatValue(total)))
+            lines.append("{}_count{} {}".format(name,
+                formatLabels(names, key), count))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,274 @@
+import logging
+import random
+
+from . import database
+from .constants import DATABASE_NAME
+
+LOGGER_NAME = "cli"
+RANDOM_RANGE = {'a':0, 'b':999999999999}
+
+"""
+Each migration upgrades the schema by one revision and runs in its own
+transaction. The revision of a database is kept in SQLite's user_version
+header field, databases created before revisions were tracked are at 0 and
+go through every migration. Migrations 1 and 2 only create what's missing,
+so they are no-ops for those older databases.
+
+Append new migrations to the end of MIGRATIONS, never edit or reorder
+existing ones.
+"""
+
+def createBaseTables(cursor):
+    """
+    Revision 1: the original branches, groups and info tables
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS branches(
+        group_name TEXT PRIMARY KEY,
+        instance_ip TEXT,
+        prune_time TEXT,
+        instance_id TEXT,
+        creation_time TEXT,
+        status TEXT)
+    ''')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS groups(
+        group_name TEXT PRIMARY KEY,
+        ram TEXT,
+        time TEXT)
+    ''')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS info(name TEXT PRIMARY KEY,
+        value TEXT)''')
+    # the stamp starts at a random version so that clients don't confuse the
+    # versions of a recreated database with old ones
+    cursor.execute('''INSERT OR IGNORE INTO info
+        VALUES ("stamp", ?)''', (random.randint(**RANDOM_RANGE),))
+
+def createChangelog(cursor):
+    """
+    Revision 2: the change log used for delta sync
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS changelog(version INTEGER,
+        kind TEXT,
+        group_name TEXT)
+    ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS changelog_version
+        ON changelog(version)''')
+    # changes made before the log existed can't be replayed
+    cursor.execute('''INSERT OR IGNORE INTO info
+        SELECT "changelog_start", CAST(value AS INTEGER) FROM info
+        WHERE name = "stamp"''')
+
+def typeColumns(cursor):
+    """
+    Revision 3: integer RAM and build times, epoch timestamps, and indexes
+    for the daemon's queries on branch status and prune time. A prune time
+    of NULL means the instance lives forever.
+    """
+    cursor.execute('''CREATE TABLE groups_typed(
+        group_name TEXT PRIMARY KEY,
+        ram INTEGER NOT NULL,
+        time INTEGER NOT NULL)
+    ''')
+    # times were stored as eg '12 minutes', CAST keeps the leading number
+    cursor.execute('''INSERT INTO groups_typed(group_name, ram, time)
+        SELECT group_name, CAST(ram AS INTEGER), CAST(time AS INTEGER)
+        FROM groups''')
+    cursor.execute('''DROP TABLE groups''')
+    cursor.execute('''ALTER TABLE groups_typed RENAME TO groups''')
+
+    cursor.execute('''CREATE TABLE branches_typed(
+        group_name TEXT PRIMARY KEY,
+        instance_ip TEXT,
+        prune_time INTEGER,
+        instance_id TEXT,
+        creation_time INTEGER,
+        status TEXT)
+    ''')
+    cursor.execute('''INSERT INTO branches_typed(group_name, instance_ip,
+            prune_time, instance_id, creation_time, status)
+        SELECT group_name, instance_ip,
+            CASE WHEN prune_time = "never" THEN NULL
+                ELSE CAST(strftime("%s", prune_time) AS INTEGER) END,
+            instance_id,
+            CAST(strftime("%s", creation_time) AS INTEGER),
+            status
+        FROM branches''')
+    cursor.execute('''DROP TABLE branches''')
+    cursor.execute('''ALTER TABLE branches_typed RENAME TO branches''')
+
+    cursor.execute('''CREATE INDEX branches_status ON branches(status)''')
+    cursor.execute('''CREATE INDEX branches_prune_time
+        ON branches(prune_time)''')
+
+def createPool(cursor):
+    """
+    Revision 4: the warm pool of unassigned instances, and when each flavor
+    was last asked for
+    """
+    cursor.execute('''CREATE TABLE pool(
+        instance_id TEXT PRIMARY KEY,
+        flavor TEXT NOT NULL,
+        instance_ip TEXT,
+        status TEXT NOT NULL,
+        creation_time INTEGER NOT NULL,
+        ready_time INTEGER)
+    ''')
+    cursor.execute('''CREATE INDEX pool_flavor_status
+        ON pool(flavor, status)''')
+
+    cursor.execute('''CREATE TABLE pool_demand(
+        flavor TEXT PRIMARY KEY,
+        last_demand INTEGER NOT NULL)
+    ''')
+
+def createJobs(cursor):
+    """
+    Revision 5: asynchronous create and destroy jobs submitted through the
+    API, with their arguments and results as JSON
+    """
+    cursor.execute('''CREATE TABLE jobs(
+        job_id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        args TEXT NOT NULL,
+        status TEXT NOT NULL,
+        result TEXT,
+        error TEXT,
+        submit_time INTEGER NOT NULL,
+        start_time INTEGER,
+        finish_time INTEGER)
+    ''')
+    cursor.execute('''CREATE INDEX jobs_finish_time ON jobs(finish_time)''')
+
+def createBuildHistory(cursor):
+    """
+    Revision 6: how long each instance took to build. 'builds' describes the
+    instance, 'build_events' records when it reached each phase.
+    """
+    cursor.execute('''CREATE TABLE builds(
+        instance_id TEXT PRIMARY KEY,
+        group_name TEXT NOT NULL,
+        flavor TEXT NOT NULL,
+        ram INTEGER NOT NULL,
+        pooled INTEGER NOT NULL)
+    ''')
+    cursor.execute('''CREATE INDEX builds_group_name
+        ON builds(group_name)''')
+
+    cursor.execute('''CREATE TABLE build_events(
+        instance_id TEXT NOT NULL,
+        phase TEXT NOT NULL,
+        time REAL NOT NULL,
+        PRIMARY KEY(instance_id, phase))
+    ''')
+
+def createSnapshots(cursor):
+    """
+    Revision 7: a hash of each group's index entry, and the snapshots that
+    groups' instances can be booted from. Hashes are filled in by the next
+    index update, which has to ingest the whole index again.
+    """
+    cursor.execute('''ALTER TABLE groups ADD COLUMN data_hash TEXT''')
+    # otherwise the update is skipped while mpistat's index is unchanged
+    cursor.execute('''DELETE FROM info
+        WHERE name IN ("index_etag", "index_hash")''')
+
+    cursor.execute('''CREATE TABLE snapshots(
+        group_name TEXT PRIMARY KEY,
+        image_id TEXT NOT NULL,
+        data_hash TEXT NOT NULL,
+        creation_time INTEGER NOT NULL,
+        expiry_time INTEGER NOT NULL)
+    ''')
+    cursor.execute('''CREATE INDEX snapshots_expiry_time
+        ON snapshots(expiry_time)''')
+
+def addServerStatus(cursor):
+    """
+    Revision 8: the status OpenStack last reported for each branch's server
+    """
+    cursor.execute('''ALTER TABLE branches ADD COLUMN server_status TEXT''')
+
+def createPendingSnapshots(cursor):
+    """
+    Revision 9: snapshots that were started but whose image isn't active
+    yet, with the instance to delete once it is
+    """
+    cursor.execute('''CREATE TABLE pending_snapshots(
+        group_name TEXT PRIMARY KEY,
+        image_id TEXT NOT NULL,
+        server_id TEXT NOT NULL,
+        data_hash TEXT NOT NULL,
+        start_time INTEGER NOT NULL)
+    ''')
+
+def addDestroyTime(cursor):
+    """
+    Revision 10: when each branch being destroyed was claimed, so claims
+    left behind by a process that died can be taken over. Branches already
+    being destroyed have none and can be taken over straight away.
+    """
+    cursor.execute('''ALTER TABLE branches ADD COLUMN destroy_time INTEGER''')
+
+MIGRATIONS = [createBaseTables, createChangelog, typeColumns, createPool,
+    createJobs, createBuildHistory, createSnapshots, addServerStatus,
+    createPendingSnapshots, addDestroyTime]
+
+# tables of databases created before revisions were tracked
+LEGACY_TABLES = {'branches', 'groups', 'info', 'changelog'}
+
+def getRevision(db_name=DATABASE_NAME):
+    """
+    Returns the schema revision of a database
+
+    Parameters
+    ----------
+    db_name
+        Path of the SQLite database file
+
+    Returns
+    -------
+    revision
+        Number of migrations that have been applied
+    """
+    return database.getConnection(db_name) \
+        .execute('''PRAGMA user_version''').fetchone()[0]
+
+def migrate(db_name=DATABASE_NAME):
+    """
+    Brings a database up to the latest schema revision, applying each
+    outstanding migration in its own transaction. Safe to call from several
+    processes at once.
+
+    Parameters
+    ----------
+    db_name
+        Path of the SQLite database file
+
+    Raises
+    ------
+    RuntimeError
+        Raised if the database was written by a newer version of Arboretum
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+
+    while True:
+        with database.transaction(db_name) as cursor:
+            # read inside the transaction, so two processes can't both apply
+            # the same migration
+            revision = cursor.execute('''PRAGMA user_version''').fetchone()[0]
+
+            if revision > len(MIGRATIONS):
+                raise RuntimeError("Database {} is at schema revision {}, " \
+                    "this version of Arboretum only knows {} revisions."
+                    .format(db_name, revision, len(MIGRATIONS)))
+
+            if revision == len(MIGRATIONS):
+                return
+
+            MIGRATIONS[revision](cursor)
+            cursor.execute('''PRAGMA user_version = {}'''
+                .format(revision + 1))
+
+        logger.info("Migrated {} to schema revision {}."
+            .format(db_name, revision + 1))
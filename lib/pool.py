@@ -0,0 +1,292 @@
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from . import cloud
+from . import database
+from . import probes
+from .constants import DATABASE_NAME, POOL_SIZES, POOL_IDLE_TIMEOUT, \
+    POOL_BUILD_TIMEOUT, POOL_PORT, POOL_GROUP_KEY, CREATE_CONCURRENCY
+
+"""
+The warm pool keeps idle instances that have already booted and provisioned
+everything that doesn't depend on a group. They're created from the pooled
+variant of user.sh, which then serves POOL_PORT to show it's ready and waits
+for the POOL_GROUP_KEY server metadata key to name a group. Claiming an
+instance sets that key and renames the server, the instance then loads the
+group's data like a freshly booted one would.
+
+Pooled instances are recorded in the 'pool' table until they are claimed.
+Each flavor in POOL_SIZES is kept topped up while it's in demand, ie while
+an instance of that flavor was created in the last POOL_IDLE_TIMEOUT
+seconds. Otherwise its idle instances are destroyed.
+"""
+
+def recordDemand(cursor, flavors):
+    """
+    Notes that instances of 'flavors' were just created, which keeps their
+    pools topped up for POOL_IDLE_TIMEOUT seconds
+
+    Parameters
+    ----------
+    cursor
+        Cursor of the database, inside a transaction
+    flavors
+        Iterable of flavor names
+    """
+    cursor.executemany('''INSERT OR REPLACE INTO pool_demand(flavor,
+        last_demand) VALUES(?, CAST(strftime("%s", "now") AS INTEGER))''',
+        ((flavor,) for flavor in set(flavors)))
+
+def claimInstance(flavor, db_name=DATABASE_NAME):
+    """
+    Takes a ready instance of 'flavor' out of the pool
+
+    Parameters
+    ----------
+    flavor
+        Name of the flavor the instance must have
+    db_name
+        Stores the name of the SQL database
+
+    Returns
+    -------
+    (instance_id, instance_ip)
+        The claimed instance, or None if the pool has no ready instance of
+        that flavor
+    """
+    if flavor not in POOL_SIZES:
+        return None
+
+    with database.transaction(db_name) as cursor:
+        cursor.execute('''SELECT instance_id, instance_ip FROM pool
+            WHERE flavor = ? AND status = "ready"
+            ORDER BY ready_time LIMIT 1''', (flavor,))
+        result = cursor.fetchone()
+
+        if result is None:
+            return None
+
+        cursor.execute('''DELETE FROM pool WHERE instance_id = ?''',
+            (result[0],))
+
+    return result
+
+def assignInstance(conn, instance_id, group):
+    """
+    Hands a claimed instance over to 'group'
+
+    Parameters
+    ----------
+    conn
+        An OpenStack connection
+    instance_id
+        ID of an instance returned by claimInstance
+    group
+        Name of the Unix group whose data the instance should load
+    """
+    conn.set_server_metadata(instance_id, {POOL_GROUP_KEY: group})
+    conn.update_server(instance_id, name='arboretum-{}-branch'.format(group))
+
+def getTargets(db_name=DATABASE_NAME):
+    """
+    Works out how many instances each flavor's pool should hold
+
+    Parameters
+    ----------
+    db_name
+        Stores the name of the SQL database
+
+    Returns
+    -------
+    targets
+        Dictionary mapping flavor names to pool sizes, including flavors
+        that still have pooled instances but should have none
+    """
+    db = database.getConnection(db_name)
+
+    recent = set(row[0] for row in db.execute('''SELECT flavor
+        FROM pool_demand
+        WHERE last_demand > CAST(strftime("%s", "now") AS INTEGER) - ?''',
+        (POOL_IDLE_TIMEOUT,)))
+
+    targets = {row[0]: 0 for row in
+        db.execute('''SELECT DISTINCT flavor FROM pool''')}
+
+    for flavor, size in POOL_SIZES.items():
+        targets[flavor] = size if flavor in recent else 0
+
+    return targets
+
+def refillPool(connect, db_name=DATABASE_NAME):
+    """
+    Boots new pooled instances for every flavor whose pool is below its
+    target size
+
+    Parameters
+    ----------
+    connect
+        Function returning an OpenStack connection
+    db_name
+        Stores the name of the SQL database
+    """
+    logger = logging.getLogger("daemon")
+    db = database.getConnection(db_name)
+
+    missing = []
+    for flavor, target in getTargets(db_name).items():
+        count = db.execute('''SELECT COUNT(*) FROM pool WHERE flavor = ?''',
+            (flavor,)).fetchone()[0]
+        missing += [flavor] * max(0, target - count)
+
+    if not missing:
+        return
+
+    logger.info("Adding {} instances to the pool.".format(len(missing)))
+
+    userdata = cloud.renderUserdata(pooled=True)
+    conn = connect()
+
+    def create(flavor):
+        name = 'arboretum-pool-{}'.format(uuid.uuid4().hex[:12])
+        info = cloud.createServer(conn, name, flavor, userdata)
+
+        with database.transaction(db_name) as cursor:
+            cursor.execute('''INSERT INTO pool(instance_id, flavor,
+                instance_ip, status, creation_time)
+                VALUES(?, ?, ?, "building",
+                CAST(strftime("%s", "now") AS INTEGER))''',
+                (info.id, flavor, info.private_v4 or ""))
+
+        return name
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(CREATE_CONCURRENCY,
+                len(missing))) as executor:
+            for flavor, future in [(flavor, executor.submit(create, flavor))
+                    for flavor in missing]:
+                try:
+                    logger.info("Created pooled {} instance {}."
+                        .format(flavor, future.result()))
+                except Exception as error:
+                    logger.warning("Couldn't create pooled {} instance.\n" \
+                        "{}: {}".format(flavor, type(error), error))
+    finally:
+        conn.close()
+
+def updatePoolInstances(connect, db_name=DATABASE_NAME, servers=None):
+    """
+    Saves the IPs of pooled instances that are still building, destroys the
+    ones whose server failed, and marks the rest ready once they serve
+    POOL_PORT
+
+    Parameters
+    ----------
+    connect
+        Function returning an OpenStack connection
+    db_name
+        Stores the name of the SQL database
+    servers
+        Servers as returned by cloud.listServers, listed here if not given
+    """
+    logger = logging.getLogger("daemon")
+
+    building = database.getConnection(db_name).execute('''SELECT
+        instance_id, instance_ip FROM pool WHERE status = "building"''') \
+        .fetchall()
+
+    if not building:
+        return
+
+    conn = connect()
+    try:
+        if servers is None:
+            servers = cloud.listServers(conn)
+
+        ips = {}
+        for instance_id, instance_ip in building:
+            server = servers.get(instance_id)
+
+            if server is not None and server.status == "ERROR":
+                with database.transaction(db_name) as cursor:
+                    cursor.execute('''DELETE FROM pool
+                        WHERE instance_id = ?''', (instance_id,))
+                conn.delete_server(instance_id)
+                logger.warning("Pooled instance {} failed in OpenStack, " \
+                    "destroyed it.".format(instance_id))
+                continue
+
+            if not instance_ip and server is not None and server.private_v4:
+                instance_ip = server.private_v4
+                with database.transaction(db_name) as cursor:
+                    cursor.execute('''UPDATE pool SET instance_ip = ?
+                        WHERE instance_id = ?''', (instance_ip, instance_id))
+
+            if instance_ip:
+                ips[instance_id] = instance_ip
+    finally:
+        conn.close()
+
+    ready = [instance_id for instance_id, outcome
+        in probes.probeAll(ips, POOL_PORT).items() if outcome == probes.READY]
+
+    if ready:
+        with database.transaction(db_name) as cursor:
+            cursor.executemany('''UPDATE pool SET status = "ready",
+                ready_time = CAST(strftime("%s", "now") AS INTEGER)
+                WHERE instance_id = ?''', [(instance_id,)
+                    for instance_id in ready])
+
+    for instance_id in ready:
+        logger.info("Pooled instance {} is ready.".format(instance_id))
+
+def prunePool(connect, db_name=DATABASE_NAME):
+    """
+    Destroys pooled instances that are no longer needed: ready instances
+    above their flavor's target, oldest first, and instances that never
+    became ready within POOL_BUILD_TIMEOUT seconds
+
+    Parameters
+    ----------
+    connect
+        Function returning an OpenStack connection
+    db_name
+        Stores the name of the SQL database
+    """
+    logger = logging.getLogger("daemon")
+    db = database.getConnection(db_name)
+
+    doomed = [row[0] for row in db.execute('''SELECT instance_id FROM pool
+        WHERE status = "building"
+        AND creation_time < CAST(strftime("%s", "now") AS INTEGER) - ?''',
+        (POOL_BUILD_TIMEOUT,))]
+
+    for flavor, target in getTargets(db_name).items():
+        ready = [row[0] for row in db.execute('''SELECT instance_id FROM pool
+            WHERE flavor = ? AND status = "ready" ORDER BY ready_time''',
+            (flavor,))]
+        building = db.execute('''SELECT COUNT(*) FROM pool
+            WHERE flavor = ? AND status = "building"''', (flavor,)) \
+            .fetchone()[0]
+        excess = len(ready) + building - target
+        doomed += ready[:max(0, min(excess, len(ready)))]
+
+    if not doomed:
+        return
+
+    conn = connect()
+    try:
+        for instance_id in doomed:
+            # claimed in the database first so it can't be handed out while
+            # it's being deleted
+            with database.transaction(db_name) as cursor:
+                cursor.execute('''DELETE FROM pool WHERE instance_id = ?''',
+                    (instance_id,))
+                if cursor.rowcount == 0:
+                    continue
+
+            conn.delete_server(instance_id)
+            logger.info("Removed instance {} from the pool."
+                .format(instance_id))
+    finally:
+        conn.close()
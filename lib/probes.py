@@ -0,0 +1,110 @@
+import http.client
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+from .constants import PROBE_CONNECT_TIMEOUT, PROBE_READ_TIMEOUT, \
+    PROBE_CONCURRENCY
+
+"""
+Readiness probes check whether an instance answers HTTP yet. A probe never
+raises, its outcome is one of:
+
+ready
+    A 2xx or 3xx response
+client_error
+    A 4xx response
+server_error
+    A 5xx response
+refused
+    Nothing listens on the port yet, the usual state of a building instance
+timeout
+    Connecting or reading took longer than the timeouts
+dns
+    The host name couldn't be resolved
+unreachable
+    Any other network error, eg no route to the host
+bad_response
+    Something answered, but not with valid HTTP
+"""
+
+READY = "ready"
+
+def probe(host, port, path="/", connect_timeout=PROBE_CONNECT_TIMEOUT,
+        read_timeout=PROBE_READ_TIMEOUT):
+    """
+    Sends a single GET request and classifies the outcome
+
+    Parameters
+    ----------
+    host
+        IP or host name of the instance
+    port
+        Port to connect to
+    path
+        Path to request
+    connect_timeout
+        Seconds to wait for the connection
+    read_timeout
+        Seconds to wait for the response once connected
+
+    Returns
+    -------
+    outcome
+        One of the outcomes described in the module docstring
+    """
+    conn = http.client.HTTPConnection(host, port, timeout=connect_timeout)
+
+    try:
+        conn.connect()
+        conn.sock.settimeout(read_timeout)
+        conn.request("GET", path)
+        status = conn.getresponse().status
+    except ConnectionRefusedError:
+        return "refused"
+    except socket.timeout:
+        return "timeout"
+    except socket.gaierror:
+        return "dns"
+    except http.client.HTTPException:
+        return "bad_response"
+    except OSError:
+        return "unreachable"
+    finally:
+        conn.close()
+
+    if status >= 500:
+        return "server_error"
+    if status >= 400:
+        return "client_error"
+    return READY
+
+def probeAll(hosts, port, path="/", concurrency=PROBE_CONCURRENCY):
+    """
+    Probes several hosts concurrently, so a round takes about as long as
+    its slowest probe rather than the sum of all of them
+
+    Parameters
+    ----------
+    hosts
+        Dictionary mapping keys, eg group names, to hosts
+    port
+        Port to connect to
+    path
+        Path to request
+    concurrency
+        Most probes in flight at once
+
+    Returns
+    -------
+    outcomes
+        Dictionary mapping the same keys to the outcome of their probe
+    """
+    if not hosts:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(hosts))) \
+            as executor:
+        futures = {key: executor.submit(probe, host, port, path)
+            for key, host in hosts.items()}
+
+        return {key: future.result() for key, future in futures.items()}
@@ -0,0 +1,236 @@
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from . import metrics
+from .constants import PROFILE_INTERVAL, WATCHDOG_FACTOR, \
+    WATCHDOG_MIN_SECONDS, WATCHDOG_SMOOTHING
+
+"""
+Profiling of the running daemon, without restarting it.
+
+The sampling profiler records the stack of every thread of a process every
+PROFILE_INTERVAL seconds, so it sees what the loops and command threads are
+doing, including time spent waiting on OpenStack or SQLite, at a cost that
+doesn't depend on how much Python code runs. Samples are kept as collapsed
+stacks, one line per distinct stack with its frames separated by
+semicolons, root first, and the number of samples that had it:
+
+    prune_process;daemon.py:pruneLoop;daemon.py:pruneStep;... 12
+
+which flamegraph.pl and speedscope read directly.
+
+The watchdog dumps the stack of a loop whose step takes far longer than its
+steps usually do, so a stall shows up in arboretum.log with where it's
+stuck.
+"""
+
+SLOW_STEPS = metrics.registry.counter("arboretum_slow_steps_total",
+    "Daemon steps that took long enough for the watchdog to dump stacks",
+    ["step"])
+
+def formatFrame(frame):
+    """
+    Returns a frame as 'file.py:function'
+    """
+    code = frame.f_code
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+def collapseStack(frame):
+    """
+    Returns the stack ending at 'frame' as frames joined by semicolons, root
+    first
+    """
+    frames = []
+    while frame is not None:
+        frames.append(formatFrame(frame))
+        frame = frame.f_back
+
+    return ";".join(reversed(frames))
+
+def sampleStacks(seconds, interval=PROFILE_INTERVAL, root=None):
+    """
+    Samples the stacks of every other thread of this process
+
+    Parameters
+    ----------
+    seconds
+        How long to sample for
+    interval
+        Seconds between two samples
+    root
+        Frame put at the root of every stack, eg the name of the process
+
+    Returns
+    -------
+    stacks
+        Dictionary mapping collapsed stacks to their number of samples
+    """
+    stacks = collections.Counter()
+    me = threading.get_ident()
+    names = {}
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        # thread names change rarely, so they're looked up once per thread
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            if thread_id not in names:
+                names = {thread.ident: thread.name
+                    for thread in threading.enumerate()}
+
+            stack = "{};{}".format(names.get(thread_id, thread_id),
+                collapseStack(frame))
+            if root is not None:
+                stack = "{};{}".format(root, stack)
+            stacks[stack] += 1
+
+        time.sleep(interval)
+
+    return dict(stacks)
+
+def mergeProfiles(profiles):
+    """
+    Adds up the samples of several profiles
+
+    Parameters
+    ----------
+    profiles
+        Iterable of dictionaries mapping collapsed stacks to sample counts
+
+    Returns
+    -------
+    stacks
+        The merged dictionary
+    """
+    merged = collections.Counter()
+    for profile in profiles:
+        merged.update(profile)
+
+    return dict(merged)
+
+def writeProfile(stacks, directory):
+    """
+    Writes collapsed stacks to a file named after the current time
+
+    Parameters
+    ----------
+    stacks
+        Dictionary mapping collapsed stacks to sample counts
+    directory
+        Directory to write to, eg the one arboretum.log is in
+
+    Returns
+    -------
+    path
+        Path of the new file
+    """
+    path = os.path.join(directory, "arboretum-profile-{}.collapsed"
+        .format(time.strftime("%Y%m%d-%H%M%S")))
+
+    with open(path, "w") as output:
+        for stack, count in sorted(stacks.items()):
+            output.write("{} {}\n".format(stack, count))
+
+    return path
+
+def serveProfiles(requests, results, name):
+    """
+    Starts a thread answering profile requests in a daemon process, so the
+    main process can profile it
+
+    Parameters
+    ----------
+    requests
+        multiprocessing Queue of (request_id, seconds) tuples for this
+        process
+    results
+        multiprocessing Queue the (request_id, stacks) results are put on
+    name
+        Name of the process, the root frame of its stacks
+    """
+    def serve():
+        while True:
+            request_id, seconds = requests.get()
+            results.put((request_id, sampleStacks(seconds, root=name)))
+
+    threading.Thread(target=serve, name="profiler", daemon=True).start()
+
+def dumpStack(thread_id):
+    """
+    Returns the current stack of a thread, formatted like a traceback
+    """
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return "Thread {} has finished.".format(thread_id)
+
+    return "".join(traceback.format_stack(frame))
+
+
+class Watchdog:
+    """
+    Dumps the stack of a step that runs far longer than it usually does:
+    WATCHDOG_FACTOR times the moving average of its durations, but at least
+    WATCHDOG_MIN_SECONDS. The average starts at WATCHDOG_MIN_SECONDS, so
+    the first step, eg a full catalogue update, gets some leeway. The step
+    itself isn't interrupted.
+
+    Methods
+    -------
+    call(step)
+        Runs 'step', returning the delay it asks for
+    """
+    def __init__(self, name, logger="daemon"):
+        """
+        Parameters
+        ----------
+        name
+            Name of the step, used in the log and metrics
+        logger
+            Name of the logger stacks are dumped to
+        """
+        self.name = name
+        self.logger = logging.getLogger(logger)
+        # moving average of the seconds the step takes
+        self.average = WATCHDOG_MIN_SECONDS
+
+    def call(self, step):
+        """
+        Runs 'step' in this thread while watching it
+
+        Parameters
+        ----------
+        step
+            Function taking no arguments and returning the seconds until it
+            should run again
+
+        Returns
+        -------
+        delay
+            What 'step' returned
+        """
+        limit = max(WATCHDOG_MIN_SECONDS, WATCHDOG_FACTOR * self.average)
+        thread_id = threading.get_ident()
+        start = time.monotonic()
+
+        def dump():
+            SLOW_STEPS.inc(step=self.name)
+            self.logger.warning("{} has been running for {:.0f} seconds, " \
+                "it's stuck at:\n{}".format(self.name,
+                    time.monotonic() - start, dumpStack(thread_id)))
+
+        timer = threading.Timer(limit, dump)
+        timer.daemon = True
+        timer.start()
+
+        try:
+            return step()
+        finally:
+            timer.cancel()
+            self.average += WATCHDOG_SMOOTHING * \
+                (time.monotonic() - start - self.average)
@@ -0,0 +1,134 @@
+import os
+import configparser
+
+import boto3
+import botocore.config
+import botocore.exceptions
+
+from .constants import S3_CONFIG, S3_ENDPOINT_VARIABLE, S3_POOL_SIZE
+
+# a single client is kept per process so that its HTTP connection pool is
+# reused between catalogue refreshes
+_client = None
+_client_pid = None
+
+class NotModified(Exception):
+    """
+    Raised when a conditional GET finds that the object hasn't changed
+    """
+    pass
+
+def readS3Config(path=S3_CONFIG):
+    """
+    Reads credentials and the endpoint from an s3cmd style config file.
+
+    Parameters
+    ----------
+    path
+        Path to the config file, defaults to ~/.s3cfg
+
+    Returns
+    -------
+    config
+        Dictionary of keyword arguments for 'boto3.client'
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(os.path.expanduser(path))
+
+    if not parser.has_section("default"):
+        return {}
+
+    section = parser["default"]
+    config = {}
+
+    if section.get("access_key"):
+        config["aws_access_key_id"] = section.get("access_key")
+    if section.get("secret_key"):
+        config["aws_secret_access_key"] = section.get("secret_key")
+
+    if section.get("host_base"):
+        scheme = "https"
+        if section.get("use_https", "True").lower() in ("false", "no", "0"):
+            scheme = "http"
+        config["endpoint_url"] = "{}://{}".format(scheme,
+            section.get("host_base"))
+
+    return config
+
+def getClient():
+    """
+    Returns the process' S3 client, creating it on first use. The endpoint
+    can be pointed at a local S3-compatible server by setting the
+    ARBORETUM_S3_ENDPOINT environment variable.
+
+    Returns
+    -------
+    client
+        A boto3 S3 client
+    """
+    global _client, _client_pid
+
+    # connection pools can't be shared with a forked parent
+    if _client is None or _client_pid != os.getpid():
+        config = readS3Config()
+
+        if os.environ.get(S3_ENDPOINT_VARIABLE):
+            config["endpoint_url"] = os.environ[S3_ENDPOINT_VARIABLE]
+
+        _client = boto3.client("s3",
+            config=botocore.config.Config(max_pool_connections=S3_POOL_SIZE,
+                s3={"addressing_style": "path"}),
+            **config)
+        _client_pid = os.getpid()
+
+    return _client
+
+def streamObject(bucket, key, etag=None):
+    """
+    Fetches an object and returns an iterator over its lines as they arrive
+    over the network, without writing it to disk.
+
+    Parameters
+    ----------
+    bucket
+        Name of the S3 bucket
+    key
+        Key of the object inside the bucket
+    etag
+        ETag of a previously fetched copy. If the object still has this ETag,
+        NotModified is raised instead of downloading it again.
+
+    Returns
+    -------
+    (lines, etag)
+        Iterator of decoded lines without line endings, and the object's
+        current ETag
+
+    Raises
+    ------
+    NotModified
+        Raised if 'etag' matches the current version of the object
+    botocore.exceptions.ClientError
+        Raised for any other error reported by the S3 server
+    """
+    kwargs = {"Bucket": bucket, "Key": key}
+    if etag is not None:
+        kwargs["IfNoneMatch"] = etag
+
+    try:
+        response = getClient().get_object(**kwargs)
+    except botocore.exceptions.ClientError as error:
+        status = error.response.get("ResponseMetadata", {}) \
+            .get("HTTPStatusCode")
+        if status == 304:
+            raise NotModified("{}/{}".format(bucket, key))
+        raise
+
+    def lines(body):
+        try:
+            for line in body.iter_lines():
+                yield line.decode("UTF-8")
+        finally:
+            body.close()
+
+    return lines(response["Body"]), response.get("ETag")
@@ -0,0 +1,228 @@
+import heapq
+import random
+import time
+
+from .constants import POLL_MIN_INTERVAL, POLL_MAX_INTERVAL
+
+
+class PollScheduler:
+    """
+    Decides when each item, eg a building branch, should next be checked
+
+    Items are checked rarely while they're far from their expected ready
+    time and every POLL_MIN_INTERVAL seconds close to it. Items that are
+    late back off gradually, and failed checks back off exponentially with
+    jitter, so that a broken instance doesn't get hammered and several of
+    them don't all retry at once.
+
+    Methods
+    -------
+    sync(expected)
+        Starts tracking new items and forgets the ones that are gone
+    due(now)
+        Items whose check is due
+    schedule(key, now)
+        Reschedules an item after a check that went as expected
+    fail(key, now)
+        Reschedules an item after a failed check
+    delay(now)
+        Seconds until the next item is due
+    """
+    def __init__(self, min_interval=POLL_MIN_INTERVAL,
+            max_interval=POLL_MAX_INTERVAL):
+        """
+        Parameters
+        ----------
+        min_interval
+            Fewest seconds between two checks of the same item
+        max_interval
+            Most seconds between two checks of the same item
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # key -> [next check time, expected ready time, consecutive failures]
+        self.items = {}
+
+    def clamp(self, delay):
+        return max(self.min_interval, min(self.max_interval, delay))
+
+    def sync(self, expected):
+        """
+        Starts tracking new items, due straight away, updates the expected
+        ready time of known ones, and forgets items that aren't in
+        'expected' any more
+
+        Parameters
+        ----------
+        expected
+            Dictionary mapping every current item to its expected ready time
+            as an epoch time
+        """
+        for key in [key for key in self.items if key not in expected]:
+            del self.items[key]
+
+        for key, ready_time in expected.items():
+            if key in self.items:
+                self.items[key][1] = ready_time
+            else:
+                self.items[key] = [0, ready_time, 0]
+
+    def due(self, now=None):
+        """
+        Returns the items whose next check time has passed
+        """
+        now = time.time() if now is None else now
+        return [key for key, item in self.items.items() if item[0] <= now]
+
+    def schedule(self, key, now=None):
+        """
+        Reschedules 'key' after a check that found it not ready yet, which is
+        expected while it builds. The delay is half the time left until the
+        expected ready time, or a quarter of how late it is.
+        """
+        now = time.time() if now is None else now
+        item = self.items[key]
+        item[2] = 0
+
+        if now < item[1]:
+            delay = (item[1] - now) / 2
+        else:
+            delay = (now - item[1]) / 4
+
+        item[0] = now + self.clamp(delay)
+
+    def fail(self, key, now=None):
+        """
+        Reschedules 'key' after a failed check, doubling the delay with each
+        consecutive failure. Half of the delay is random.
+        """
+        now = time.time() if now is None else now
+        item = self.items[key]
+        item[2] += 1
+
+        delay = self.clamp(self.min_interval * 2 ** item[2])
+        item[0] = now + delay / 2 + random.uniform(0, delay / 2)
+
+    def delay(self, now=None):
+        """
+        Returns the seconds until the next item is due, between 0 and
+        max_interval
+        """
+        now = time.time() if now is None else now
+
+        if not self.items:
+            return self.max_interval
+
+        next_check = min(item[0] for item in self.items.values())
+        return max(0, min(self.max_interval, next_check - now))
+
+
+class ExpiryHeap:
+    """
+    Keeps items, eg branches, ordered by their deadlines, so the earliest
+    one is found without scanning them all
+
+    Changing or removing an item's deadline leaves its old heap entry in
+    place, entries that don't match an item's current deadline are skipped
+    when they reach the top.
+
+    Methods
+    -------
+    set(key, deadline)
+        Adds, moves or, with a deadline of None, removes an item
+    defer(key, until)
+        Keeps an item from being due before 'until'
+    clear()
+        Forgets every item, but not deferrals
+    pop(now)
+        Removes and returns the items that are due
+    next()
+        Deadline of the earliest item
+    """
+    def __init__(self):
+        # (deadline, key) entries, some of which may be outdated
+        self.heap = []
+        # key -> current deadline
+        self.deadlines = {}
+        # key -> time before which it can't be due, eg after a failure
+        self.deferred = {}
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def set(self, key, deadline):
+        """
+        Sets the deadline of 'key', removing it if 'deadline' is None
+
+        Parameters
+        ----------
+        key
+            The item
+        deadline
+            Epoch time the item is due at, or None
+        """
+        if deadline is None:
+            self.deadlines.pop(key, None)
+            self.deferred.pop(key, None)
+            return
+
+        deadline = max(deadline, self.deferred.get(key, deadline))
+        if self.deadlines.get(key) == deadline:
+            return
+
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+
+        # outdated entries are dropped once they outnumber the live ones
+        if len(self.heap) > 2 * len(self.deadlines) + 16:
+            self.heap = [(deadline, key)
+                for key, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def defer(self, key, until):
+        """
+        Makes 'key' due at 'until' and no earlier, even if set again with an
+        earlier deadline, until it's removed
+        """
+        self.deferred[key] = until
+        self.set(key, until)
+
+    def clear(self):
+        """
+        Forgets every item, eg before loading them all again
+        """
+        self.heap = []
+        self.deadlines = {}
+
+    def discardOutdated(self):
+        while self.heap and \
+                self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def pop(self, now=None):
+        """
+        Removes the items whose deadline has passed
+
+        Returns
+        -------
+        due
+            List of (key, deadline) tuples, earliest first
+        """
+        now = time.time() if now is None else now
+
+        due = []
+        self.discardOutdated()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            due.append((key, deadline))
+            self.discardOutdated()
+
+        return due
+
+    def next(self):
+        """
+        Returns the earliest deadline, or None if there are no items
+        """
+        self.discardOutdated()
+        return self.heap[0][0] if self.heap else None
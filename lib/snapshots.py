@@ -0,0 +1,256 @@
+import logging
+
+from . import database
+from .constants import DATABASE_NAME, SNAPSHOTS_ENABLED, \
+    SNAPSHOT_MIN_BUILD_TIME, SNAPSHOT_LIFETIME, SNAPSHOT_TIMEOUT
+
+"""
+Snapshots save the work of building a group's tree. When SNAPSHOTS_ENABLED
+is set, a group's instance is snapshotted before it's destroyed, tagged with
+the hash of the group's index entry. The group's next instance boots from
+the snapshot if the hash still matches, ie if mpistat's data for the group
+hasn't changed. Each group keeps at most one snapshot, which expires
+SNAPSHOT_LIFETIME seconds after it was taken or last used.
+
+Snapshots take a while, so destroys don't wait for them: the instance's
+branch stays 'destroying' while its snapshot is pending, and the daemon's
+prune step deletes the instance once checkSnapshots finds the image active.
+"""
+
+def findSnapshot(group, db_name=DATABASE_NAME):
+    """
+    Looks for a usable snapshot of 'group' and extends its lifetime
+
+    Parameters
+    ----------
+    group
+        Name of the Unix group
+    db_name
+        Stores the name of the SQL database
+
+    Returns
+    -------
+    image_id
+        ID of the snapshot's image, or None if snapshots are disabled or
+        the group has no up to date snapshot
+    """
+    if not SNAPSHOTS_ENABLED:
+        return None
+
+    with database.transaction(db_name) as cursor:
+        cursor.execute('''SELECT snapshots.image_id FROM snapshots
+            JOIN groups ON groups.group_name = snapshots.group_name
+            WHERE snapshots.group_name = ?
+            AND snapshots.data_hash = groups.data_hash
+            AND snapshots.expiry_time > CAST(strftime("%s", "now") AS INTEGER)
+            ''', (group,))
+        result = cursor.fetchone()
+
+        if result is None:
+            return None
+
+        cursor.execute('''UPDATE snapshots SET
+            expiry_time = CAST(strftime("%s", "now") AS INTEGER) + ?
+            WHERE group_name = ?''', (SNAPSHOT_LIFETIME, group))
+
+    return result[0]
+
+def startSnapshot(conn, group, server_id, caller, db_name=DATABASE_NAME):
+    """
+    Starts snapshotting the instance of 'group' if it's worth keeping,
+    without waiting for OpenStack to finish. The snapshot is recorded as
+    pending, and checkSnapshots saves it once its image is active. Groups
+    that already have a snapshot of the same data only have its lifetime
+    extended. Failures are logged, never raised, so they don't stop the
+    instance from being destroyed.
+
+    Parameters
+    ----------
+    conn
+        An OpenStack connection
+    group
+        Name of the Unix group
+    server_id
+        ID of the group's instance, which should be up
+    caller
+        Name of the logger to report to, 'cli' logs to the CLI's logger
+    db_name
+        Stores the name of the SQL database
+
+    Returns
+    -------
+    started
+        True if a snapshot was started, in which case the instance has to
+        be kept until checkSnapshots says it's done
+    """
+    if not SNAPSHOTS_ENABLED:
+        return False
+
+    logger = logging.getLogger(caller)
+    db = database.getConnection(db_name)
+
+    result = db.execute('''SELECT groups.data_hash, groups.time,
+        snapshots.image_id, snapshots.data_hash
+        FROM groups LEFT OUTER JOIN snapshots
+        ON snapshots.group_name = groups.group_name
+        WHERE groups.group_name = ?''', (group,)).fetchone()
+
+    if result is None or result[0] is None \
+            or result[1] < SNAPSHOT_MIN_BUILD_TIME:
+        return False
+
+    data_hash, _, old_image, old_hash = result
+
+    if old_image is not None and old_hash == data_hash:
+        with database.transaction(db_name) as cursor:
+            cursor.execute('''UPDATE snapshots SET
+                expiry_time = CAST(strftime("%s", "now") AS INTEGER) + ?
+                WHERE group_name = ?''', (SNAPSHOT_LIFETIME, group))
+        return False
+
+    logger.info("Snapshotting {} instance...".format(group))
+
+    try:
+        image = conn.create_image_snapshot(
+            'arboretum-{}-{}'.format(group, data_hash[:12]), server_id,
+            wait=False, arboretum_group=group, arboretum_data_hash=data_hash)
+    except Exception as error:
+        logger.warning("Couldn't snapshot {} instance.\n{}: {}".format(group,
+            type(error), error))
+        return False
+
+    with database.transaction(db_name) as cursor:
+        cursor.execute('''INSERT OR REPLACE INTO pending_snapshots(
+            group_name, image_id, server_id, data_hash, start_time)
+            VALUES(?, ?, ?, ?, CAST(strftime("%s", "now") AS INTEGER))''',
+            (group, image.id, server_id, data_hash))
+
+    return True
+
+def checkSnapshots(conn, caller, db_name=DATABASE_NAME):
+    """
+    Saves the pending snapshots whose image is active, and gives up on the
+    ones that failed or took longer than SNAPSHOT_TIMEOUT seconds
+
+    Parameters
+    ----------
+    conn
+        An OpenStack connection
+    caller
+        Name of the logger to report to, 'cli' logs to the CLI's logger
+    db_name
+        Stores the name of the SQL database
+
+    Returns
+    -------
+    finished
+        List of (group, server_id) tuples of the instances whose snapshot
+        is done with, either way, and that can be deleted now
+    """
+    pending = database.getConnection(db_name).execute('''SELECT
+        group_name, image_id, server_id, data_hash,
+        start_time + ? < CAST(strftime("%s", "now") AS INTEGER)
+        FROM pending_snapshots''', (SNAPSHOT_TIMEOUT,)).fetchall()
+
+    if not pending:
+        return []
+
+    logger = logging.getLogger(caller)
+    finished = []
+
+    for group, image_id, server_id, data_hash, timed_out in pending:
+        try:
+            image = conn.get_image(image_id)
+        except Exception as error:
+            # asked again on the next check
+            logger.warning("Couldn't check snapshot {} of {}.\n{}: {}"
+                .format(image_id, group, type(error), error))
+            continue
+
+        status = image.status if image is not None else "deleted"
+
+        if status == "active":
+            with database.transaction(db_name) as cursor:
+                old_image = cursor.execute('''SELECT image_id FROM snapshots
+                    WHERE group_name = ?''', (group,)).fetchone()
+                cursor.execute('''INSERT OR REPLACE INTO snapshots(
+                    group_name, image_id, data_hash, creation_time,
+                    expiry_time)
+                    VALUES(?, ?, ?, CAST(strftime("%s", "now") AS INTEGER),
+                    CAST(strftime("%s", "now") AS INTEGER) + ?)''',
+                    (group, image_id, data_hash, SNAPSHOT_LIFETIME))
+                cursor.execute('''DELETE FROM pending_snapshots
+                    WHERE group_name = ?''', (group,))
+
+            logger.info("Snapshot {} of {} instance saved.".format(image_id,
+                group))
+
+            if old_image is not None and old_image[0] != image_id:
+                deleteImage(conn, old_image[0], logger)
+        elif status in ("killed", "deleted") or timed_out:
+            logger.warning("Snapshot {} of {} instance failed with status " \
+                "{}.".format(image_id, group, status))
+            if status != "deleted":
+                deleteImage(conn, image_id, logger)
+
+            with database.transaction(db_name) as cursor:
+                cursor.execute('''DELETE FROM pending_snapshots
+                    WHERE group_name = ?''', (group,))
+        else:
+            # still queued or saving
+            continue
+
+        finished.append((group, server_id))
+
+    return finished
+
+def deleteImage(conn, image_id, logger):
+    """
+    Deletes a snapshot's image, logging rather than raising on failure
+    """
+    try:
+        conn.delete_image(image_id)
+    except Exception as error:
+        logger.warning("Couldn't delete snapshot {}.\n{}: {}"
+            .format(image_id, type(error), error))
+
+def pruneSnapshots(connect, db_name=DATABASE_NAME):
+    """
+    Deletes snapshots that expired, or whose group's data has changed or
+    is no longer in the catalogue
+
+    Parameters
+    ----------
+    connect
+        Function returning an OpenStack connection
+    db_name
+        Stores the name of the SQL database
+    """
+    stale = database.getConnection(db_name).execute('''SELECT
+        snapshots.group_name, snapshots.image_id
+        FROM snapshots LEFT OUTER JOIN groups
+        ON groups.group_name = snapshots.group_name
+        WHERE snapshots.expiry_time <= CAST(strftime("%s", "now") AS INTEGER)
+        OR groups.data_hash IS NOT snapshots.data_hash''').fetchall()
+
+    if not stale:
+        return
+
+    logger = logging.getLogger("daemon")
+    conn = connect()
+
+    try:
+        for group, image_id in stale:
+            with database.transaction(db_name) as cursor:
+                # skipped if a new snapshot replaced it in the meantime
+                cursor.execute('''DELETE FROM snapshots
+                    WHERE group_name = ? AND image_id = ?''',
+                    (group, image_id))
+                if cursor.rowcount == 0:
+                    continue
+
+            deleteImage(conn, image_id, logger)
+            logger.info("Deleted stale snapshot {} of {}."
+                .format(image_id, group))
+    finally:
+        conn.close()
@@ -0,0 +1,274 @@
+import threading
+import time
+
+from . import database
+from . import flavors
+from . import metrics
+from .constants import DATABASE_NAME, RAM_HEADROOM, ESTIMATE_GROUP_HISTORY, \
+    ESTIMATE_MIN_SAMPLES
+
+"""
+Build telemetry records when each instance reaches each phase of its build:
+
+accepted
+    The create request was received, eg when an API job was submitted
+created
+    OpenStack accepted the create_server call
+claimed
+    Instead of 'created', for instances taken from the warm pool
+restored
+    Instead of 'created', for instances booted from a snapshot
+active
+    OpenStack reported the server as ACTIVE
+ip_assigned
+    The daemon found the server's IP
+ready
+    Treeserve answered its first request
+
+The time from 'accepted' to 'ready' of instances that were built from
+scratch, rather than claimed or restored, is what the estimator learns
+from.
+"""
+
+PHASES = ['accepted', 'created', 'claimed', 'restored', 'active',
+    'ip_assigned', 'ready']
+
+PHASE_SECONDS = metrics.registry.histogram("arboretum_build_phase_seconds",
+    "Seconds from a create being accepted to the instance reaching each "
+    "phase", ["phase"], buckets=(5, 15, 30, 60, 120, 300, 600, 900, 1800,
+    3600, 7200, 14400))
+
+def recordBuild(cursor, instance_id, group, flavor, ram, pooled, events):
+    """
+    Records a new instance and the phases it has already gone through
+
+    Parameters
+    ----------
+    cursor
+        Cursor of the database, inside a transaction
+    instance_id
+        ID of the server
+    group
+        Name of the Unix group the instance is for
+    flavor
+        Name of the instance's flavor
+    ram
+        Bytes of RAM the group needs, as in the groups table
+    pooled
+        Whether the instance was claimed from the warm pool
+    events
+        Dictionary mapping phases to epoch times
+    """
+    cursor.execute('''INSERT OR REPLACE INTO builds(instance_id, group_name,
+        flavor, ram, pooled) VALUES(?, ?, ?, ?, ?)''',
+        (instance_id, group, flavor, ram, int(pooled)))
+
+    for phase, when in events.items():
+        recordEvent(cursor, instance_id, phase, when)
+
+def recordEvent(cursor, instance_id, phase, when=None):
+    """
+    Records that an instance reached 'phase'. Only the first time a phase is
+    reached counts.
+
+    Parameters
+    ----------
+    cursor
+        Cursor of the database, inside a transaction
+    instance_id
+        ID of the server
+    phase
+        One of PHASES
+    when
+        Epoch time, defaults to now
+    """
+    when = time.time() if when is None else when
+
+    cursor.execute('''INSERT OR IGNORE INTO build_events(instance_id, phase,
+        time) VALUES(?, ?, ?)''', (instance_id, phase, when))
+
+    if cursor.rowcount == 1 and phase != "accepted":
+        accepted = cursor.execute('''SELECT time FROM build_events
+            WHERE instance_id = ? AND phase = "accepted"''',
+            (instance_id,)).fetchone()
+        if accepted is not None:
+            PHASE_SECONDS.observe(when - accepted[0], phase=phase)
+
+def fitLine(samples):
+    """
+    Least squares fit of y = intercept + slope * x
+
+    Parameters
+    ----------
+    samples
+        List of (x, y) tuples
+
+    Returns
+    -------
+    (intercept, slope)
+        The slope is 0 if every sample has the same x
+    """
+    n = len(samples)
+    mean_x = sum(x for x, y in samples) / n
+    mean_y = sum(y for x, y in samples) / n
+
+    spread = sum((x - mean_x) ** 2 for x, y in samples)
+    if spread == 0:
+        return mean_y, 0
+
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in samples) / spread
+    return mean_y - slope * mean_x, slope
+
+
+class BuildEstimator:
+    """
+    Predicts how long an instance will take from being requested to being
+    ready, from the build history
+
+    Groups that have been built before are predicted from the mean of their
+    last ESTIMATE_GROUP_HISTORY builds. Other groups use a linear fit of
+    build time against RAM for the flavor they would get, or across all
+    flavors if that flavor has too few builds. The models are refitted
+    whenever an instance becomes ready, so predictions cost a couple of
+    dictionary lookups.
+
+    Methods
+    -------
+    refresh(db_name)
+        Refits the models if the history has changed
+    predict(group, ram)
+        Predicted seconds to ready, or None without enough history
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.group_means = {}
+        self.flavor_models = {}
+        self.overall = None
+
+    def refresh(self, db_name=DATABASE_NAME):
+        """
+        Refits the models if instances became ready since the last fit
+
+        Parameters
+        ----------
+        db_name
+            Stores the name of the SQL database
+        """
+        db = database.getConnection(db_name)
+
+        version = db.execute('''SELECT COUNT(*), MAX(rowid) FROM build_events
+            WHERE phase = "ready"''').fetchone()
+
+        with self.lock:
+            if version == self.version:
+                return
+
+            # most recent first, so each group keeps its latest builds
+            durations = db.execute('''SELECT builds.group_name,
+                builds.flavor, builds.ram, ready.time - accepted.time
+                FROM builds
+                JOIN build_events accepted
+                    ON accepted.instance_id = builds.instance_id
+                    AND accepted.phase = "accepted"
+                JOIN build_events ready
+                    ON ready.instance_id = builds.instance_id
+                    AND ready.phase = "ready"
+                WHERE builds.pooled = 0
+                AND NOT EXISTS (SELECT 1 FROM build_events restored
+                    WHERE restored.instance_id = builds.instance_id
+                    AND restored.phase = "restored")
+                ORDER BY ready.time DESC''').fetchall()
+
+            by_group = {}
+            by_flavor = {}
+            for group, flavor, ram, seconds in durations:
+                if len(by_group.setdefault(group, [])) < \
+                        ESTIMATE_GROUP_HISTORY:
+                    by_group[group].append(seconds)
+                by_flavor.setdefault(flavor, []).append((ram, seconds))
+
+            self.group_means = {group: sum(times) / len(times)
+                for group, times in by_group.items()}
+            self.flavor_models = {flavor: fitLine(samples)
+                for flavor, samples in by_flavor.items()
+                if len(samples) >= ESTIMATE_MIN_SAMPLES}
+
+            everything = [(ram, seconds)
+                for group, flavor, ram, seconds in durations]
+            self.overall = fitLine(everything) \
+                if len(everything) >= ESTIMATE_MIN_SAMPLES else None
+
+            self.version = version
+
+    def predict(self, group, ram):
+        """
+        Predicts how long a new instance of 'group' would take to be ready
+
+        Parameters
+        ----------
+        group
+            Name of the Unix group
+        ram
+            Bytes of RAM the group needs
+
+        Returns
+        -------
+        seconds
+            Predicted seconds from request to ready, or None if there's no
+            history to go by
+        """
+        if group in self.group_means:
+            return self.group_means[group]
+
+        flavor = flavors.catalogue.peek(ram + RAM_HEADROOM)
+        model = self.flavor_models.get(flavor, self.overall)
+
+        if model is None:
+            return None
+
+        return max(0, model[0] + model[1] * ram)
+
+# shared by everything in this process
+estimator = BuildEstimator()
+
+def summarisePhases(db_name=DATABASE_NAME):
+    """
+    Works out where build time goes, per flavor
+
+    Parameters
+    ----------
+    db_name
+        Stores the name of the SQL database
+
+    Returns
+    -------
+    summary
+        Dictionary mapping flavors to the number of finished 'builds' and
+        the mean seconds from 'accepted' to each later phase
+    """
+    db = database.getConnection(db_name)
+
+    summary = {}
+    for flavor, count in db.execute('''SELECT builds.flavor, COUNT(*)
+            FROM builds JOIN build_events
+            ON build_events.instance_id = builds.instance_id
+            AND build_events.phase = "ready"
+            GROUP BY builds.flavor'''):
+        summary[flavor] = {'builds': count}
+
+    for flavor, phase, seconds in db.execute('''SELECT builds.flavor,
+            event.phase, AVG(event.time - accepted.time)
+            FROM builds
+            JOIN build_events accepted
+                ON accepted.instance_id = builds.instance_id
+                AND accepted.phase = "accepted"
+            JOIN build_events event
+                ON event.instance_id = builds.instance_id
+                AND event.phase != "accepted"
+            WHERE builds.instance_id IN (SELECT instance_id
+                FROM build_events WHERE phase = "ready")
+            GROUP BY builds.flavor, event.phase'''):
+        summary[flavor][phase] = seconds
+
+    return summary
@@ -5,8 +5,37 @@
 export S3_AWS_ACCESS_KEY=""
 export S3_AWS_SECRET_KEY=""
 export S3_SANGER_URL="https://cog.sanger.ac.uk"
-export S3_GROUP_NAME="{{ group_name }}"
 
 cd /home/ubuntu
 git clone https://github.com/wtsi-hgi/sapling.git
+{% if pooled %}
+# Pooled instance: provision everything that doesn't depend on a group, then
+# wait for Arboretum to assign one through the server metadata
+ansible-playbook /home/ubuntu/sapling/local.yml --skip-tags group_data
+
+mkdir -p /tmp/arboretum-pool
+(cd /tmp/arboretum-pool && exec python3 -m http.server 8081) &
+POOL_SERVER=$!
+
+METADATA="http://169.254.169.254/openstack/latest/meta_data.json"
+until S3_GROUP_NAME=$(curl -sf "$METADATA" | python3 -c \
+    'import json, sys; print(json.load(sys.stdin)["meta"]["arboretum_group"])' \
+    2>/dev/null); do
+    sleep 2
+done
+
+kill $POOL_SERVER
+export S3_GROUP_NAME
+{% else %}
+export S3_GROUP_NAME="{{ group_name }}"
+{% endif %}
+{% if restored %}
+# booted from a snapshot of this group's last instance, the tree is already
+# built and only has to be served again
+ansible-playbook /home/ubuntu/sapling/local.yml --tags serve
+{% elif pooled %}
+# everything else was provisioned while the instance waited in the pool
+ansible-playbook /home/ubuntu/sapling/local.yml --tags group_data
+{% else %}
 ansible-playbook /home/ubuntu/sapling/local.yml
+{% endif %}